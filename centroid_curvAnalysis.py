@@ -51,22 +51,6 @@ class FNNDSC_CentroidCloud(base.FNNDSC):
     # across all instances of this class
     #
     _dictErr = {
-        'subjectSpecFail'   : {
-            'action'        : 'examining command line arguments, ',
-            'error'         : 'it seems that no subjects were specified.',
-            'exitCode'      : 10},
-        'noFreeSurferEnv'   : {
-            'action'        : 'examining environment, ',
-            'error'         : 'it seems that the FreeSurfer environment has not been sourced.',
-            'exitCode'      : 11},
-        'noStagePostConditions' : {
-            'action'        : 'querying a stage for its exitCode, ',
-            'error'         : 'it seems that the stage has not been specified.',
-            'exitCode'      : 12},
-        'subjectDirnotExist': {
-            'action'        : 'examining the <subjectDirectories>, ',
-            'error'         : 'the directory does not exist.',
-            'exitCode'      : 13},
         'Load'              : {
             'action'        : 'attempting to pickle load object, ',
             'error'         : 'a PickleError occured.',
@@ -993,7 +977,7 @@ class FNNDSC_CentroidCloud(base.FNNDSC):
                         pylab.xlabel('group mean cuvature')
                         pylab.ylabel('group expected occurrence')
                     _str_graphFile = '%s-centroids-cloudCoreContour' % self.filestem()
-                    self._log('Saving graphical plot to stem "%s"                        \r' % _str_graphFile)
+                    self._log('Saving graphical plot to stem "%s"                        \r', _str_graphFile)
                     pylab.savefig('%s.png' % _str_graphFile, bbox_inches=0)
                     pylab.savefig('%s.pdf' % _str_graphFile, bbox_inches=0)
                     pylab.close()
@@ -1024,7 +1008,8 @@ def synopsis(ab_shortOnly = False):
                             [--curv|-c <curvType>               \\
                             [--asymmetricalDeviations <center]  \\
                             [--usePercentiles <percentile>]     \\
-                            [--convexHulluse|-x]
+                            [--convexHulluse|-x]                \\
+                            [--profile <prefix>]
     ''' % scriptName
 
     description =  '''
@@ -1092,6 +1077,11 @@ def synopsis(ab_shortOnly = False):
 
         The special keyword 'all' can be used to turn on all stages.
 
+        --profile <prefix>
+        If specified, profile the run with a low-overhead sampling profiler
+        and write the collapsed stacks of each stage to
+        <prefix>.<stage>.collapsed, e.g. for rendering with 'flamegraph.pl'.
+
 
     EXAMPLES
 
@@ -1233,6 +1223,11 @@ if __name__ == "__main__":
                         action='store_true',
                         default=False,
                         help='Use a convex hull about the statistical boundary')
+    parser.add_argument('--profile',
+                        dest='profile',
+                        action='store',
+                        default='',
+                        help='file prefix for sampled profiles of each stage')
     args = parser.parse_args()
 
     OSshell = crun.crun()
@@ -1253,7 +1248,8 @@ if __name__ == "__main__":
                         logTo                   = 'CentroidCloud.log',
                         syslog                  = True,
                         logTee                  = True,
-                        convexHulluse           = args.convexHulluse
+                        convexHulluse           = args.convexHulluse,
+                        sampleTo                = args.profile
                         )
 
     Ccloud.verbosity(args.verbosity)
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+'''
+
+    A small central log collector for the 'message'/'dgmsocket' logging
+    infrastructure.
+
+    Processes anywhere on the cluster log to the collector by pointing
+    their message.Message objects at it:
+
+        log.to('tcp://<collectorHost>:<port>')      # reliable stream
+        log.to('udp://<collectorHost>:<port>')      # coalesced datagrams
+
+    The collector appends the logs of each sending host to its own file
+    and notes any frames that were lost in transit.
+
+'''
+
+import  os
+import  sys
+import  argparse
+
+import  dgmsocket as dgm
+
+scriptName      = os.path.basename(sys.argv[0])
+
+
+def synopsis(ab_shortOnly = False):
+    shortSynopsis =  '''
+    SYNOPSIS
+
+            %s                                      \\
+                            [--port|-p <port>]                  \\
+                            [--bind|-b <address>]               \\
+                            [--outputDir|-o <dir>]
+    ''' % scriptName
+
+    description =  '''
+    DESCRIPTION
+
+        `%s' listens on <port> (both UDP and TCP) for log traffic sent by
+        message.Message objects with a 'tcp://' or 'udp://' destination,
+        and appends it to <dir>/<sendingHost>.log.
+
+        Each transmission carries a per-process sequence number, so lines
+        that were lost in transit are noted in the log as
+
+            *** <host>:<pid>: <N> frame(s) lost (<first>-<last>) ***
+
+        Plain datagrams sent to a 'host:port' destination are written
+        as-is to <dir>/dgm.log.
+
+    ARGS
+
+        --port|-p <port> (default: 1701)
+        The port to listen on.
+
+        --bind|-b <address> (default: all interfaces)
+        The address to listen on.
+
+        --outputDir|-o <dir> (default: current directory)
+        The directory in which to write the log files.
+
+    EXAMPLES
+
+        $>dgmcollect.py --port 1701 --outputDir /neuro/logs
+
+    ''' % (scriptName)
+    if ab_shortOnly:
+        return shortSynopsis
+    else:
+        return shortSynopsis + description
+
+
+#
+# entry point
+#
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description = synopsis(True))
+    parser.add_argument('--port', '-p',
+                        dest='port',
+                        action='store',
+                        default='1701',
+                        help='port to listen on')
+    parser.add_argument('--bind', '-b',
+                        dest='bind',
+                        action='store',
+                        default='',
+                        help='address to listen on')
+    parser.add_argument('--outputDir', '-o',
+                        dest='outputDir',
+                        action='store',
+                        default='.',
+                        help='directory for the collected log files')
+    args = parser.parse_args()
+
+    collector = dgm.C_dgmcollector(int(args.port), args.outputDir, args.bind)
+    print 'Collecting logs on port %s into %s...' % (args.port, args.outputDir)
+    try:
+        collector.serve()
+    except KeyboardInterrupt:
+        pass
+    collector.close()
+    print '%d frames received, %d frames lost.' % \
+          (collector.m_frames, collector.m_lost)
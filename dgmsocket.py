@@ -19,7 +19,15 @@
 # 06 December 2011
 # o Clean-up the socket communication
 #
+# 18 October 2026
+# o Add a coalescing, sequenced transport (C_dgmstream) over UDP or
+#   TCP, and a matching collector (C_dgmcollector, see dgmcollect.py).
+#
 import socket
+import os
+import time
+import select
+import threading
 
 class C_dgmsocket :
 	# 
@@ -84,3 +92,317 @@ class C_dgmsocket :
             
                 
 
+
+
+#
+#	A C_dgmstream collects written text in a bounded buffer that is
+#	drained by a background thread, either as coalesced UDP datagrams
+#	or over a persistent TCP connection. Each frame carries a header
+#
+#		DGM1 <source> <seq> <nbytes>\n
+#
+#	followed by <nbytes> of payload, where <source> identifies the
+#	sending process (<host>:<pid>) and <seq> counts the frames of that
+#	source, so that a collector can detect (and report) lost frames.
+#	If the buffer is full, writers block until there is room, for at
+#	most m_maxWait seconds, after which the oldest buffered text is
+#	dropped and replaced by a note of the loss.
+#
+class C_dgmstream :
+	#
+	# Member variables
+	#
+	mstr_obj	= 'C_dgmstream';	# name of object class
+	mstr_magic	= 'DGM1';		# frame header tag
+
+	def __init__(	self,
+			astr_hostname	= 'localhost',
+			a_port		= 1701,
+			astr_protocol	= 'udp',
+			a_maxDatagram	= 8192,
+			a_maxBuffer	= 4*1024*1024,
+			a_flushInterval	= 0.2,
+			a_maxWait	= 30.0) :
+		self.mstr_remoteHost	= astr_hostname
+		self.m_port		= a_port
+		self.mstr_protocol	= astr_protocol
+		self.m_maxDatagram	= a_maxDatagram
+		self.m_maxBuffer	= a_maxBuffer
+		self.m_flushInterval	= a_flushInterval
+		self.m_maxWait		= a_maxWait
+		self.mstr_source	= '%s:%d' % (socket.gethostname(), os.getpid())
+		self.m_seq		= 0
+		self.m_dropped		= 0
+		self.ml_buffer		= []
+		self.m_buffered		= 0
+		self.m_socket		= None
+		self.mb_closed		= False
+		self.m_cond		= threading.Condition()
+		self.m_thread		= threading.Thread(target = self.run)
+		self.m_thread.daemon	= True
+		self.m_thread.start()
+
+	def frame(self, str_payload) :
+		self.m_seq += 1
+		return '%s %s %d %d\n%s' % (self.mstr_magic, self.mstr_source,
+					self.m_seq, len(str_payload), str_payload)
+
+	def connect(self) :
+		if self.m_socket is not None: return True
+		try:
+			if self.mstr_protocol == 'tcp':
+				self.m_socket = socket.create_connection(
+					(self.mstr_remoteHost, self.m_port), 10)
+			else:
+				self.m_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		except socket.error:
+			self.m_socket = None
+			return False
+		return True
+
+	def send(self, str_payload) :
+		# Returns False (keeping the payload) if the connection is down.
+		if not self.connect(): return False
+		str_frame = self.frame(str_payload)
+		try:
+			if self.mstr_protocol == 'tcp':
+				self.m_socket.sendall(str_frame)
+			else:
+				self.m_socket.sendto(str_frame,
+					(self.mstr_remoteHost, self.m_port))
+		except socket.error:
+			self.m_seq -= 1
+			self.m_socket.close()
+			self.m_socket = None
+			return False
+		return True
+
+	def chunk(self) :
+		# Take whole messages, up to m_maxDatagram bytes, off the front
+		# of the buffer. Only a message that is larger than m_maxDatagram
+		# by itself is split, preferably after a newline.
+		str_data = self.ml_buffer[0]
+		if len(str_data) > self.m_maxDatagram:
+			cut = str_data.rfind('\n', 0, self.m_maxDatagram) + 1
+			if not cut: cut = self.m_maxDatagram
+			self.ml_buffer[0] = str_data[cut:]
+			self.m_buffered  -= cut
+			return str_data[:cut]
+		l_chunk = []
+		size	= 0
+		while len(self.ml_buffer) and \
+		      size + len(self.ml_buffer[0]) <= self.m_maxDatagram:
+			str_data = self.ml_buffer.pop(0)
+			l_chunk.append(str_data)
+			size += len(str_data)
+		self.m_buffered -= size
+		return ''.join(l_chunk)
+
+	def run(self) :
+		retry = self.m_flushInterval
+		while True:
+			self.m_cond.acquire()
+			while not self.m_buffered and not self.mb_closed:
+				self.m_cond.wait(self.m_flushInterval)
+			if not self.m_buffered and self.mb_closed:
+				self.m_cond.release()
+				return
+			str_chunk = self.chunk()
+			self.m_cond.release()
+			while not self.send(str_chunk):
+				# Connection down: wait, then try again. Writers block
+				# meanwhile, once the buffer fills up.
+				if self.mb_closed and retry >= 8: return
+				time.sleep(retry)
+				retry = min(retry * 2, 10.0)
+			retry = self.m_flushInterval
+			self.m_cond.acquire()
+			self.m_cond.notifyAll()
+			self.m_cond.release()
+
+	def write(self, str_payload) :
+		self.m_cond.acquire()
+		deadline = time.time() + self.m_maxWait
+		while self.m_buffered + len(str_payload) > self.m_maxBuffer and \
+		      len(self.ml_buffer) and time.time() < deadline:
+			self.m_cond.wait(min(1.0, max(0.0, deadline - time.time())))
+		dropped = 0
+		while self.m_buffered + len(str_payload) > self.m_maxBuffer and \
+		      len(self.ml_buffer):
+			self.m_buffered -= len(self.ml_buffer.pop(0))
+			dropped += 1
+		if dropped:
+			self.m_dropped += dropped
+			str_note = '\n*** %s: %d message(s) dropped by sender ***\n' % \
+				(self.mstr_source, dropped)
+			self.ml_buffer.insert(0, str_note)
+			self.m_buffered += len(str_note)
+		self.ml_buffer.append(str_payload)
+		self.m_buffered += len(str_payload)
+		if self.m_buffered >= self.m_maxDatagram: self.m_cond.notifyAll()
+		self.m_cond.release()
+
+	def tx(self, str_payload) :
+		self.write(str_payload)
+
+	def flush(self) :
+		# Ask for the buffer to be sent now, without waiting for it.
+		self.m_cond.acquire()
+		self.m_cond.notifyAll()
+		self.m_cond.release()
+
+	def drain(self) :
+		# Wait until everything written so far has been sent.
+		self.m_cond.acquire()
+		self.m_cond.notifyAll()
+		while self.m_buffered and self.m_thread.isAlive():
+			self.m_cond.wait(1.0)
+		self.m_cond.release()
+
+	def close(self) :
+		self.m_cond.acquire()
+		self.mb_closed = True
+		self.m_cond.notifyAll()
+		self.m_cond.release()
+		while self.m_thread.isAlive(): self.m_thread.join(1)
+		if self.m_socket is not None: self.m_socket.close()
+		self.m_socket = None
+
+	def dropped(self) :
+		return self.m_dropped
+
+
+class C_dgmcollector :
+	#
+	# Member variables
+	#
+	mstr_obj	= 'C_dgmcollector';	# name of object class
+
+	#
+	#	A collector listens on both UDP and TCP on <a_port>, unpacks
+	#	the frames sent by C_dgmstream objects, and appends their
+	#	payloads to one log file per sending host in <astr_dir>.
+	#	Since the processes of a host share its file, only complete
+	#	lines are written, and the partial last line of a frame is
+	#	held back per source until the rest of it arrives.
+	#	Lost frames are noted in the log file of the source. Plain
+	#	(unframed) datagrams, as sent by C_dgmsocket, are logged
+	#	as-is to 'dgm.log'.
+	#
+	def __init__(self, a_port = 1701, astr_dir = '.', astr_bind = '') :
+		self.m_port		= a_port
+		self.mstr_dir		= astr_dir
+		self.md_file		= {}	# host -> open file
+		self.md_seq		= {}	# source -> last seq
+		self.md_partial		= {}	# source -> partial last line
+		self.md_stream		= {}	# tcp socket -> pending data
+		self.m_frames		= 0
+		self.m_lost		= 0
+		if not os.path.isdir(astr_dir): os.makedirs(astr_dir)
+		self.m_udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		self.m_udp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		self.m_udp.bind((astr_bind, a_port))
+		self.m_tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.m_tcp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		self.m_tcp.bind((astr_bind, a_port))
+		self.m_tcp.listen(64)
+
+	def file(self, str_host) :
+		if str_host not in self.md_file:
+			str_name = os.path.join(self.mstr_dir, '%s.log' % str_host)
+			self.md_file[str_host] = open(str_name, 'a')
+		return self.md_file[str_host]
+
+	def deliver(self, str_source, seq, str_payload) :
+		self.m_frames += 1
+		f	= self.file(str_source.rpartition(':')[0])
+		last	= self.md_seq.get(str_source, 0)
+		if seq > last + 1:
+			self.m_lost += seq - last - 1
+			self.partial_flush(str_source)
+			f.write('*** %s: %d frame(s) lost (%d-%d) ***\n' % \
+				(str_source, seq - last - 1, last + 1, seq - 1))
+		if seq > last: self.md_seq[str_source] = seq
+		str_data = self.md_partial.pop(str_source, '') + str_payload
+		index	 = str_data.rfind('\n') + 1
+		f.write(str_data[:index])
+		if index < len(str_data): self.md_partial[str_source] = str_data[index:]
+
+	def partial_flush(self, str_source) :
+		# Write out the held back partial line of <str_source>, if any.
+		str_data = self.md_partial.pop(str_source, '')
+		if len(str_data):
+			self.file(str_source.rpartition(':')[0]).write(str_data + '\n')
+
+	def unpack(self, str_data) :
+		# Returns (source, seq, payload, rest) or None if incomplete.
+		index = str_data.find('\n')
+		if index < 0: return None
+		l_header = str_data[:index].split(' ')
+		if len(l_header) != 4 or l_header[0] != C_dgmstream.mstr_magic:
+			raise ValueError('not a dgm frame')
+		size = int(l_header[3])
+		if len(str_data) < index + 1 + size: return None
+		return (l_header[1], int(l_header[2]),
+			str_data[index+1:index+1+size], str_data[index+1+size:])
+
+	def datagram(self) :
+		str_data, address = self.m_udp.recvfrom(65536)
+		try:
+			t_frame = self.unpack(str_data)
+		except ValueError:
+			t_frame = None
+		if t_frame is None:
+			self.file('dgm').write(str_data)
+			return
+		self.deliver(*t_frame[:3])
+
+	def stream(self, sock) :
+		try:
+			str_data = sock.recv(65536)
+		except socket.error:
+			str_data = ''
+		if not str_data:
+			del self.md_stream[sock]
+			sock.close()
+			return
+		str_data = self.md_stream[sock] + str_data
+		try:
+			while True:
+				t_frame = self.unpack(str_data)
+				if t_frame is None: break
+				self.deliver(*t_frame[:3])
+				str_data = t_frame[3]
+		except ValueError:
+			# Not a framed stream; drop the connection.
+			del self.md_stream[sock]
+			sock.close()
+			return
+		self.md_stream[sock] = str_data
+
+	def flush(self) :
+		for f in self.md_file.values(): f.flush()
+
+	def serve(self, a_timeout = None) :
+		# Run until a_timeout seconds have passed (or forever).
+		start = time.time()
+		while a_timeout is None or time.time() - start < a_timeout:
+			l_fd = [self.m_udp, self.m_tcp] + self.md_stream.keys()
+			l_ready = select.select(l_fd, [], [], 1.0)[0]
+			for sock in l_ready:
+				if sock is self.m_udp:
+					self.datagram()
+				elif sock is self.m_tcp:
+					client, address = self.m_tcp.accept()
+					self.md_stream[client] = ''
+				else:
+					self.stream(sock)
+			self.flush()
+
+	def close(self) :
+		for str_source in self.md_partial.keys(): self.partial_flush(str_source)
+		self.flush()
+		for f in self.md_file.values(): f.close()
+		for sock in self.md_stream.keys(): sock.close()
+		self.m_udp.close()
+		self.m_tcp.close()
@@ -21,17 +21,264 @@ key has a dictionary of 'action', 'error', 'exitCode':
         }
     }
 
+Keys are looked up in the _dictErr of the callingClass and then of each of
+its base classes, and finally in the central registry of this module (see
+register()), which holds the errors that are common to all classes, e.g.
+'preconditions', 'noFreeSurferEnv' or 'stageExec'. A class only declares
+these to override them (say, with its own exit code).
+
+Fatal errors are raised as StageError exceptions. Since a StageError is a
+SystemExit, an uncaught one still terminates the script with the error's
+exit code, while pipelines and batch drivers can catch it, inspect its
+fields, or pass it between processes (it pickles).
+
+In "keep going" mode (see keepGoing()), errors reported with collect() are
+not fatal: they are logged in a single line each and added to a summary
+that can be reported once at the end of the run (see summary()).
+
 '''
 
 import  inspect
+import  linecache
 import  sys
+import  threading
 
 from    _common._colors import Colors
 
+
+# The central registry of errors common to all classes. See register().
+# A class only needs to declare these in its _dictErr to change them.
+_d_registry     = {
+    'unknown'           : {
+        'action'        : 'processing, ',
+        'error'         : 'an unspecified error occurred.',
+        'exitCode'      : 1},
+    'preconditions'     : {
+        'action'        : 'executing preconditions, ',
+        'error'         : 'a failure state was detected.',
+        'exitCode'      : 10},
+    'postconditions'    : {
+        'action'        : 'executing postconditions, ',
+        'error'         : 'a failure state was detected.',
+        'exitCode'      : 11},
+    'subjectSpecFail'   : {
+        'action'        : 'examining command line arguments, ',
+        'error'         : 'it seems that no subjects were specified.',
+        'exitCode'      : 10},
+    'noFreeSurferEnv'   : {
+        'action'        : 'examining environment, ',
+        'error'         : 'it seems that the FreeSurfer environment has not been sourced.',
+        'exitCode'      : 11},
+    'notClusterNode'    : {
+        'action'        : 'checking the execution environemt, ',
+        'error'         : 'script can only run on a cluster node.',
+        'exitCode'      : 12},
+    'noStagePostConditions' : {
+        'action'        : 'querying a stage for its exitCode, ',
+        'error'         : 'it seems that the stage has not been specified.',
+        'exitCode'      : 12},
+    'subjectDirnotExist': {
+        'action'        : 'examining the <subjectDirectories>, ',
+        'error'         : 'the directory does not exist.',
+        'exitCode'      : 13},
+    'stageExec'         : {
+        'action'        : 'executing stage, ',
+        'error'         : 'an external error was detected.',
+        'exitCode'      : 30}
+}
+
+
+def register(astr_key, astr_action, astr_error, exitCode):
+    '''
+    Add (or replace) the error <astr_key> in the central registry.
+    '''
+    _d_registry[astr_key] = {
+        'action'        : astr_action,
+        'error'         : astr_error,
+        'exitCode'      : exitCode}
+
+
+def registry(callingClass = None):
+    '''
+    Returns a dictionary of all the errors known to <callingClass> (or,
+    without a <callingClass>, of the central registry).
+    '''
+    d_error = dict(_d_registry)
+    if callingClass is not None:
+        for d_class in reversed(_classDicts(callingClass)): d_error.update(d_class)
+    return d_error
+
+
+def _classDicts(callingClass):
+    '''
+    Returns the _dictErr of <callingClass> and its base classes, most
+    derived first.
+    '''
+    klass = callingClass
+    if not inspect.isclass(klass): klass = callingClass.__class__
+    return [c.__dict__['_dictErr'] for c in inspect.getmro(klass)
+            if '_dictErr' in c.__dict__]
+
+
+def lookup(callingClass, astr_key):
+    '''
+    Returns the error dictionary of <astr_key> for <callingClass>.
+    '''
+    for d_class in _classDicts(callingClass):
+        if astr_key in d_class: return d_class[astr_key]
+    if astr_key in _d_registry: return _d_registry[astr_key]
+    return _d_registry['unknown']
+
+
+class StageError(SystemExit):
+    '''
+    A structured error, carrying the error key and exit code along with
+    where it occurred: the class (owner) that reported it and, where
+    known, the stage and subject being processed.
+    '''
+
+    def __init__(self, key = 'unknown', exitCode = 1, action = '', error = '',
+                 extra = '', owner = '', stage = '', subject = ''):
+        SystemExit.__init__(self, exitCode)
+        self.key        = key
+        self.exitCode   = exitCode
+        self.action     = action
+        self.error      = error
+        self.extra      = extra
+        self.owner      = owner
+        self.stage      = stage
+        self.subject    = subject
+
+
+    def __reduce__(self):
+        return (StageError, (self.key, self.exitCode, self.action, self.error,
+                             self.extra, self.owner, self.stage, self.subject))
+
+
+    def __str__(self):
+        l_where = [s for s in (self.owner, self.stage, self.subject) if s]
+        str_error = '[%s] %s: while %s%s' % (self.exitCode, '/'.join(l_where),
+                                             self.action, self.error)
+        if len(self.extra):
+            str_error += ' (%s)' % self.extra.strip().split('\n')[-1]
+        return str_error
+
+
+def error_make(callingClass, astr_key, astr_extraMsg = '', **kwargs):
+    '''
+    Returns the StageError for <astr_key> of <callingClass>. The
+    optional kwargs 'stage' and 'subject' are recorded in the error.
+    '''
+    d_error     = lookup(callingClass, astr_key)
+    str_owner   = ''
+    if hasattr(callingClass, 'name'): str_owner = str(callingClass.name())
+    return StageError(astr_key, d_error['exitCode'], d_error['action'],
+                      d_error['error'], astr_extraMsg, str_owner,
+                      kwargs.get('stage', ''), kwargs.get('subject', ''))
+
+
+class Summary:
+    '''
+    A thread-safe collection of non-fatal StageErrors, reported once at
+    the end of a run.
+    '''
+
+    def __init__(self):
+        self._l_error   = []
+        self._lock      = threading.Lock()
+
+
+    def add(self, e):
+        self._lock.acquire()
+        self._l_error.append(e)
+        self._lock.release()
+
+
+    def errors(self):
+        return list(self._l_error)
+
+
+    def __len__(self):
+        return len(self._l_error)
+
+
+    def exitCode(self):
+        '''
+        Returns the exit code of the first error, or 0 if there were none.
+        '''
+        if not len(self._l_error): return 0
+        return self._l_error[0].exitCode
+
+
+    def report(self, log):
+        '''
+        Write the summary to <log>, grouping the errors by owner and key.
+        '''
+        d_group = {}
+        l_group = []
+        for e in self.errors():
+            t_key = (e.owner, e.key)
+            if t_key not in d_group:
+                d_group[t_key] = []
+                l_group.append(t_key)
+            d_group[t_key].append(e)
+        log(Colors.RED + '\n:: ERROR SUMMARY :: ' + Colors.NO_COLOUR +
+            '%d error(s) were collected during the run.\n' % len(self), syslog = False)
+        for t_key in l_group:
+            l_error = d_group[t_key]
+            e       = l_error[0]
+            log('\t%s::%s (exit code %d) x %d: while %s%s\n' % \
+                (e.owner, e.key, e.exitCode, len(l_error), e.action, e.error),
+                syslog = False)
+            l_where = [x.subject or x.stage for x in l_error if x.subject or x.stage]
+            if len(l_where):
+                log('\t\tat: %s\n' % ', '.join(l_where), syslog = False)
+
+
+_summary        = Summary()
+_b_keepGoing    = False
+
+
+def summary():
+    '''
+    Returns the Summary of the errors collected so far.
+    '''
+    return _summary
+
+
+def keepGoing(*args):
+    '''
+    get/set the "keep going" flag. If True, errors reported via
+    collect() are added to the summary() instead of being fatal.
+
+    keepGoing():                returns the current flag
+    keepGoing(True|False):      sets the flag to True|False
+    '''
+    global _b_keepGoing
+    if len(args):
+        _b_keepGoing = args[0]
+    else:
+        return _b_keepGoing
+
+
+def _caller(depth):
+    '''
+    Returns the source line of the frame <depth> levels above the caller
+    of this function (or '__main__' if there is none). This is much
+    cheaper than inspect.stack(), which reads the source of every frame.
+    '''
+    try:
+        frame = sys._getframe(depth + 1)
+    except ValueError:
+        return '__main__'
+    return linecache.getline(frame.f_code.co_filename, frame.f_lineno).strip()
+
+
 def report(     callingClass,
                 astr_key,
                 ab_exitToOs=1,
-                astr_header=""
+                astr_header="",
+                **kwargs
                 ):
     '''
     Error handling.
@@ -40,9 +287,11 @@ def report(     callingClass,
     _dictErr and sent to log object.
 
     If <ab_exitToOs> is False, error is considered non-fatal and
-    processing can continue, otherwise processing terminates.
+    processing can continue, otherwise processing terminates by
+    raising the StageError of the error.
 
     '''
+    e           = error_make(callingClass, astr_key, astr_header, **kwargs)
     log         = callingClass.log()
     b_syslog    = log.syslog()
     log.syslog(False)
@@ -52,45 +301,57 @@ def report(     callingClass,
     log( "\n" )
     log( "\tSorry, some error seems to have occurred in:\n\t<" )
     log( Colors.LIGHT_GREEN + ("%s" % callingClass.name()) + Colors.NO_COLOUR + "::")
-    log( Colors.LIGHT_CYAN + ("%s" % inspect.stack()[2][4][0].strip()) + Colors.NO_COLOUR)
+    log( Colors.LIGHT_CYAN + ("%s" % _caller(2)) + Colors.NO_COLOUR)
     log( "> called by <")
-    try:
-        caller = inspect.stack()[3][4][0].strip()
-    except:
-        caller = '__main__'
+    caller = _caller(3)
     log( Colors.LIGHT_GREEN + ("%s" % callingClass.name()) + Colors.NO_COLOUR + "::")
     log( Colors.LIGHT_CYAN + ("%s" % caller) + Colors.NO_COLOUR)
     log( ">\n")
 
-    log( "\tWhile %s\n" % callingClass._dictErr[astr_key]['action'] )
-    log( "\t%s\n" % callingClass._dictErr[astr_key]['error'] )
+    log( "\tWhile %s\n" % e.action )
+    log( "\t%s\n" % e.error )
     log( "\n" )
     if ab_exitToOs:
-        log( "Returning to system with error code %d\n" % \
-                        callingClass._dictErr[astr_key]['exitCode'] )
-        sys.exit( callingClass._dictErr[astr_key]['exitCode'] )
+        log( "Returning to system with error code %d\n" % e.exitCode )
+        log.syslog(b_syslog)
+        raise e
     log.syslog(b_syslog)
-    return callingClass._dictErr[astr_key]['exitCode']
+    return e.exitCode
 
 
-def fatal( callingClass, astr_key, astr_extraMsg="" ):
+def fatal( callingClass, astr_key, astr_extraMsg="", **kwargs ):
     '''
     Convenience dispatcher to the error_exit() method.
 
     Will raise "fatal" error, i.e. terminate script.
     '''
     b_exitToOS  = True
-    report( callingClass, astr_key, b_exitToOS, astr_extraMsg )
+    report( callingClass, astr_key, b_exitToOS, astr_extraMsg, **kwargs )
 
 
-def warn( callingClass, astr_key, astr_extraMsg="" ):
+def warn( callingClass, astr_key, astr_extraMsg="", **kwargs ):
     '''
     Convenience dispatcher to the error_exit() method.
 
     Will raise "warning" error, i.e. script processing continues.
     '''
     b_exitToOS = False
-    report( callingClass, astr_key, b_exitToOS, astr_extraMsg )
+    report( callingClass, astr_key, b_exitToOS, astr_extraMsg, **kwargs )
 
-    
-    
\ No newline at end of file
+
+def collect( callingClass, astr_key, astr_extraMsg="", **kwargs ):
+    '''
+    Report an error that need not stop a batch, e.g. the failure of a
+    single subject. The optional kwargs 'stage' and 'subject' say where
+    the error occurred.
+
+    In "keep going" mode, the error is logged in a single line, added
+    to the summary() and its exit code returned. Otherwise, it is fatal.
+    '''
+    if not _b_keepGoing:
+        report( callingClass, astr_key, True, astr_extraMsg, **kwargs )
+    e = error_make(callingClass, astr_key, astr_extraMsg, **kwargs)
+    _summary.add(e)
+    callingClass.log()( Colors.YELLOW + ":: ERROR (continuing) :: " +
+                        Colors.NO_COLOUR + "%s\n" % str(e) )
+    return e.exitCode
@@ -11,6 +11,7 @@ from    _common import crun
 import  error
 import  message
 import  stage
+import  sampler
 
 
 class FNNDSC():
@@ -89,11 +90,25 @@ class FNNDSC():
 
         self._str_subjectDir            = ''
         self._b_debugMode               = False
+        self._l_plan                    = []
+        self._str_sampleTo              = ''
+        self._d_sampler                 = {}
         
         for key, value in kwargs.iteritems():
             if key == 'syslog':         self._log.syslog(value)
             if key == 'logTo':          self._log.to(value)
             if key == 'logTee':         self._log.tee(value)
+            if key == 'logRecords':     self._log.records(value)
+            if key == 'logRotate':      self._log.rotate(**value)
+            if key == 'journal':        self._pipeline.journal(value)
+            if key == 'resume':         self._pipeline.resume(value)
+            if key == 'profileTo':      self._pipeline.profileTo(value)
+            if key == 'plan':           self._l_plan            = value
+            if key == 'keepGoing':      error.keepGoing(value)
+            if key == 'telemetry':      self._pipeline.telemetry(value)
+            if key == 'sampleTo':       self._str_sampleTo      = value
+            if key == 'sampleInterval': self._d_sampler['interval'] = value
+            if key == 'sampleClock':    self._d_sampler['clock']    = value
 
 
 
@@ -110,12 +125,60 @@ class FNNDSC():
         '''
         The main 'engine' of the class.
 
+        If a timing history was given with the 'plan' keyword, the
+        pipeline is only planned (see stage.Pipeline.plan()), not run.
+
+        Errors collected in "keep going" mode (see error.collect()) are
+        summarized once the pipeline has finished, and the first one
+        determines the exit code.
+
+        If a file prefix was given with the 'sampleTo' keyword, the run
+        is profiled by a sampler.Sampler, and the collapsed stacks of
+        each stage are written to <prefix>.<stage>.collapsed (see
+        sample_write()).
+
         '''
+        if len(self._l_plan):
+            self._pipeline.plan(history = self._l_plan)
+            return
         self._log('Starting %s...\n' % self.__name)
-        self._pipeline.execute()
+        profiler = None
+        if len(self._str_sampleTo):
+            profiler = sampler.Sampler(**self._d_sampler)
+            profiler.start()
+        try:
+            self._pipeline.execute()
+        finally:
+            # Profiles are also written when a stage exits to the system.
+            if profiler is not None:
+                profiler.stop()
+                self.sample_write(profiler)
         self._log('Finished %s\n' % self.__name)
+        summary = error.summary()
+        if len(summary):
+            summary.report(self._log)
+            sys.exit(summary.exitCode())
         
 
+    def sample_write(self, profiler):
+        '''
+        Write the collapsed stacks recorded by <profiler> and log how
+        much of each stage's wall time was sampled.
+        '''
+        d_summary   = profiler.summary()
+        d_stageTime = self._pipeline.stageTimes()
+        profiler.write(self._str_sampleTo)
+        for str_label in profiler.labels():
+            str_file    = profiler.fileName(self._str_sampleTo, str_label)
+            d_label     = d_summary.get(str_label, {'samples': 0, 'seconds': 0})
+            str_wall    = ''
+            t_time      = d_stageTime.get(str_label)
+            if t_time is not None and t_time[1] is not None:
+                str_wall = ' of %.1f seconds wall time' % (t_time[1] - t_time[0])
+            self._log('Profile <%s>: %d samples (%.1f seconds)%s -> %s\n' % \
+                      (str_label, d_label['samples'], d_label['seconds'], str_wall, str_file))
+
+
     def stage_add(self, stage):
         self._pipeline.stage_add(stage)
 
@@ -16,11 +16,14 @@
 #
 
 import fnmatch
+import hashlib
+import json
 import matplotlib
 matplotlib.use( 'Agg' ) # switch to offscreen rendering
 import matplotlib.pyplot as plot
 from matplotlib.colors import LogNorm
 import multiprocessing
+from multiprocessing.pool import ThreadPool
 import numpy as np
 import os
 import scipy.io
@@ -31,10 +34,10 @@ import time
 
 import fyborg
 import fyborg.colortable
+import trkstream
 from fyborg.logger import Logger
 from fyborg._colors import Colors
 from fyborg._common import FNNDSCConsole as c
-from fyborg._common import FNNDSCFileIO as io
 
 class FyborgLogic:
 
@@ -122,7 +125,7 @@ bug  : \\\\   \\   :   ;    :: ;;  .' ;._..+:     ;
 
     print outro
 
-  def run( self, input, output, radius, length, stage, cortex_only, verbose ):
+  def run( self, input, output, radius, length, stage, cortex_only, verbose, jobs=1, intermediates=False ):
     '''
     '''
 
@@ -159,6 +162,7 @@ bug  : \\\\   \\   :   ;    :: ;;  .' ;._..+:     ;
                 'e2_T1_space':os.path.join( output, 'dti_e2_T1_space.nii' ),
                 'e3_T1_space':os.path.join( output, 'dti_e3_T1_space.nii' ),
                 'B0toT1matrix':os.path.join( output, 'B0-to-T1.mat' ),
+                'manifest':os.path.join( output, 'preprocessing.json' ),
                 'fibers':os.path.join( output, 'fybers_T1_space.trk' ),
                 'fibers_mapped':os.path.join( output, 'fybers_T1_space_mapped.trk' ),
                 'fibers_mapped_length_filtered':os.path.join( output, 'fybers_T1_space_mapped_length_filtered.trk' ),
@@ -195,7 +199,7 @@ bug  : \\\\   \\   :   ;    :: ;;  .' ;._..+:     ;
     c.info( Colors.YELLOW + '>> STAGE [' + Colors.PURPLE + '2' + Colors.YELLOW + ']: ' + Colors.YELLOW + ' PREPROCESSING' + Colors._CLEAR )
 
     if stage <= 2:
-      self.preprocessing( _inputs, _outputs )
+      self.preprocessing( _inputs, _outputs, jobs )
     else:
       c.info( Colors.PURPLE + '  skipping it..' + Colors._CLEAR )
 
@@ -210,7 +214,7 @@ bug  : \\\\   \\   :   ;    :: ;;  .' ;._..+:     ;
     c.info( Colors.YELLOW + '>> STAGE [' + Colors.PURPLE + '4' + Colors.YELLOW + ']: ' + Colors.YELLOW + ' FILTERING' + Colors._CLEAR )
 
     if stage <= 4:
-      self.filtering( _inputs, _outputs, length, cortex_only )
+      self.filtering( _inputs, _outputs, length, cortex_only, intermediates )
     else:
       c.info( Colors.PURPLE + '  skipping it..' + Colors._CLEAR )
 
@@ -224,7 +228,7 @@ bug  : \\\\   \\   :   ;    :: ;;  .' ;._..+:     ;
     c.info( Colors.YELLOW + '>> STAGE [' + Colors.PURPLE + '6' + Colors.YELLOW + ']: ' + Colors.YELLOW + ' ROI EXTRACTION' + Colors._CLEAR )
 
     if stage <= 6:
-      self.roi_extract( _inputs, _outputs )
+      self.roi_extract( _inputs, _outputs, jobs )
     else:
       c.info( Colors.PURPLE + '  skipping it..' + Colors._CLEAR )
 
@@ -234,69 +238,151 @@ bug  : \\\\   \\   :   ;    :: ;;  .' ;._..+:     ;
     c.info( '' )
     c.info( 'ALL DONE! SAYONARA..' )
 
-  def preprocessing( self, inputs, outputs ):
+  def preprocessing( self, inputs, outputs, jobs=1 ):
     '''
     Co-Register the input files using Flirt.
+
+    The tool environment is set up once for all commands. The DTI volumes are
+    then resampled by up to <jobs> concurrent flirt runs, skipping those whose
+    input volume and registration matrix did not change since the last run.
     '''
+    env = self.environment()
 
     # convert the T1.mgz to T1.nii
-    cmd = 'ss;'
-    cmd += 'chb-fsstable;'
-    cmd += 'mri_convert ' + inputs['T1'][-1] + ' ' + outputs['T1']
+    cmd = 'mri_convert ' + inputs['T1'][-1] + ' ' + outputs['T1']
     c.info( Colors.YELLOW + '  Converting ' + Colors.PURPLE + 'T1.mgz' + Colors.YELLOW + ' to ' + Colors.PURPLE + 'T1.nii' + Colors.YELLOW + '!' + Colors._CLEAR )
-    sp = subprocess.Popen( ["/bin/bash", "-i", "-c", cmd], stdout=sys.stdout )
-    sp.communicate()
+    self.shell( cmd, env )
 
     # convert the aparc+aseg.mgz to aparc+aseg.nii
-    cmd = 'ss;'
-    cmd += 'chb-fsstable;'
-    cmd += 'mri_convert ' + inputs['segmentation'][-1] + ' ' + outputs['segmentation']
+    cmd = 'mri_convert ' + inputs['segmentation'][-1] + ' ' + outputs['segmentation']
     c.info( Colors.YELLOW + '  Converting ' + Colors.PURPLE + 'aparc+aseg.mgz' + Colors.YELLOW + ' to ' + Colors.PURPLE + 'aparc+aseg.nii' + Colors.YELLOW + '!' + Colors._CLEAR )
-    sp = subprocess.Popen( ["/bin/bash", "-i", "-c", cmd], stdout=sys.stdout )
-    sp.communicate()
+    self.shell( cmd, env )
 
     # register B0 to T1
-    cmd = 'ss;'
-    cmd += 'chb-fsstable;'
     flirtcmd = 'flirt -in ' + inputs['b0'][-1] + ' -ref ' + outputs['T1'] + ' -usesqform -nosearch -dof 6 -cost mutualinfo -out ' + outputs['b0_T1_space'] + '.gz -omat ' + outputs['B0toT1matrix'] + ';'
-    cmd += flirtcmd
+    cmd = flirtcmd
     cmd += 'gzip -d -f ' + outputs['b0_T1_space'] + '.gz;'
     self.__logger.debug( flirtcmd )
     c.info( Colors.YELLOW + '  Registering ' + Colors.PURPLE + os.path.split( inputs['b0'][-1] )[1] + Colors.YELLOW + ' to ' + Colors.PURPLE + 'T1.nii' + Colors.YELLOW + ' and storing ' + Colors.PURPLE + os.path.split( outputs['B0toT1matrix'] )[1] + Colors.YELLOW + '!' + Colors._CLEAR )
-    sp = subprocess.Popen( ["/bin/bash", "-i", "-c", cmd], stdout=sys.stdout )
-    sp.communicate()
+    self.shell( cmd, env )
+
+    # the hashes of the inputs of previous resamplings
+    try:
+      manifest = json.load( open( outputs['manifest'] ) )
+    except ( IOError, ValueError ):
+      manifest = {}
+    matrix_hash = self.hash( outputs['B0toT1matrix'] )
 
     # resample all other DTI volumes to T1 space
+    resamplings = []
     for i in inputs:
 
       if i == 'fibers' or i == 'segmentation' or i == 'T1' or i == 'b0':
         # we do not map these
         continue
 
-      cmd = 'ss;'
-      cmd += 'chb-fsstable;'
-      flirtcmd = 'flirt -in ' + inputs[i][-1] + ' -ref ' + outputs['T1'] + ' -out ' + outputs[i + '_T1_space'] + '.gz -init ' + outputs['B0toT1matrix'] + ' -applyxfm;'
-      cmd += flirtcmd
-      cmd += 'gzip -d -f ' + outputs[i + '_T1_space'] + '.gz;'
+      output = outputs[i + '_T1_space']
+      hashes = {'input': self.hash( inputs[i][-1] ), 'matrix': matrix_hash}
+      if os.path.exists( output ) and manifest.get( os.path.split( output )[1] ) == hashes:
+        c.info( Colors.YELLOW + '  Skipping ' + Colors.PURPLE + os.path.split( output )[1] + Colors.YELLOW + ' since ' + Colors.PURPLE + os.path.split( inputs[i][-1] )[1] + Colors.YELLOW + ' and ' + Colors.PURPLE + os.path.split( outputs['B0toT1matrix'] )[1] + Colors.YELLOW + ' did not change!' + Colors._CLEAR )
+        continue
+
+      flirtcmd = 'flirt -in ' + inputs[i][-1] + ' -ref ' + outputs['T1'] + ' -out ' + output + '.gz -init ' + outputs['B0toT1matrix'] + ' -applyxfm;'
+      cmd = flirtcmd
+      cmd += 'gzip -d -f ' + output + '.gz;'
       self.__logger.debug( flirtcmd )
-      c.info( Colors.YELLOW + '  Resampling ' + Colors.PURPLE + os.path.split( inputs[i][-1] )[1] + Colors.YELLOW + ' as ' + Colors.PURPLE + os.path.split( outputs[i + '_T1_space'] )[1] + Colors.YELLOW + ' using ' + Colors.PURPLE + os.path.split( outputs['B0toT1matrix'] )[1] + Colors.YELLOW + '!' + Colors._CLEAR )
-      sp = subprocess.Popen( ["/bin/bash", "-i", "-c", cmd], stdout=sys.stdout )
-      sp.communicate()
+      c.info( Colors.YELLOW + '  Resampling ' + Colors.PURPLE + os.path.split( inputs[i][-1] )[1] + Colors.YELLOW + ' as ' + Colors.PURPLE + os.path.split( output )[1] + Colors.YELLOW + ' using ' + Colors.PURPLE + os.path.split( outputs['B0toT1matrix'] )[1] + Colors.YELLOW + '!' + Colors._CLEAR )
+      resamplings.append( ( output, hashes, cmd ) )
+
+    if resamplings:
+      # the resamplings only depend on the matrix, so they can run side by
+      # side (but interactive shells can not)
+      if not env:
+        jobs = 1
+      pool = ThreadPool( max( 1, min( int( jobs ), len( resamplings ) ) ) )
+      results = pool.map( lambda r: self.shell( r[2], env, True ), resamplings )
+      pool.close()
+      pool.join()
+
+      for ( output, hashes, cmd ), ( returncode, log ) in zip( resamplings, results ):
+        sys.stdout.write( log )
+        if returncode == 0 and os.path.exists( output ):
+          manifest[os.path.split( output )[1]] = hashes
+        else:
+          manifest.pop( os.path.split( output )[1], None )
+          c.error( Colors.RED + 'Could not resample ' + Colors.YELLOW + os.path.split( output )[1] + Colors.RED + '!' + Colors._CLEAR )
+
+      json.dump( manifest, open( outputs['manifest'], 'w' ), indent=1, sort_keys=True )
 
     # resample the fibers to T1 space
-    cmd = 'ss;'
-    cmd += 'chb-fsstable;'
     transformcmd = 'track_transform ' + inputs['fibers'][-1] + ' ' + outputs['fibers'] + ' -src ' + inputs['b0'][-1] + ' -ref ' + outputs['T1'] + ' -reg ' + outputs['B0toT1matrix'] + ';'
-    cmd += transformcmd
+    cmd = transformcmd
     self.__logger.debug( transformcmd )
     c.info( Colors.YELLOW + '  Transforming ' + Colors.PURPLE + os.path.split( inputs['fibers'][-1] )[1] + Colors.YELLOW + ' to ' + Colors.PURPLE + os.path.split( outputs['fibers'] )[1] + Colors.YELLOW + ' using ' + Colors.PURPLE + os.path.split( outputs['B0toT1matrix'] )[1] + Colors.YELLOW + '!' + Colors._CLEAR )
-    sp = subprocess.Popen( ["/bin/bash", "-i", "-c", cmd], stdout=sys.stdout )
-    sp.communicate()
+    self.shell( cmd, env )
+
+
+  def environment( self ):
+    '''
+    Set up the tool environment ('ss;chb-fsstable;') once and return its
+    variables, or None if they could not be captured.
+    '''
+    marker = '--- fyborg environment ---'
+    sp = subprocess.Popen( ["/bin/bash", "-i", "-c", "ss;chb-fsstable;echo '" + marker + "';env -0"], stdout=subprocess.PIPE )
+    out = sp.communicate()[0]
+    if sp.returncode or not marker + '\n' in out:
+      c.info( Colors.PURPLE + '  Could not capture the tool environment, setting it up for every command..' + Colors._CLEAR )
+      return None
+
+    env = {}
+    for variable in out.split( marker + '\n', 1 )[1].split( '\0' ):
+      if '=' in variable:
+        key, value = variable.split( '=', 1 )
+        env[key] = value
+    return env
+
+
+  def shell( self, cmd, env, capture=False ):
+    '''
+    Run <cmd> with the tool environment <env>, or in an interactive shell that
+    sets it up if there is none. If <capture> is set, the output is returned
+    along with the exit code instead of being written to stdout.
+    '''
+    if env:
+      args = ["/bin/bash", "-c", cmd]
+    else:
+      args = ["/bin/bash", "-i", "-c", 'ss;chb-fsstable;' + cmd]
+
+    if capture:
+      sp = subprocess.Popen( args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env )
+    else:
+      sp = subprocess.Popen( args, stdout=sys.stdout, env=env )
+    out = sp.communicate()[0]
+    return ( sp.returncode, out or '' )
+
+
+  @staticmethod
+  def hash( path ):
+    '''
+    Returns the SHA-1 of the file at <path>, or None if there is no such file.
+    '''
+    if not path or not os.path.isfile( path ):
+      return None
+
+    sha1 = hashlib.sha1()
+    f = open( path, 'rb' )
+    for block in iter( lambda: f.read( 1 << 20 ), '' ):
+      sha1.update( block )
+    f.close()
+    return sha1.hexdigest()
 
 
   def mapping( self, inputs, outputs, radius ):
     '''
     Map all detected scalar volumes to each fiber.
+
+    Unlike the later stages, this loads the whole track file, since the
+    fyborg.fyborg() driver of the actions does.
     '''
 
     # check if we have all required input data
@@ -343,9 +429,15 @@ bug  : \\\\   \\   :   ;    :: ;;  .' ;._..+:     ;
       fyborg.fyborg( outputs['fibers'], outputs['fibers_mapped'], actions )
 
 
-  def filtering( self, inputs, outputs, length, cortex_only ):
+  def filtering( self, inputs, outputs, length, cortex_only, intermediates=False ):
     '''
-    Filter the mapped fibers.
+    Filter the mapped fibers, applying all filters in a single pass. If
+    <intermediates> is set, the filters run one by one instead and the output
+    of each one is stored.
+
+    Like mapping(), each pass loads the whole track file through the
+    fyborg.fyborg() driver of the filter actions. Only the track counts are
+    read with trkstream.
     '''
 
     # check if we have all required input data
@@ -356,50 +448,108 @@ bug  : \\\\   \\   :   ;    :: ;;  .' ;._..+:     ;
       sys.exit( 2 )
 
     # find the order of the mapped scalars
-    header = io.loadTrkHeaderOnly( outputs['fibers_mapped'] )
-    scalars = list( header['scalar_name'] )
+    reader = trkstream.Reader( outputs['fibers_mapped'] )
+    scalars = list( reader.header()['scalar_name'] )
+    reader.close()
 
     # split the length range
     length = length.split( ' ' )
     min_length = int( length[0] )
     max_length = int( length[1] )
 
-    # length filtering
-
-    c.info( Colors.YELLOW + '  Filtering ' + Colors.PURPLE + 'fiber length' + Colors.YELLOW + ' to be ' + Colors.PURPLE + '>' + str( min_length ) + ' and <' + str( max_length ) + Colors.YELLOW + ' for ' + Colors.PURPLE + os.path.split( outputs['fibers_mapped'] )[1] + Colors.YELLOW + ' and store as ' + Colors.PURPLE + os.path.split( outputs['fibers_mapped_length_filtered'] )[1] + Colors.YELLOW + '!' + Colors._CLEAR )
-    fyborg.fyborg( outputs['fibers_mapped'], outputs['fibers_mapped_length_filtered'], [fyborg.FyFilterLengthAction( scalars.index( 'length' ), min_length, max_length )] )
-
-    header = io.loadTrkHeaderOnly( outputs['fibers_mapped_length_filtered'] )
-    new_count = header['n_count']
+    # the filters are applied in this order
+    filters = []
 
-    c.info( Colors.YELLOW + '  Number of tracks after ' + Colors.PURPLE + 'length filtering' + Colors.YELLOW + ': ' + str( new_count ) + Colors.YELLOW + Colors._CLEAR )
+    # length filtering
+    c.info( Colors.YELLOW + '  Configuring filtering of ' + Colors.PURPLE + 'fiber length' + Colors.YELLOW + ' to be ' + Colors.PURPLE + '>' + str( min_length ) + ' and <' + str( max_length ) + Colors.YELLOW + '!' + Colors._CLEAR )
+    filters.append( ( 'length filtering', fyborg.FyFilterLengthAction( scalars.index( 'length' ), min_length, max_length ), outputs['fibers_mapped_length_filtered'] ) )
 
     if cortex_only:
 
       # special cortex filtering
 
-      c.info( Colors.YELLOW + '  Filtering for ' + Colors.PURPLE + 'valid cortex structures' + Colors.YELLOW + ' in ' + Colors.PURPLE + os.path.split( outputs['fibers_mapped_length_filtered'] )[1] + Colors.YELLOW + ' and store as ' + Colors.PURPLE + os.path.split( outputs['fibers_mapped_length_filtered_cortex_only'] )[1] + Colors.YELLOW + '!' + Colors._CLEAR )
+      c.info( Colors.YELLOW + '  Configuring filtering for ' + Colors.PURPLE + 'valid cortex structures' + Colors.YELLOW + '!' + Colors._CLEAR )
       c.info( Colors.PURPLE + '    Conditions for valid fibers:' + Colors._CLEAR )
       c.info( Colors.PURPLE + '    1.' + Colors.YELLOW + ' The fiber track has to pass through the cerebral white matter. (Label values: ' + Colors.PURPLE + '[2, 41]' + Colors.YELLOW + ')' + Colors._CLEAR )
       c.info( Colors.PURPLE + '    2.' + Colors.YELLOW + ' The fiber track shall only touch sub-cortical structures not more than ' + Colors.PURPLE + '5 times' + Colors.YELLOW + '. (Label values: ' + Colors.PURPLE + '[10, 49, 16, 28, 60, 4, 43]' + Colors.YELLOW + ')' + Colors._CLEAR )
       c.info( Colors.PURPLE + '    3.' + Colors.YELLOW + ' The track shall not pass through the corpus callosum (Labels: ' + Colors.PURPLE + '[251, 255]' + Colors.YELLOW + ') and end in the same hemisphere (Labels: ' + Colors.PURPLE + '[1000-1035]' + Colors.YELLOW + ' for left, ' + Colors.PURPLE + '[2000-2035]' + Colors.YELLOW + ' for right).' + Colors._CLEAR )
+      filters.append( ( 'cortex filtering', fyborg.FyFilterCortexAction( scalars.index( 'segmentation' ) ), outputs['fibers_mapped_length_filtered_cortex_only'] ) )
 
-      fyborg.fyborg( outputs['fibers_mapped_length_filtered'], outputs['fibers_mapped_length_filtered_cortex_only'], [fyborg.FyFilterCortexAction( scalars.index( 'segmentation' ) )] )
+    else:
 
-      header = io.loadTrkHeaderOnly( outputs['fibers_mapped_length_filtered_cortex_only'] )
-      new_count = header['n_count']
+      c.info( Colors.YELLOW + '  Info: ' + Colors.PURPLE + 'Cortical _and_ sub-cortical structures ' + Colors.YELLOW + 'will be included..' + Colors._CLEAR )
+
+    count = self.track_count( outputs['fibers_mapped'] )
+
+    if intermediates:
 
-      c.info( Colors.YELLOW + '  Number of tracks after ' + Colors.PURPLE + 'cortex filtering' + Colors.YELLOW + ': ' + str( new_count ) + Colors.YELLOW + Colors._CLEAR )
+      # one pass per filter, storing the tracks after each one
+      trk_inputfile = outputs['fibers_mapped']
+      for name, action, trk_outputfile in filters:
+        c.info( Colors.YELLOW + '  Performing ' + Colors.PURPLE + name + Colors.YELLOW + ' for ' + Colors.PURPLE + os.path.split( trk_inputfile )[1] + Colors.YELLOW + ' and storing as ' + Colors.PURPLE + os.path.split( trk_outputfile )[1] + Colors.YELLOW + '!' + Colors._CLEAR )
+        fyborg.fyborg( trk_inputfile, trk_outputfile, [action] )
 
-      c.info( Colors.YELLOW + '  Copied filtered tracks from ' + Colors.PURPLE + os.path.split( outputs['fibers_mapped_length_filtered_cortex_only'] )[1] + Colors.YELLOW + ' to ' + Colors.PURPLE + os.path.split( outputs['fibers_final'] )[1] + Colors.YELLOW + '!' + Colors._CLEAR )
-      shutil.copyfile( outputs['fibers_mapped_length_filtered_cortex_only'], outputs['fibers_final'] )
+        new_count = self.track_count( trk_outputfile )
+        c.info( Colors.YELLOW + '  Number of tracks rejected by ' + Colors.PURPLE + name + Colors.YELLOW + ': ' + str( count - new_count ) + Colors._CLEAR )
+        count = new_count
+        trk_inputfile = trk_outputfile
+
+      c.info( Colors.YELLOW + '  Copied filtered tracks from ' + Colors.PURPLE + os.path.split( trk_inputfile )[1] + Colors.YELLOW + ' to ' + Colors.PURPLE + os.path.split( outputs['fibers_final'] )[1] + Colors.YELLOW + '!' + Colors._CLEAR )
+      shutil.copyfile( trk_inputfile, outputs['fibers_final'] )
 
     else:
 
-      c.info( Colors.YELLOW + '  Info: ' + Colors.PURPLE + 'Cortical _and_ sub-cortical structures ' + Colors.YELLOW + 'will be included..' + Colors._CLEAR )
+      # a single pass through all the filters, storing only the final tracks,
+      # while each filter counts the tracks it rejects
+      counters = [self.rejection_counter( f[1] ) for f in filters]
+      c.info( Colors.YELLOW + '  Performing ' + Colors.PURPLE + ', '.join( [f[0] for f in filters] ) + Colors.YELLOW + ' for ' + Colors.PURPLE + os.path.split( outputs['fibers_mapped'] )[1] + Colors.YELLOW + ' and storing as ' + Colors.PURPLE + os.path.split( outputs['fibers_final'] )[1] + Colors.YELLOW + '!' + Colors._CLEAR )
+      fyborg.fyborg( outputs['fibers_mapped'], outputs['fibers_final'], [f[1] for f in filters] )
+
+      new_count = self.track_count( outputs['fibers_final'] )
+      rejected = count - new_count
+      for name, counter in zip( [f[0] for f in filters], counters ):
+        c.info( Colors.YELLOW + '  Number of tracks rejected by ' + Colors.PURPLE + name + Colors.YELLOW + ': ' + str( counter[0] ) + Colors._CLEAR )
+      c.info( Colors.YELLOW + '  Number of tracks rejected by ' + Colors.PURPLE + 'all filters' + Colors.YELLOW + ': ' + str( rejected ) + Colors._CLEAR )
+
+      # the stored tracks have to pass every filter, so at least as many tracks
+      # were rejected in total as by any single filter, and at most their sum
+      if rejected < max( [counter[0] for counter in counters] ):
+        c.error( Colors.RED + 'Tracks rejected by a filter were stored in ' + Colors.YELLOW + outputs['fibers_final'] + Colors.RED + '! The filters were not all applied.' + Colors._CLEAR )
+        sys.exit( 2 )
+      if rejected > sum( [counter[0] for counter in counters] ):
+        c.info( Colors.YELLOW + '  Warning: ' + Colors.PURPLE + 'the counts of each filter are incomplete' + Colors.YELLOW + ' (use --intermediates to count each filter in its own pass)' + Colors._CLEAR )
+      count = new_count
+
+    c.info( Colors.YELLOW + '  Number of tracks after ' + Colors.PURPLE + 'filtering' + Colors.YELLOW + ': ' + str( count ) + Colors._CLEAR )
+
 
-      c.info( Colors.YELLOW + '  Copied filtered tracks from ' + Colors.PURPLE + os.path.split( outputs['fibers_mapped_length_filtered'] )[1] + Colors.YELLOW + ' to ' + Colors.PURPLE + os.path.split( outputs['fibers_final'] )[1] + Colors.YELLOW + '!' + Colors._CLEAR )
-      shutil.copyfile( outputs['fibers_mapped_length_filtered'], outputs['fibers_final'] )
+  @staticmethod
+  def rejection_counter( action ):
+    '''
+    Count the tracks that the fyborg filter <action> rejects, by wrapping its
+    validate() method in place (so that the action keeps its type). Returns a
+    one element list that holds the count.
+    '''
+    counter = [0]
+    validate = action.validate
+    def counting_validate( *args, **kwargs ):
+      valid = validate( *args, **kwargs )
+      if not valid:
+        counter[0] += 1
+      return valid
+    action.validate = counting_validate
+    return counter
+
+
+  @staticmethod
+  def track_count( path ):
+    '''
+    Returns the number of tracks in the header of the .trk file at <path>.
+    '''
+    reader = trkstream.Reader( path )
+    count = reader.count()
+    reader.close()
+    return count
 
 
 
@@ -414,9 +564,8 @@ bug  : \\\\   \\   :   ;    :: ;;  .' ;._..+:     ;
       c.error( Colors.RED + 'Could not find ' + Colors.YELLOW + outputs['fibers_final'] + Colors.RED + ' but we really need it to start with stage 5!!' + Colors._CLEAR )
       sys.exit( 2 )
 
-    s = io.loadTrk( outputs['fibers_final'] )
-    tracks = s[0]
-    header = s[1]
+    reader = trkstream.Reader( outputs['fibers_final'] )
+    header = reader.header()
 
     scalarNames = header['scalar_name'].tolist()
     matrix = {}
@@ -464,40 +613,16 @@ bug  : \\\\   \\   :   ;    :: ;;  .' ;._..+:     ;
     c.info( Colors.YELLOW + '  Preparing matrix (' + Colors.PURPLE + '[' + str( len( labels ) ) + 'x' + str( len( labels ) ) + ']' + Colors.YELLOW + ') for ' + Colors.PURPLE + 'fibercount' + Colors.YELLOW + ' values!' + Colors._CLEAR )
 
     c.info( Colors.YELLOW + '  Analyzing fibers of ' + Colors.PURPLE + os.path.split( outputs['fibers_final'] )[1] + Colors.YELLOW + '..' + Colors._CLEAR )
-    for tCounter, t in enumerate( tracks ):
-
-      tCoordinates = t[0]
-      tScalars = t[1]
-
-      # find the segmentation labels for the start and end points
-      start_label = tScalars[0, indices['segmentation']]
-      end_label = tScalars[-1, indices['segmentation']]
-
-      try:
-        # now grab the index of the labels in our label list
-        start_index = labels.index( start_label )
-        end_index = labels.index( end_label )
-      except:
-        # this label is not monitored, so ignore this track
-        continue
-
-      # loop through all different scalars
-      for m in matrix:
-
-        # calculate the mean for each track
-        value = np.mean( tScalars[:, indices[m]] )
-
-        if m == 'inv_adc':
-          # invert the value since it is 1-ADC
-          value = 1 / value
-        elif m == 'fibercount':
-          # in the case of fibercount, add 1
-          value = 1
-
-        # store value in the matrix
-        matrix[m][start_index, end_index] += value
-        if not start_index == end_index:
-          matrix[m][end_index, start_index] += value
+    # the mean of the mapped scalars of each track is added to the matrix
+    # elements of its start and end labels (the fibercount adds 1), reading
+    # the tracks chunk by chunk
+    names = matrix.keys()
+    matrix = None
+    for tracks in reader.chunks():
+      matrix = self.connectivity_matrices( tracks, labels, indices, names, matrix )
+    reader.close()
+    if matrix is None:
+      matrix = self.connectivity_matrices( [], labels, indices, names )
 
     # fiber loop is done, all values are stored
     # now normalize the matrices
@@ -534,8 +659,114 @@ bug  : \\\\   \\   :   ;    :: ;;  .' ;._..+:     ;
     scipy.io.savemat( outputs['matrix_all'], matrix, oned_as='row' )
 
 
-  def roi_extract( self, inputs, outputs ):
+  @staticmethod
+  def connectivity_matrices( tracks, labels, indices, names, matrix=None, chunk=10000 ):
     '''
+    Accumulate the connectivity matrices <names> for all <tracks> at once.
+
+    <indices> maps every matrix name to the column of its scalar, and
+    'segmentation' to the column of the segmentation labels. Tracks whose
+    endpoint labels are not among <labels> are ignored. Returns the (not yet
+    normalized) matrices, exactly as if they were summed up track by track:
+    the per-track means are reduced in the same order as np.mean() does and
+    the values are added to each matrix element in track order.
+
+    If <matrix> is given, i.e. the matrices of the previous chunk of tracks,
+    the values are added to it (in place) in the same order.
+    '''
+    n_labels = len( labels )
+
+    # label value -> matrix index (or -1 if the label is not monitored)
+    table = np.empty( max( labels ) + 1, dtype=np.int64 )
+    table.fill( -1 )
+    for i in reversed( range( n_labels ) ):
+      table[labels[i]] = i
+
+    seg_column = indices['segmentation']
+    columns = sorted( set( [indices[m] for m in names if m != 'fibercount'] ) )
+
+    n_tracks = len( tracks )
+    lengths = np.array( [len( t[1] ) for t in tracks], dtype=np.int64 )
+    start_label = np.zeros( n_tracks )
+    end_label = np.zeros( n_tracks )
+    means = {}
+    for column in columns:
+      means[column] = None
+
+    # group the tracks by their number of points: the scalars of each group
+    # then stack into a (tracks x points) array, and every row is reduced
+    # exactly like np.mean() reduces the scalars of a single track
+    order = np.argsort( lengths, kind='mergesort' )
+    boundaries = np.flatnonzero( np.diff( lengths[order] ) ) + 1
+    for group in np.split( order, boundaries ):
+      if not len( group ) or not lengths[group[0]]:
+        continue
+      for first in range( 0, len( group ), chunk ):
+        members = group[first:first + chunk]
+        points = np.array( [tracks[i][1] for i in members] )
+        start_label[members] = points[:, 0, seg_column]
+        end_label[members] = points[:, -1, seg_column]
+        for column in columns:
+          values = np.ascontiguousarray( points[:, :, column] )
+          sums = np.add.reduce( values, axis=1 )
+          if means[column] is None:
+            means[column] = np.zeros( n_tracks, dtype=sums.dtype )
+          means[column][members] = ( sums / np.float64( lengths[group[0]] ) ).astype( sums.dtype )
+
+    # map the endpoint labels to matrix indices
+    def label_index( values ):
+      index = np.empty( len( values ), dtype=np.int64 )
+      index.fill( -1 )
+      valid = ( values >= 0 ) & ( values < len( table ) ) & ( values == np.floor( values ) )
+      index[valid] = table[values[valid].astype( np.int64 )]
+      return index
+
+    start_index = label_index( start_label )
+    end_index = label_index( end_label )
+    kept = np.flatnonzero( ( start_index >= 0 ) & ( end_index >= 0 ) & ( lengths > 0 ) )
+    start_index = start_index[kept]
+    end_index = end_index[kept]
+
+    # every track adds to [start, end] and, off the diagonal, to [end, start]:
+    # interleave both in track order so that each element sums in that order
+    mirrored = start_index != end_index
+    position = np.arange( len( kept ) ) + np.concatenate( ( [0], np.cumsum( mirrored )[:-1] ) ).astype( np.int64 )
+    cells = np.empty( len( kept ) + mirrored.sum(), dtype=np.int64 )
+    cells[position] = start_index * n_labels + end_index
+    cells[position[mirrored] + 1] = ( end_index * n_labels + start_index )[mirrored]
+
+    if matrix is None:
+      matrix = {}
+      previous = False
+    else:
+      previous = True
+    for m in names:
+      if m == 'fibercount':
+        value = np.ones( len( kept ) )
+      else:
+        value = means[indices[m]]
+        if value is None:
+          value = np.zeros( n_tracks, dtype=np.float32 )
+        value = value[kept]
+        if m == 'inv_adc':
+          # invert the value since it is 1-ADC
+          value = 1 / value
+      weights = np.empty( len( cells ) )
+      weights[position] = value
+      weights[position[mirrored] + 1] = value[mirrored]
+      if previous:
+        # unlike np.bincount(), np.add.at() adds to the existing sums
+        np.add.at( matrix[m].reshape( -1 ), cells, weights )
+      else:
+        matrix[m] = np.bincount( cells, weights=weights, minlength=n_labels * n_labels ).reshape( n_labels, n_labels ).astype( np.float64 )
+
+    return matrix
+
+
+  def roi_extract( self, inputs, outputs, jobs=1 ):
+    '''
+    Extract a .trk file and a label volume for every label the fibers pass
+    through, using up to <jobs> parallel processes.
     '''
     # check if we have all required input data
     # we need at least: 
@@ -544,12 +775,10 @@ bug  : \\\\   \\   :   ;    :: ;;  .' ;._..+:     ;
       c.error( Colors.RED + 'Could not find ' + Colors.YELLOW + outputs['fibers_final'] + Colors.RED + ' but we really need it to start with stage 6!!' + Colors._CLEAR )
       sys.exit( 2 )
 
-    s = io.loadTrk( outputs['fibers_final'] )
-    tracks = s[0]
-    header = s[1]
+    reader = trkstream.Reader( outputs['fibers_final'] )
+    header = reader.header()
 
     scalarNames = header['scalar_name'].tolist()
-    labels = {}
 
     # check if the segmentation is mapped
     try:
@@ -574,42 +803,113 @@ bug  : \\\\   \\   :   ;    :: ;;  .' ;._..+:     ;
       colors[splitted_line[0]] = splitted_line[1]
 
 
-    # loop through tracks
-    for i, t in enumerate( tracks ):
-
-      tCoordinates = t[0]
-      tScalars = t[1]
-
-      # grab the scalars for each point
-      for scalar in tScalars:
-
-        # but only the label value
-        label_value = str( int( scalar[seg_index] ) )
-
-        if not label_value in labels:
-
-          labels[label_value] = []
+    # index the tracks by the labels they pass through
+    index = self.roi_index( reader.chunks(), seg_index )
+    reader.close()
+    c.info( Colors.YELLOW + '  Found ' + Colors.PURPLE + str( len( index[0] ) ) + Colors.YELLOW + ' labels along ' + Colors.PURPLE + str( index[3] ) + Colors.YELLOW + ' tracks!' + Colors._CLEAR )
+
+    # now write the rois of all detected labels, spread over the jobs
+    rois = []
+    for n, l in enumerate( index[0] ):
+      l = str( l )
+      rois.append( ( l, l + '_' + colors[l] + '.trk', l + '_' + colors[l] + '.nii', index[2][index[1][n]:index[1][n + 1]] ) )
+
+    jobs = max( 1, min( int( jobs ), len( rois ) ) )
+    if jobs == 1:
+      self.roi_write( outputs['fibers_final'], header, rois, outputs )
+      return
+
+    workers = []
+    for n in xrange( jobs ):
+      # every worker streams the tracks for its own labels
+      p = multiprocessing.Process( target=self.roi_write, args=( outputs['fibers_final'], header, rois[n::jobs], outputs ) )
+      p.start()
+      workers.append( p )
+
+    failed = 0
+    for p in workers:
+      p.join()
+      if p.exitcode:
+        failed += 1
+
+    if failed:
+      c.error( Colors.RED + 'The ROI extraction failed in ' + Colors.YELLOW + str( failed ) + Colors.RED + ' of ' + str( jobs ) + ' jobs!' + Colors._CLEAR )
+      sys.exit( 2 )
 
-        if not i in labels[label_value]:
-          # store the unique fiber id for this label
-          labels[label_value].append( i )
 
-    # now loop through all detected labels
-    for l in labels:
+  @staticmethod
+  def roi_index( chunks, seg_index ):
+    '''
+    Build an inverted index of the label values along the tracks, which are
+    given as <chunks>, i.e. lists of tracks (see trkstream.Reader.chunks()).
 
-      new_tracks = []
+    Returns ( labels, offsets, ids, count ) with the index in compressed sparse
+    row form: the ids of the tracks passing through labels[n] are
+    ids[offsets[n]:offsets[n + 1]], in ascending order and each listed once.
+    The ids number the tracks across all chunks, <count> is their total.
+    '''
+    all_values = []
+    all_ids = []
+    first_id = 0
+    for tracks in chunks:
+
+      lengths = np.array( [len( t[1] ) for t in tracks], dtype=np.int64 )
+      if lengths.sum():
+        # the label value (truncated like int()) and the track id of every point
+        values = np.concatenate( [np.asarray( t[1] )[:, seg_index] for t in tracks if len( t[1] )] ).astype( np.int64 )
+        ids = np.repeat( np.arange( first_id, first_id + len( tracks ), dtype=np.int64 ), lengths )
+
+        # sort by label, then by track, and drop repeated ( label, track ) pairs
+        order = np.lexsort( ( ids, values ) )
+        values = values[order]
+        ids = ids[order]
+        unique = np.ones( len( values ), dtype=bool )
+        unique[1:] = ( values[1:] != values[:-1] ) | ( ids[1:] != ids[:-1] )
+        all_values.append( values[unique] )
+        all_ids.append( ids[unique] )
+
+      first_id += len( tracks )
+
+    if not all_values:
+      return ( np.zeros( 0, dtype=np.int64 ), np.zeros( 1, dtype=np.int64 ), np.zeros( 0, dtype=np.int64 ), first_id )
+
+    # a track lies within a single chunk, so the pairs are unique already
+    values = np.concatenate( all_values )
+    ids = np.concatenate( all_ids )
+    order = np.lexsort( ( ids, values ) )
+    values = values[order]
+    ids = ids[order]
+
+    first = np.flatnonzero( np.concatenate( ( [True], values[1:] != values[:-1] ) ) )
+    offsets = np.append( first, len( values ) )
+    return ( values[first], offsets, ids, first_id )
+
+
+  def roi_write( self, path, header, rois, outputs ):
+    '''
+    Write the .trk file and the label volume of each of the <rois>, given as
+    ( label, trk file, nii file, track ids ), streaming the tracks from <path>.
+    '''
+    writers = []
+    for l, trk_outputfile, nii_outputfile, ids in rois:
+      c.info( Colors.YELLOW + '  Creating fiber ROI ' + Colors.PURPLE + trk_outputfile + Colors.YELLOW + '!' + Colors._CLEAR )
+      writers.append( trkstream.Writer( os.path.join( outputs['roi'], trk_outputfile ), header ) )
 
-      for t_id in labels[l]:
-        # grab the fiber + scalars
-        current_fiber = tracks[t_id]
+    # pass the tracks of each chunk on to the files of their labels
+    reader = trkstream.Reader( path )
+    first_id = 0
+    for tracks in reader.chunks():
+      last_id = first_id + len( tracks )
+      for ( l, trk_outputfile, nii_outputfile, ids ), writer in zip( rois, writers ):
+        ids = ids[np.searchsorted( ids, first_id ):np.searchsorted( ids, last_id )]
+        writer.write( [tracks[t_id - first_id] for t_id in ids] )
+      first_id = last_id
+    reader.close()
 
-        new_tracks.append( current_fiber )
+    for writer in writers:
+      writer.close()
 
-      # now store the trk file
-      trk_outputfile = l + '_' + colors[l] + '.trk'
-      nii_outputfile = l + '_' + colors[l] + '.nii'
-      c.info( Colors.YELLOW + '  Creating fiber ROI ' + Colors.PURPLE + trk_outputfile + Colors.YELLOW + '!' + Colors._CLEAR )
-      io.saveTrk( os.path.join( outputs['roi'], trk_outputfile ), new_tracks, header, None, True )
+    for l, trk_outputfile, nii_outputfile, ids in rois:
 
       # also create a roi label volume for this label value
       c.info( Colors.YELLOW + '  Creating NII ROI ' + Colors.PURPLE + nii_outputfile + Colors.YELLOW + '!' + Colors._CLEAR )
@@ -678,7 +978,9 @@ if __name__ == "__main__":
   parser.add_argument( '-co', '--cortex_only', action='store_true', dest='cortex_only', help='Perform filtering for cortex specific analysis and skip sub-cortical structures.' )
   parser.add_argument( '-s', '--stage', action='store', dest='stage', default=0, type=int, help='Start with a specific stage while skipping the ones before. E.g. --stage 3 directly starts the mapping without preprocessing, --stage 4 starts with the filtering' )
   parser.add_argument( '-overwrite', '--overwrite', action='store_true', dest='overwrite', help='Overwrite any existing output. DANGER!!' )
+  parser.add_argument( '-im', '--intermediates', action='store_true', dest='intermediates', help='Run the filters one by one and store the tracks after each. DEFAULT: off, i.e. a single pass' )
   parser.add_argument( '-v', '--verbose', action='store_true', dest='verbose', help='Show verbose output' )
+  parser.add_argument( '-j', '--jobs', action='store', dest='jobs', default=multiprocessing.cpu_count(), type=int, help='The number of parallel processes for the resampling and the ROI extraction. E.g. --jobs 4, DEFAULT: the number of CPUs' )
 
   # always show the help if no arguments were specified
   if len( sys.argv ) == 1:
@@ -710,4 +1012,4 @@ if __name__ == "__main__":
 
 
   logic = FyborgLogic()
-  logic.run( options.input, options.output, options.radius, options.length, int( options.stage ), options.cortex_only, options.verbose )
+  logic.run( options.input, options.output, options.radius, options.length, int( options.stage ), options.cortex_only, options.verbose, options.jobs, options.intermediates )
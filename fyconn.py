@@ -31,10 +31,10 @@ import time
 
 import fyborg
 import fyborg.colortable
+import trkstream
 from fyborg.logger import Logger
 from fyborg._colors import Colors
 from fyborg._common import FNNDSCConsole as c
-from fyborg._common import FNNDSCFileIO as io
 
 class FyborgLogic:
 
@@ -122,7 +122,7 @@ bug  : \\\\   \\   :   ;    :: ;;  .' ;._..+:     ;
 
     print outro
 
-  def run( self, input, output, radius, length, stage, cortex_only, verbose ):
+  def run( self, input, output, radius, length, stage, cortex_only, verbose, jobs=1, intermediates=False ):
     '''
     '''
 
@@ -213,7 +213,7 @@ bug  : \\\\   \\   :   ;    :: ;;  .' ;._..+:     ;
     c.info( Colors.YELLOW + '>> STAGE [' + Colors.PURPLE + '4' + Colors.YELLOW + ']: ' + Colors.YELLOW + ' FILTERING' + Colors._CLEAR )
 
     if stage <= 4:
-      self.filtering( _inputs, _outputs, length, cortex_only )
+      self.filtering( _inputs, _outputs, length, cortex_only, intermediates )
     else:
       c.info( Colors.PURPLE + '  skipping it..' + Colors._CLEAR )
 
@@ -227,7 +227,7 @@ bug  : \\\\   \\   :   ;    :: ;;  .' ;._..+:     ;
     c.info( Colors.YELLOW + '>> STAGE [' + Colors.PURPLE + '6' + Colors.YELLOW + ']: ' + Colors.YELLOW + ' ROI EXTRACTION' + Colors._CLEAR )
 
     if stage <= 6:
-      self.roi_extract( _inputs, _outputs )
+      self.roi_extract( _inputs, _outputs, jobs )
     else:
       c.info( Colors.PURPLE + '  skipping it..' + Colors._CLEAR )
 
@@ -310,6 +310,9 @@ bug  : \\\\   \\   :   ;    :: ;;  .' ;._..+:     ;
   def mapping( self, inputs, outputs, radius ):
     '''
     Map all detected scalar volumes to each fiber.
+
+    Unlike the later stages, this loads the whole track file, since the
+    fyborg.fyborg() driver of the actions does.
     '''
 
     # check if we have all required input data
@@ -356,9 +359,15 @@ bug  : \\\\   \\   :   ;    :: ;;  .' ;._..+:     ;
       fyborg.fyborg( outputs['fibers'], outputs['fibers_mapped'], actions )
 
 
-  def filtering( self, inputs, outputs, length, cortex_only ):
+  def filtering( self, inputs, outputs, length, cortex_only, intermediates=False ):
     '''
-    Filter the mapped fibers.
+    Filter the mapped fibers, applying all filters in a single pass. If
+    <intermediates> is set, the filters run one by one instead and the output
+    of each one is stored.
+
+    Like mapping(), each pass loads the whole track file through the
+    fyborg.fyborg() driver of the filter actions. Only the track counts are
+    read with trkstream.
     '''
 
     # check if we have all required input data
@@ -369,50 +378,108 @@ bug  : \\\\   \\   :   ;    :: ;;  .' ;._..+:     ;
       sys.exit( 2 )
 
     # find the order of the mapped scalars
-    header = io.loadTrkHeaderOnly( outputs['fibers_mapped'] )
-    scalars = list( header['scalar_name'] )
+    reader = trkstream.Reader( outputs['fibers_mapped'] )
+    scalars = list( reader.header()['scalar_name'] )
+    reader.close()
 
     # split the length range
     length = length.split( ' ' )
     min_length = int( length[0] )
     max_length = int( length[1] )
 
-    # length filtering
-
-    c.info( Colors.YELLOW + '  Filtering ' + Colors.PURPLE + 'fiber length' + Colors.YELLOW + ' to be ' + Colors.PURPLE + '>' + str( min_length ) + ' and <' + str( max_length ) + Colors.YELLOW + ' for ' + Colors.PURPLE + os.path.split( outputs['fibers_mapped'] )[1] + Colors.YELLOW + ' and store as ' + Colors.PURPLE + os.path.split( outputs['fibers_mapped_length_filtered'] )[1] + Colors.YELLOW + '!' + Colors._CLEAR )
-    fyborg.fyborg( outputs['fibers_mapped'], outputs['fibers_mapped_length_filtered'], [fyborg.FyFilterLengthAction( scalars.index( 'length' ), min_length, max_length )] )
+    # the filters are applied in this order
+    filters = []
 
-    header = io.loadTrkHeaderOnly( outputs['fibers_mapped_length_filtered'] )
-    new_count = header['n_count']
-
-    c.info( Colors.YELLOW + '  Number of tracks after ' + Colors.PURPLE + 'length filtering' + Colors.YELLOW + ': ' + str( new_count ) + Colors.YELLOW + Colors._CLEAR )
+    # length filtering
+    c.info( Colors.YELLOW + '  Configuring filtering of ' + Colors.PURPLE + 'fiber length' + Colors.YELLOW + ' to be ' + Colors.PURPLE + '>' + str( min_length ) + ' and <' + str( max_length ) + Colors.YELLOW + '!' + Colors._CLEAR )
+    filters.append( ( 'length filtering', fyborg.FyFilterLengthAction( scalars.index( 'length' ), min_length, max_length ), outputs['fibers_mapped_length_filtered'] ) )
 
     if cortex_only:
 
       # special cortex filtering
 
-      c.info( Colors.YELLOW + '  Filtering for ' + Colors.PURPLE + 'valid cortex structures' + Colors.YELLOW + ' in ' + Colors.PURPLE + os.path.split( outputs['fibers_mapped_length_filtered'] )[1] + Colors.YELLOW + ' and store as ' + Colors.PURPLE + os.path.split( outputs['fibers_mapped_length_filtered_cortex_only'] )[1] + Colors.YELLOW + '!' + Colors._CLEAR )
+      c.info( Colors.YELLOW + '  Configuring filtering for ' + Colors.PURPLE + 'valid cortex structures' + Colors.YELLOW + '!' + Colors._CLEAR )
       c.info( Colors.PURPLE + '    Conditions for valid fibers:' + Colors._CLEAR )
       c.info( Colors.PURPLE + '    1.' + Colors.YELLOW + ' The fiber track has to pass through the cerebral white matter. (Label values: ' + Colors.PURPLE + '[2, 41]' + Colors.YELLOW + ')' + Colors._CLEAR )
       c.info( Colors.PURPLE + '    2.' + Colors.YELLOW + ' The fiber track shall only touch sub-cortical structures not more than ' + Colors.PURPLE + '5 times' + Colors.YELLOW + '. (Label values: ' + Colors.PURPLE + '[10, 49, 16, 28, 60, 4, 43]' + Colors.YELLOW + ')' + Colors._CLEAR )
       c.info( Colors.PURPLE + '    3.' + Colors.YELLOW + ' The track shall not pass through the corpus callosum (Labels: ' + Colors.PURPLE + '[251, 255]' + Colors.YELLOW + ') and end in the same hemisphere (Labels: ' + Colors.PURPLE + '[1000-1035]' + Colors.YELLOW + ' for left, ' + Colors.PURPLE + '[2000-2035]' + Colors.YELLOW + ' for right).' + Colors._CLEAR )
+      filters.append( ( 'cortex filtering', fyborg.FyFilterCortexAction( scalars.index( 'segmentation' ) ), outputs['fibers_mapped_length_filtered_cortex_only'] ) )
+
+    else:
+
+      c.info( Colors.YELLOW + '  Info: ' + Colors.PURPLE + 'Cortical _and_ sub-cortical structures ' + Colors.YELLOW + 'will be included..' + Colors._CLEAR )
+
+    count = self.track_count( outputs['fibers_mapped'] )
 
-      fyborg.fyborg( outputs['fibers_mapped_length_filtered'], outputs['fibers_mapped_length_filtered_cortex_only'], [fyborg.FyFilterCortexAction( scalars.index( 'segmentation' ) )] )
+    if intermediates:
 
-      header = io.loadTrkHeaderOnly( outputs['fibers_mapped_length_filtered_cortex_only'] )
-      new_count = header['n_count']
+      # one pass per filter, storing the tracks after each one
+      trk_inputfile = outputs['fibers_mapped']
+      for name, action, trk_outputfile in filters:
+        c.info( Colors.YELLOW + '  Performing ' + Colors.PURPLE + name + Colors.YELLOW + ' for ' + Colors.PURPLE + os.path.split( trk_inputfile )[1] + Colors.YELLOW + ' and storing as ' + Colors.PURPLE + os.path.split( trk_outputfile )[1] + Colors.YELLOW + '!' + Colors._CLEAR )
+        fyborg.fyborg( trk_inputfile, trk_outputfile, [action] )
 
-      c.info( Colors.YELLOW + '  Number of tracks after ' + Colors.PURPLE + 'cortex filtering' + Colors.YELLOW + ': ' + str( new_count ) + Colors.YELLOW + Colors._CLEAR )
+        new_count = self.track_count( trk_outputfile )
+        c.info( Colors.YELLOW + '  Number of tracks rejected by ' + Colors.PURPLE + name + Colors.YELLOW + ': ' + str( count - new_count ) + Colors._CLEAR )
+        count = new_count
+        trk_inputfile = trk_outputfile
 
-      c.info( Colors.YELLOW + '  Copied filtered tracks from ' + Colors.PURPLE + os.path.split( outputs['fibers_mapped_length_filtered_cortex_only'] )[1] + Colors.YELLOW + ' to ' + Colors.PURPLE + os.path.split( outputs['fibers_final'] )[1] + Colors.YELLOW + '!' + Colors._CLEAR )
-      shutil.copyfile( outputs['fibers_mapped_length_filtered_cortex_only'], outputs['fibers_final'] )
+      c.info( Colors.YELLOW + '  Copied filtered tracks from ' + Colors.PURPLE + os.path.split( trk_inputfile )[1] + Colors.YELLOW + ' to ' + Colors.PURPLE + os.path.split( outputs['fibers_final'] )[1] + Colors.YELLOW + '!' + Colors._CLEAR )
+      shutil.copyfile( trk_inputfile, outputs['fibers_final'] )
 
     else:
 
-      c.info( Colors.YELLOW + '  Info: ' + Colors.PURPLE + 'Cortical _and_ sub-cortical structures ' + Colors.YELLOW + 'will be included..' + Colors._CLEAR )
+      # a single pass through all the filters, storing only the final tracks,
+      # while each filter counts the tracks it rejects
+      counters = [self.rejection_counter( f[1] ) for f in filters]
+      c.info( Colors.YELLOW + '  Performing ' + Colors.PURPLE + ', '.join( [f[0] for f in filters] ) + Colors.YELLOW + ' for ' + Colors.PURPLE + os.path.split( outputs['fibers_mapped'] )[1] + Colors.YELLOW + ' and storing as ' + Colors.PURPLE + os.path.split( outputs['fibers_final'] )[1] + Colors.YELLOW + '!' + Colors._CLEAR )
+      fyborg.fyborg( outputs['fibers_mapped'], outputs['fibers_final'], [f[1] for f in filters] )
+
+      new_count = self.track_count( outputs['fibers_final'] )
+      rejected = count - new_count
+      for name, counter in zip( [f[0] for f in filters], counters ):
+        c.info( Colors.YELLOW + '  Number of tracks rejected by ' + Colors.PURPLE + name + Colors.YELLOW + ': ' + str( counter[0] ) + Colors._CLEAR )
+      c.info( Colors.YELLOW + '  Number of tracks rejected by ' + Colors.PURPLE + 'all filters' + Colors.YELLOW + ': ' + str( rejected ) + Colors._CLEAR )
+
+      # the stored tracks have to pass every filter, so at least as many tracks
+      # were rejected in total as by any single filter, and at most their sum
+      if rejected < max( [counter[0] for counter in counters] ):
+        c.error( Colors.RED + 'Tracks rejected by a filter were stored in ' + Colors.YELLOW + outputs['fibers_final'] + Colors.RED + '! The filters were not all applied.' + Colors._CLEAR )
+        sys.exit( 2 )
+      if rejected > sum( [counter[0] for counter in counters] ):
+        c.info( Colors.YELLOW + '  Warning: ' + Colors.PURPLE + 'the counts of each filter are incomplete' + Colors.YELLOW + ' (use --intermediates to count each filter in its own pass)' + Colors._CLEAR )
+      count = new_count
 
-      c.info( Colors.YELLOW + '  Copied filtered tracks from ' + Colors.PURPLE + os.path.split( outputs['fibers_mapped_length_filtered'] )[1] + Colors.YELLOW + ' to ' + Colors.PURPLE + os.path.split( outputs['fibers_final'] )[1] + Colors.YELLOW + '!' + Colors._CLEAR )
-      shutil.copyfile( outputs['fibers_mapped_length_filtered'], outputs['fibers_final'] )
+    c.info( Colors.YELLOW + '  Number of tracks after ' + Colors.PURPLE + 'filtering' + Colors.YELLOW + ': ' + str( count ) + Colors._CLEAR )
+
+
+  @staticmethod
+  def rejection_counter( action ):
+    '''
+    Count the tracks that the fyborg filter <action> rejects, by wrapping its
+    validate() method in place (so that the action keeps its type). Returns a
+    one element list that holds the count.
+    '''
+    counter = [0]
+    validate = action.validate
+    def counting_validate( *args, **kwargs ):
+      valid = validate( *args, **kwargs )
+      if not valid:
+        counter[0] += 1
+      return valid
+    action.validate = counting_validate
+    return counter
+
+
+  @staticmethod
+  def track_count( path ):
+    '''
+    Returns the number of tracks in the header of the .trk file at <path>.
+    '''
+    reader = trkstream.Reader( path )
+    count = reader.count()
+    reader.close()
+    return count
 
 
 
@@ -427,9 +494,8 @@ bug  : \\\\   \\   :   ;    :: ;;  .' ;._..+:     ;
       c.error( Colors.RED + 'Could not find ' + Colors.YELLOW + outputs['fibers_final'] + Colors.RED + ' but we really need it to start with stage 5!!' + Colors._CLEAR )
       sys.exit( 2 )
 
-    s = io.loadTrk( outputs['fibers_final'] )
-    tracks = s[0]
-    header = s[1]
+    reader = trkstream.Reader( outputs['fibers_final'] )
+    header = reader.header()
 
     scalarNames = header['scalar_name'].tolist()
     matrix = {}
@@ -477,40 +543,16 @@ bug  : \\\\   \\   :   ;    :: ;;  .' ;._..+:     ;
     c.info( Colors.YELLOW + '  Preparing matrix (' + Colors.PURPLE + '[' + str( len( labels ) ) + 'x' + str( len( labels ) ) + ']' + Colors.YELLOW + ') for ' + Colors.PURPLE + 'fibercount' + Colors.YELLOW + ' values!' + Colors._CLEAR )
 
     c.info( Colors.YELLOW + '  Analyzing fibers of ' + Colors.PURPLE + os.path.split( outputs['fibers_final'] )[1] + Colors.YELLOW + '..' + Colors._CLEAR )
-    for tCounter, t in enumerate( tracks ):
-
-      tCoordinates = t[0]
-      tScalars = t[1]
-
-      # find the segmentation labels for the start and end points
-      start_label = tScalars[0, indices['segmentation']]
-      end_label = tScalars[-1, indices['segmentation']]
-
-      try:
-        # now grab the index of the labels in our label list
-        start_index = labels.index( start_label )
-        end_index = labels.index( end_label )
-      except:
-        # this label is not monitored, so ignore this track
-        continue
-
-      # loop through all different scalars
-      for m in matrix:
-
-        # calculate the mean for each track
-        value = np.mean( tScalars[:, indices[m]] )
-
-        if m == 'inv_adc':
-          # invert the value since it is 1-ADC
-          value = 1 / value
-        elif m == 'fibercount':
-          # in the case of fibercount, add 1
-          value = 1
-
-        # store value in the matrix
-        matrix[m][start_index, end_index] += value
-        if not start_index == end_index:
-          matrix[m][end_index, start_index] += value
+    # the mean of the mapped scalars of each track is added to the matrix
+    # elements of its start and end labels (the fibercount adds 1), reading
+    # the tracks chunk by chunk
+    names = matrix.keys()
+    matrix = None
+    for tracks in reader.chunks():
+      matrix = self.connectivity_matrices( tracks, labels, indices, names, matrix )
+    reader.close()
+    if matrix is None:
+      matrix = self.connectivity_matrices( [], labels, indices, names )
 
     # fiber loop is done, all values are stored
     # now normalize the matrices
@@ -547,8 +589,114 @@ bug  : \\\\   \\   :   ;    :: ;;  .' ;._..+:     ;
     scipy.io.savemat( outputs['matrix_all'], matrix, oned_as='row' )
 
 
-  def roi_extract( self, inputs, outputs ):
+  @staticmethod
+  def connectivity_matrices( tracks, labels, indices, names, matrix=None, chunk=10000 ):
     '''
+    Accumulate the connectivity matrices <names> for all <tracks> at once.
+
+    <indices> maps every matrix name to the column of its scalar, and
+    'segmentation' to the column of the segmentation labels. Tracks whose
+    endpoint labels are not among <labels> are ignored. Returns the (not yet
+    normalized) matrices, exactly as if they were summed up track by track:
+    the per-track means are reduced in the same order as np.mean() does and
+    the values are added to each matrix element in track order.
+
+    If <matrix> is given, i.e. the matrices of the previous chunk of tracks,
+    the values are added to it (in place) in the same order.
+    '''
+    n_labels = len( labels )
+
+    # label value -> matrix index (or -1 if the label is not monitored)
+    table = np.empty( max( labels ) + 1, dtype=np.int64 )
+    table.fill( -1 )
+    for i in reversed( range( n_labels ) ):
+      table[labels[i]] = i
+
+    seg_column = indices['segmentation']
+    columns = sorted( set( [indices[m] for m in names if m != 'fibercount'] ) )
+
+    n_tracks = len( tracks )
+    lengths = np.array( [len( t[1] ) for t in tracks], dtype=np.int64 )
+    start_label = np.zeros( n_tracks )
+    end_label = np.zeros( n_tracks )
+    means = {}
+    for column in columns:
+      means[column] = None
+
+    # group the tracks by their number of points: the scalars of each group
+    # then stack into a (tracks x points) array, and every row is reduced
+    # exactly like np.mean() reduces the scalars of a single track
+    order = np.argsort( lengths, kind='mergesort' )
+    boundaries = np.flatnonzero( np.diff( lengths[order] ) ) + 1
+    for group in np.split( order, boundaries ):
+      if not len( group ) or not lengths[group[0]]:
+        continue
+      for first in range( 0, len( group ), chunk ):
+        members = group[first:first + chunk]
+        points = np.array( [tracks[i][1] for i in members] )
+        start_label[members] = points[:, 0, seg_column]
+        end_label[members] = points[:, -1, seg_column]
+        for column in columns:
+          values = np.ascontiguousarray( points[:, :, column] )
+          sums = np.add.reduce( values, axis=1 )
+          if means[column] is None:
+            means[column] = np.zeros( n_tracks, dtype=sums.dtype )
+          means[column][members] = ( sums / np.float64( lengths[group[0]] ) ).astype( sums.dtype )
+
+    # map the endpoint labels to matrix indices
+    def label_index( values ):
+      index = np.empty( len( values ), dtype=np.int64 )
+      index.fill( -1 )
+      valid = ( values >= 0 ) & ( values < len( table ) ) & ( values == np.floor( values ) )
+      index[valid] = table[values[valid].astype( np.int64 )]
+      return index
+
+    start_index = label_index( start_label )
+    end_index = label_index( end_label )
+    kept = np.flatnonzero( ( start_index >= 0 ) & ( end_index >= 0 ) & ( lengths > 0 ) )
+    start_index = start_index[kept]
+    end_index = end_index[kept]
+
+    # every track adds to [start, end] and, off the diagonal, to [end, start]:
+    # interleave both in track order so that each element sums in that order
+    mirrored = start_index != end_index
+    position = np.arange( len( kept ) ) + np.concatenate( ( [0], np.cumsum( mirrored )[:-1] ) ).astype( np.int64 )
+    cells = np.empty( len( kept ) + mirrored.sum(), dtype=np.int64 )
+    cells[position] = start_index * n_labels + end_index
+    cells[position[mirrored] + 1] = ( end_index * n_labels + start_index )[mirrored]
+
+    if matrix is None:
+      matrix = {}
+      previous = False
+    else:
+      previous = True
+    for m in names:
+      if m == 'fibercount':
+        value = np.ones( len( kept ) )
+      else:
+        value = means[indices[m]]
+        if value is None:
+          value = np.zeros( n_tracks, dtype=np.float32 )
+        value = value[kept]
+        if m == 'inv_adc':
+          # invert the value since it is 1-ADC
+          value = 1 / value
+      weights = np.empty( len( cells ) )
+      weights[position] = value
+      weights[position[mirrored] + 1] = value[mirrored]
+      if previous:
+        # unlike np.bincount(), np.add.at() adds to the existing sums
+        np.add.at( matrix[m].reshape( -1 ), cells, weights )
+      else:
+        matrix[m] = np.bincount( cells, weights=weights, minlength=n_labels * n_labels ).reshape( n_labels, n_labels ).astype( np.float64 )
+
+    return matrix
+
+
+  def roi_extract( self, inputs, outputs, jobs=1 ):
+    '''
+    Extract a .trk file and a label volume for every label the fibers pass
+    through, using up to <jobs> parallel processes.
     '''
     # check if we have all required input data
     # we need at least:
@@ -557,12 +705,10 @@ bug  : \\\\   \\   :   ;    :: ;;  .' ;._..+:     ;
       c.error( Colors.RED + 'Could not find ' + Colors.YELLOW + outputs['fibers_final'] + Colors.RED + ' but we really need it to start with stage 6!!' + Colors._CLEAR )
       sys.exit( 2 )
 
-    s = io.loadTrk( outputs['fibers_final'] )
-    tracks = s[0]
-    header = s[1]
+    reader = trkstream.Reader( outputs['fibers_final'] )
+    header = reader.header()
 
     scalarNames = header['scalar_name'].tolist()
-    labels = {}
 
     # check if the segmentation is mapped
     try:
@@ -587,42 +733,113 @@ bug  : \\\\   \\   :   ;    :: ;;  .' ;._..+:     ;
       colors[splitted_line[0]] = splitted_line[1]
 
 
-    # loop through tracks
-    for i, t in enumerate( tracks ):
-
-      tCoordinates = t[0]
-      tScalars = t[1]
-
-      # grab the scalars for each point
-      for scalar in tScalars:
-
-        # but only the label value
-        label_value = str( int( scalar[seg_index] ) )
-
-        if not label_value in labels:
-
-          labels[label_value] = []
+    # index the tracks by the labels they pass through
+    index = self.roi_index( reader.chunks(), seg_index )
+    reader.close()
+    c.info( Colors.YELLOW + '  Found ' + Colors.PURPLE + str( len( index[0] ) ) + Colors.YELLOW + ' labels along ' + Colors.PURPLE + str( index[3] ) + Colors.YELLOW + ' tracks!' + Colors._CLEAR )
+
+    # now write the rois of all detected labels, spread over the jobs
+    rois = []
+    for n, l in enumerate( index[0] ):
+      l = str( l )
+      rois.append( ( l, l + '_' + colors[l] + '.trk', l + '_' + colors[l] + '.nii.gz', index[2][index[1][n]:index[1][n + 1]] ) )
+
+    jobs = max( 1, min( int( jobs ), len( rois ) ) )
+    if jobs == 1:
+      self.roi_write( outputs['fibers_final'], header, rois, outputs )
+      return
+
+    workers = []
+    for n in xrange( jobs ):
+      # every worker streams the tracks for its own labels
+      p = multiprocessing.Process( target=self.roi_write, args=( outputs['fibers_final'], header, rois[n::jobs], outputs ) )
+      p.start()
+      workers.append( p )
+
+    failed = 0
+    for p in workers:
+      p.join()
+      if p.exitcode:
+        failed += 1
+
+    if failed:
+      c.error( Colors.RED + 'The ROI extraction failed in ' + Colors.YELLOW + str( failed ) + Colors.RED + ' of ' + str( jobs ) + ' jobs!' + Colors._CLEAR )
+      sys.exit( 2 )
 
-        if not i in labels[label_value]:
-          # store the unique fiber id for this label
-          labels[label_value].append( i )
 
-    # now loop through all detected labels
-    for l in labels:
+  @staticmethod
+  def roi_index( chunks, seg_index ):
+    '''
+    Build an inverted index of the label values along the tracks, which are
+    given as <chunks>, i.e. lists of tracks (see trkstream.Reader.chunks()).
 
-      new_tracks = []
+    Returns ( labels, offsets, ids, count ) with the index in compressed sparse
+    row form: the ids of the tracks passing through labels[n] are
+    ids[offsets[n]:offsets[n + 1]], in ascending order and each listed once.
+    The ids number the tracks across all chunks, <count> is their total.
+    '''
+    all_values = []
+    all_ids = []
+    first_id = 0
+    for tracks in chunks:
+
+      lengths = np.array( [len( t[1] ) for t in tracks], dtype=np.int64 )
+      if lengths.sum():
+        # the label value (truncated like int()) and the track id of every point
+        values = np.concatenate( [np.asarray( t[1] )[:, seg_index] for t in tracks if len( t[1] )] ).astype( np.int64 )
+        ids = np.repeat( np.arange( first_id, first_id + len( tracks ), dtype=np.int64 ), lengths )
+
+        # sort by label, then by track, and drop repeated ( label, track ) pairs
+        order = np.lexsort( ( ids, values ) )
+        values = values[order]
+        ids = ids[order]
+        unique = np.ones( len( values ), dtype=bool )
+        unique[1:] = ( values[1:] != values[:-1] ) | ( ids[1:] != ids[:-1] )
+        all_values.append( values[unique] )
+        all_ids.append( ids[unique] )
+
+      first_id += len( tracks )
+
+    if not all_values:
+      return ( np.zeros( 0, dtype=np.int64 ), np.zeros( 1, dtype=np.int64 ), np.zeros( 0, dtype=np.int64 ), first_id )
+
+    # a track lies within a single chunk, so the pairs are unique already
+    values = np.concatenate( all_values )
+    ids = np.concatenate( all_ids )
+    order = np.lexsort( ( ids, values ) )
+    values = values[order]
+    ids = ids[order]
+
+    first = np.flatnonzero( np.concatenate( ( [True], values[1:] != values[:-1] ) ) )
+    offsets = np.append( first, len( values ) )
+    return ( values[first], offsets, ids, first_id )
+
+
+  def roi_write( self, path, header, rois, outputs ):
+    '''
+    Write the .trk file and the label volume of each of the <rois>, given as
+    ( label, trk file, nii file, track ids ), streaming the tracks from <path>.
+    '''
+    writers = []
+    for l, trk_outputfile, nii_outputfile, ids in rois:
+      c.info( Colors.YELLOW + '  Creating fiber ROI ' + Colors.PURPLE + trk_outputfile + Colors.YELLOW + '!' + Colors._CLEAR )
+      writers.append( trkstream.Writer( os.path.join( outputs['roi'], trk_outputfile ), header ) )
 
-      for t_id in labels[l]:
-        # grab the fiber + scalars
-        current_fiber = tracks[t_id]
+    # pass the tracks of each chunk on to the files of their labels
+    reader = trkstream.Reader( path )
+    first_id = 0
+    for tracks in reader.chunks():
+      last_id = first_id + len( tracks )
+      for ( l, trk_outputfile, nii_outputfile, ids ), writer in zip( rois, writers ):
+        ids = ids[np.searchsorted( ids, first_id ):np.searchsorted( ids, last_id )]
+        writer.write( [tracks[t_id - first_id] for t_id in ids] )
+      first_id = last_id
+    reader.close()
 
-        new_tracks.append( current_fiber )
+    for writer in writers:
+      writer.close()
 
-      # now store the trk file
-      trk_outputfile = l + '_' + colors[l] + '.trk'
-      nii_outputfile = l + '_' + colors[l] + '.nii.gz'
-      c.info( Colors.YELLOW + '  Creating fiber ROI ' + Colors.PURPLE + trk_outputfile + Colors.YELLOW + '!' + Colors._CLEAR )
-      io.saveTrk( os.path.join( outputs['roi'], trk_outputfile ), new_tracks, header, None, True )
+    for l, trk_outputfile, nii_outputfile, ids in rois:
 
       # also create a roi label volume for this label value
       c.info( Colors.YELLOW + '  Creating NII ROI ' + Colors.PURPLE + nii_outputfile + Colors.YELLOW + '!' + Colors._CLEAR )
@@ -691,7 +908,9 @@ if __name__ == "__main__":
   parser.add_argument( '-co', '--cortex_only', action='store_true', dest='cortex_only', help='Perform filtering for cortex specific analysis and skip sub-cortical structures.' )
   parser.add_argument( '-s', '--stage', action='store', dest='stage', default=0, type=int, help='Start with a specific stage while skipping the ones before. E.g. --stage 3 directly starts the mapping without preprocessing, --stage 4 starts with the filtering' )
   parser.add_argument( '-overwrite', '--overwrite', action='store_true', dest='overwrite', help='Overwrite any existing output. DANGER!!' )
+  parser.add_argument( '-im', '--intermediates', action='store_true', dest='intermediates', help='Run the filters one by one and store the tracks after each. DEFAULT: off, i.e. a single pass' )
   parser.add_argument( '-v', '--verbose', action='store_true', dest='verbose', help='Show verbose output' )
+  parser.add_argument( '-j', '--jobs', action='store', dest='jobs', default=multiprocessing.cpu_count(), type=int, help='The number of parallel processes for the ROI extraction. E.g. --jobs 4, DEFAULT: the number of CPUs' )
 
   # always show the help if no arguments were specified
   if len( sys.argv ) == 1:
@@ -723,4 +942,4 @@ if __name__ == "__main__":
 
 
   logic = FyborgLogic()
-  logic.run( options.input, options.output, options.radius, options.length, int( options.stage ), options.cortex_only, options.verbose )
+  logic.run( options.input, options.output, options.radius, options.length, int( options.stage ), options.cortex_only, options.verbose, options.jobs, options.intermediates )
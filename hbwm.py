@@ -66,26 +66,6 @@ class FNNDSC_HBWM(base.FNNDSC):
     # across all instances of this class
     #
     _dictErr = {
-        'subjectSpecFail'   : {
-            'action'        : 'examining command line arguments, ',
-            'error'         : 'it seems that no subjects were specified.',
-            'exitCode'      : 10},
-        'noFreeSurferEnv'   : {
-            'action'        : 'examining environment, ',
-            'error'         : 'it seems that the FreeSurfer environment has not been sourced.',
-            'exitCode'      : 11},
-        'notClusterNode'    : {
-            'action'        : 'checking the execution environemt, ',
-            'error'         : 'script can only run on a cluster node.',
-            'exitCode'      : 12},
-        'subjectDirnotExist': {
-            'action'        : 'examining the <subjectDirectories>, ',
-            'error'         : 'the directory does not exist.',
-            'exitCode'      : 13},
-        'stageExec'         : {
-            'action'        : 'executing stage, ',
-            'error'         : 'an external error was detected.',
-            'exitCode'      : 30},
         'Load'              : {
             'action'        : 'attempting to pickle load object, ',
             'error'         : 'a PickleError occured.',
@@ -319,7 +299,7 @@ class FNNDSC_HBWM(base.FNNDSC):
             stage.canRun(True)
             
         for str_subj in self._l_subject:
-            self._log('Checking on subjectDir <%s>' % str_subj,
+            self._log('Checking on subjectDir <%s>', str_subj,
                         debug=9, lw=self._lw)
             if os.path.isdir(str_subj):
                 self._log('[ ok ]\n', debug=9, rw=self._rw, syslog=False)
@@ -492,6 +472,9 @@ def synopsis(ab_shortOnly = False):
                             [--curv|-c <curvType>               \\
                             [--cluster|-l <cluster>]            \\
                             [--queue |-q <queue>]               \\
+                            [--keepGoing|-k]                    \\
+                            [--telemetry <address>]             \\
+                            [--profile <prefix>]                \\
                             [--partitions|-p <numberOfSurfacePartitions>] \\
                             <Subj1> <Subj2> ... <SubjN>
     ''' % scriptName
@@ -537,6 +520,24 @@ def synopsis(ab_shortOnly = False):
 
         --queue <queue>
         Name of queue on cluster to use. Cluster-specific.
+
+        --keepGoing|-k
+        If specified, a failure for one subject does not stop the run.
+        Each failure is logged in a single line, and all failures are
+        summarized when the run completes, after which the script exits
+        with the error code of the first failure.
+
+        --telemetry <address>
+        If specified, serve the progress of the run as JSON on <address>:
+        either '[host:]port' for HTTP, or the path of a Unix socket. For
+        example, with '--telemetry 8421':
+
+            $>curl http://127.0.0.1:8421/
+
+        --profile <prefix>
+        If specified, profile the run with a low-overhead sampling profiler
+        and write the collapsed stacks of each stage to
+        <prefix>.<stage>.collapsed, e.g. for rendering with 'flamegraph.pl'.
       
         --stages|-s <stages>
         The stages to execute. This is specified in a string, such as '1234'
@@ -711,6 +712,21 @@ if __name__ == "__main__":
                         action='store',
                         default='',
                         help='default queue to use')
+    parser.add_argument('--keepGoing', '-k',
+                        dest='b_keepGoing',
+                        action="store_true",
+                        default=False,
+                        help='continue with other subjects on failure')
+    parser.add_argument('--telemetry',
+                        dest='telemetry',
+                        action='store',
+                        default='',
+                        help='address on which to serve progress as JSON')
+    parser.add_argument('--profile',
+                        dest='profile',
+                        action='store',
+                        default='',
+                        help='file prefix for sampled profiles of each stage')
     args = parser.parse_args()
 
     
@@ -729,7 +745,10 @@ if __name__ == "__main__":
                         curvList        = args.curv,
                         logTo           = 'HBWM.log',
                         syslog          = True,
-                        logTee          = True
+                        logTee          = True,
+                        keepGoing       = args.b_keepGoing,
+                        telemetry       = args.telemetry,
+                        sampleTo        = args.profile
                         )
     pipe_HBWM.verbosity(args.verbosity)
     pipe_HBWM.subjectsDir(pipe_HBWM._str_workingDir)
@@ -835,7 +854,7 @@ if __name__ == "__main__":
                     shell.schedulerStdOut(str_shellstdout)
                     shell.schedulerStdErr(str_shellstderr)
 
-                    log('Processing %s: %s...\n' % (pipeline.subj(), str_surfaceFile))
+                    log('Processing %s: %s...\n', pipeline.subj(), str_surfaceFile)
                     shell.description('0:%s:%s:%s' % \
                         (pipeline.subj(), pipeline.hemi(), pipeline.surface()))
                     log('Checking on number of vertices... ')
@@ -1125,8 +1144,9 @@ if __name__ == "__main__":
                             (pipeline.hemi(), pipeline.surface(), pipeline.curv())
                         misc.mkdir(str_recomDir)
                         os.chdir(str_recomDir)
-                        remoteShell.description('2:%s:%s:%s:%s' % (pipeline.subj(),
-                                    pipeline.hemi(), pipeline.surface(), pipeline.curv()))
+                        str_where           = '%s:%s:%s:%s' % (pipeline.subj(),
+                                    pipeline.hemi(), pipeline.surface(), pipeline.curv())
+                        remoteShell.description('2:' + str_where)
                         remoteShell.workingDir("%s/%s" % \
                             (pipeline.local2remoteUserHomeDir(pipeline.analysisDir()), str_recomDir))
                         str_autodijkFile = '%s.%s.autodijk-%s.crv' % \
@@ -1136,10 +1156,11 @@ if __name__ == "__main__":
                                     (str_autodijkFile)
                         remoteShell(str_cmd, waitForChild=True, stdoutflush=True, stderrflush=True)
                         if remoteShell.exitCode():
-                            error.fatal(pipe_HBWM, 'stageExec', remoteShell.stderr())
+                            error.collect(pipe_HBWM, 'stageExec', remoteShell.stderr(), stage=stage.name(), subject=str_where)
+                            continue
                         remoteShell('cp %s %s/surf' % (str_autodijkFile, pipeline.subjectDir()))
                         if remoteShell.exitCode():
-                            error.fatal(pipe_HBWM, 'stageExec', remoteShell.stderr())
+                            error.collect(pipe_HBWM, 'stageExec', remoteShell.stderr(), stage=stage.name(), subject=str_where)
         os.chdir(pipeline.startDir())
         return True
     stage2.def_stage(f_stage2callback, subj=args.l_subj, obj=stage2, pipe=pipe_HBWM)
@@ -1207,8 +1228,9 @@ if __name__ == "__main__":
                         str_autonsFile   = '%s.%s.ans-%s.crv' % \
                                     (pipeline.hemi(), pipeline.surface(), pipeline.curv())
                         os.chdir(pipeline.surfDir())
-                        remoteShell.description('3:%s:%s:%s:%s' % (pipeline.subj(),
-                                    pipeline.hemi(), pipeline.surface(), pipeline.curv()))
+                        str_where           = '%s:%s:%s:%s' % (pipeline.subj(),
+                                    pipeline.hemi(), pipeline.surface(), pipeline.curv())
+                        remoteShell.description('3:' + str_where)
                         remoteShell.workingDir(pipeline.local2remoteUserHomeDir(pipeline.surfDir()))
                         log('Normalizing and shifting %s\n' % str_autodijkFile)
                         str_cmd = "\
@@ -1220,7 +1242,7 @@ if __name__ == "__main__":
                              str_autodijkFile, str_autonsFile, str_autonormFile)
                         remoteShell(str_cmd, waitForChild=True, stdoutflush=True, stderrflush=True)
                         if remoteShell.exitCode():
-                            error.fatal(pipe_HBWM, 'stageExec', remoteShell.stderr())
+                            error.collect(pipe_HBWM, 'stageExec', remoteShell.stderr(), stage=stage.name(), subject=str_where)
         os.chdir(pipeline.startDir())
         return True
     stage3.def_stage(f_stage3callback, subj=args.l_subj, obj=stage3, pipe=pipe_HBWM)
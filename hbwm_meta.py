@@ -45,22 +45,6 @@ class FNNDSC_HBWMmeta(base.FNNDSC):
     # across all instances of this class
     #
     _dictErr = {
-        'subjectSpecFail'   : {
-            'action'        : 'examining command line arguments, ',
-            'error'         : 'it seems that no subjects were specified.',
-            'exitCode'      : 10},
-        'noFreeSurferEnv'   : {
-            'action'        : 'examining environment, ',
-            'error'         : 'it seems that the FreeSurfer environment has not been sourced.',
-            'exitCode'      : 11},
-        'noStagePostConditions' : {
-            'action'        : 'querying a stage for its exitCode, ',
-            'error'         : 'it seems that the stage has not been specified.',
-            'exitCode'      : 12},
-        'subjectDirnotExist': {
-            'action'        : 'examining the <subjectDirectories>, ',
-            'error'         : 'the directory does not exist.',
-            'exitCode'      : 13},
         'Load'              : {
             'action'        : 'attempting to pickle load object, ',
             'error'         : 'a PickleError occured.',
@@ -183,7 +167,7 @@ class FNNDSC_HBWMmeta(base.FNNDSC):
         self._log('[ ok ]\n', debug=9, rw=self._rw, syslog=False)
         
         for str_subj in self._l_subject:
-            self._log('Checking on subjectDir <%s>' % str_subj,
+            self._log('Checking on subjectDir <%s>', str_subj,
                         debug=9, lw=self._lw)
             if os.path.isdir(str_subj):
                 self._log('[ ok ]\n', debug=9, rw=self._rw, syslog=False)
@@ -216,6 +200,12 @@ def synopsis(ab_shortOnly = False):
                             [--cluster|-l <cluster>]            \\
                             [--queue |-q <queue>]               \\
                             [--partitions|-p <numberOfSurfacePartitions>] \\
+                            [--jobs|-j <concurrentJobs>]        \\
+                            [--retry <attempts>]                \\
+                            [--timings <timingFile>]            \\
+                            [--plan <timingFile>]               \\
+                            [--telemetry <address>]             \\
+                            [--profile <prefix>]                \\
                             <Subj1> <Subj2> ... <SubjN>
     ''' % scriptName
   
@@ -268,6 +258,39 @@ def synopsis(ab_shortOnly = False):
         --queue <queue>
         Name of queue on cluster to use. Cluster-specific.
 
+        --jobs|-j <concurrentJobs> (default: 1)
+        The number of 'hbwm.py' subject/hemi/surface/curv instances to run
+        concurrently. All instances are run, and any failures are
+        reported together once all have completed.
+
+        --retry <attempts> (default: 1)
+        The number of times each 'hbwm.py' instance is attempted before it
+        is considered failed. Useful when remote shells fail on transient
+        network errors. Attempts are spaced by an exponential backoff.
+
+        --timings <timingFile>
+        If specified, record the timing profile of each stage to
+        <timingFile> (JSON, or CSV if the name ends in '.csv').
+
+        --plan <timingFile>
+        Do not run anything. Instead, use the timing history in
+        <timingFile> (as recorded by --timings) to estimate the duration
+        of each stage, scaled by the size of the current inputs, and
+        report the critical path and expected total wall time. Can be
+        specified multiple times to pool several histories.
+
+        --telemetry <address>
+        If specified, serve the progress of the run as JSON on <address>:
+        either '[host:]port' for HTTP, or the path of a Unix socket. For
+        example, with '--telemetry 8421':
+
+            $>curl http://127.0.0.1:8421/
+
+        --profile <prefix>
+        If specified, profile the run with a low-overhead sampling profiler
+        and write the collapsed stacks of each stage to
+        <prefix>.<stage>.collapsed, e.g. for rendering with 'flamegraph.pl'.
+
         --stages|-s <stages>
         The stages of 'hbwm.py' to execute. This is specified in a string, 
         such as '1234' which would imply stages 1, 2, 3, and 4.
@@ -409,6 +432,36 @@ if __name__ == "__main__":
                         action='store',
                         default='',
                         help='default queue to use')
+    parser.add_argument('--jobs', '-j',
+                        dest='jobs',
+                        action='store',
+                        default='1',
+                        help='number of hbwm.py instances to run concurrently')
+    parser.add_argument('--retry',
+                        dest='retry',
+                        action='store',
+                        default='1',
+                        help='number of attempts per hbwm.py instance')
+    parser.add_argument('--timings',
+                        dest='timings',
+                        action='store',
+                        default='',
+                        help='file to record stage timings to')
+    parser.add_argument('--plan',
+                        dest='l_plan',
+                        action='append',
+                        default=[],
+                        help='estimate the run from recorded timings; nothing is executed')
+    parser.add_argument('--telemetry',
+                        dest='telemetry',
+                        action='store',
+                        default='',
+                        help='address on which to serve progress as JSON')
+    parser.add_argument('--profile',
+                        dest='profile',
+                        action='store',
+                        default='',
+                        help='file prefix for sampled profiles of each stage')
     args = parser.parse_args()
 
     OSshell = crun.crun()
@@ -421,6 +474,10 @@ if __name__ == "__main__":
                         hemiList        = args.hemi,
                         surfaceList     = args.surface,
                         curvList        = args.curv,
+                        profileTo       = args.timings,
+                        plan            = args.l_plan,
+                        telemetry       = args.telemetry,
+                        sampleTo        = args.profile,
                         logTo           = 'HBWMmeta.log',
                         syslog          = True,
                         logTee          = True
@@ -451,37 +508,59 @@ if __name__ == "__main__":
         if int(args.partitions) > _maxPartitions:
             error.fatal(hbwm, 'Partition')
 
-        for pipeline._str_subj in lst_subj:
-            for pipeline._str_hemi in lst_hemi:
-                for pipeline._str_surface in lst_surface:
-                    for pipeline._str_curv in lst_curv:
-                        log = stage.log()
-                        log('Processing %s: %s.%s, %s...\n' % \
-                            (pipeline.subj(), pipeline.hemi(), pipeline.surface(), pipeline.curv()))
-                        str_hostOnlySpec = ''
-                        if len(args.host):
-                            str_hostOnlySpec = "--host %s " % args.host
-                            log('Locking jobs to only run on host -->%s<--\n' % args.host)
-                        str_debug = ""
-                        if args.b_debug: str_debug = " --debug "
-                        str_queue = ""
-                        if args.queue: str_queue = " --queue %s " % args.queue
-                        str_cmd = "~/src/scripts/hbwm.py -v 10 -s %s %s -r -m %s -f %s -c %s -p %s --cluster %s %s %s %s" % \
-                            (args.stages, str_hostOnlySpec,
-                            pipeline.hemi(), pipeline.surface(), pipeline.curv(), args.partitions,
-                            args.cluster, str_debug, str_queue, pipeline.subj())
-                        print str_cmd
-                        shell = crun.crun()
-                        shell.echo(False)
-                        shell.echoStdOut(False)
-                        shell.detach(False)
-                        shell(str_cmd, waitForChild=True, stdoutflush=True, stderrflush=True)
-                        if shell.exitCode():
-                            error.fatal(hbwm, 'stageExec', shell.stderr())
+        log = stage.log()
+        str_hostOnlySpec = ''
+        if len(args.host):
+            str_hostOnlySpec = "--host %s " % args.host
+            log('Locking jobs to only run on host -->%s<--\n' % args.host)
+        str_debug = ""
+        if args.b_debug: str_debug = " --debug "
+        str_queue = ""
+        if args.queue: str_queue = " --queue %s " % args.queue
+
+        def f_cmd(d_item):
+            log('Processing %s: %s.%s, %s...\n',
+                d_item['subj'], d_item['hemi'], d_item['surface'], d_item['curv'])
+            str_cmd = "~/src/scripts/hbwm.py -v 10 -s %s %s -r -m %s -f %s -c %s -p %s --cluster %s %s %s %s" % \
+                (args.stages, str_hostOnlySpec,
+                d_item['hemi'], d_item['surface'], d_item['curv'], args.partitions,
+                args.cluster, str_debug, str_queue, d_item['subj'])
+            print str_cmd
+            return str_cmd
+
+        def f_shell():
+            shell = crun.crun()
+            shell.echo(False)
+            shell.echoStdOut(False)
+            shell.detach(False)
+            return shell
+
+        fan = stage.fanout(cmd          = f_cmd,
+                           params       = [('subj',     lst_subj),
+                                           ('hemi',     lst_hemi),
+                                           ('surface',  lst_surface),
+                                           ('curv',     lst_curv)],
+                           workers      = int(args.jobs),
+                           retry        = int(args.retry),
+                           shellFactory = f_shell)
+        if len(fan.failures()):
+            error.fatal(hbwm, 'stageExec', fan.summary_str())
         os.chdir(pipeline.startDir())
         return True
 
     stage0.def_stage(f_stage0callback, subj=args.l_subj, obj=stage0, pipe=hbwm)
+    # The surfaces to be processed serve as the stage's input size for
+    # --plan, so that estimates scale with the size of the batch.
+    stage0.inputFiles(['%s/surf/%s.%s' % (subj, hemi, surface)
+                        for subj in args.l_subj
+                        for hemi in hbwm.l_hemisphere()
+                        for surface in hbwm.l_surface()])
+    # The callback only gets the pipeline object, so name what the work
+    # depends on for the result cache and the journal.
+    stage0.cacheKey('%s %s %s %s %s %s %s %s %s' % \
+                    (' '.join(args.l_subj), ' '.join(hbwm.l_hemisphere()),
+                    ' '.join(hbwm.l_surface()), ' '.join(hbwm.l_curv()),
+                    args.stages, args.partitions, args.cluster, args.host, args.queue))
     stage0.def_postconditions(f_blockOnScheduledJobs, obj=stage0,
                               blockProcess    = 'hbwm.py')
 
@@ -45,10 +45,6 @@ class CLUSTER(base.FNNDSC):
             'action'        : 'checking command line args, ',
             'error'         : 'it seems that an invalid cluster destination was specified.',
             'exitCode'      : 10},
-        'noFreeSurferEnv'   : {
-            'action'        : 'examining environment, ',
-            'error'         : 'it seems that the FreeSurfer environment has not been sourced.',
-            'exitCode'      : 11},
     }
 
     def startDir(self):
@@ -3,11 +3,374 @@
 import  sys
 import  os
 import  time
-import  inspect
 import  types
+import  json
+import  threading
+import  collections
+import  atexit
+import  glob
+import  gzip
+import  shutil
 import  dgmsocket as dgm
 from    _common._colors import Colors
 
+try:
+    import  msgpack
+except ImportError:
+    msgpack     = None
+
+
+class AsyncWriter:
+    '''
+    A background thread that performs the actual writes of one or more
+    Message objects.
+
+    Messages are appended to a bounded queue and the caller returns
+    immediately. The writer thread drains the queue in batches: every
+    <flushInterval> seconds, as soon as <flushCount> messages are
+    waiting, or when flush() is called. Consecutive messages to the same
+    destination are joined into a single write, colour codes are
+    stripped once per batch rather than once per message, and each
+    destination is flushed once per batch. Datagram socket targets are
+    still sent one message per datagram.
+
+    If <maxQueue> messages are waiting, callers block until the writer
+    has caught up. All writers are flushed and stopped when the
+    interpreter exits.
+    '''
+
+    _l_writer       = []
+    _lock           = threading.Lock()
+
+    def __init__(self, **kwargs):
+        self._maxQueue          = 10000
+        self._flushInterval     = 0.5
+        self._flushCount        = 1000
+        for key, value in kwargs.iteritems():
+            if key == 'maxQueue':       self._maxQueue          = value
+            if key == 'flushInterval':  self._flushInterval     = value
+            if key == 'flushCount':     self._flushCount        = value
+        # A deque is used rather than a Queue.Queue since appends to it are
+        # atomic and cheap, which is what matters to the callers.
+        self._deque             = collections.deque()
+        self._event             = threading.Event()
+        self._thread            = threading.Thread(target = self.run)
+        self._thread.daemon     = True
+        self._thread.start()
+        AsyncWriter._lock.acquire()
+        AsyncWriter._l_writer.append(self)
+        AsyncWriter._lock.release()
+
+
+    def write(self, handle, str_msg, ab_strip = False):
+        '''
+        Queue <str_msg> for writing to <handle>, stripping colour codes
+        if <ab_strip> is True.
+        '''
+        self._deque.append((handle, ab_strip, str_msg))
+        waiting = len(self._deque)
+        if waiting >= self._flushCount:     self._event.set()
+        if waiting >= self._maxQueue:       self.flush()
+
+
+    def control(self, astr_action):
+        '''
+        Queue <astr_action> ('flush' or 'close') and wait until the
+        writer thread has reached it.
+        '''
+        if not self._thread.isAlive(): return
+        event = threading.Event()
+        self._deque.append((astr_action, event))
+        self._event.set()
+        while not event.isSet() and self._thread.isAlive(): event.wait(1)
+
+
+    def flush(self):
+        '''
+        Block until all messages queued so far have been written.
+        '''
+        self.control('flush')
+
+
+    def close(self):
+        '''
+        Write all pending messages and stop the writer thread.
+        '''
+        self.control('close')
+        AsyncWriter._lock.acquire()
+        if self in AsyncWriter._l_writer: AsyncWriter._l_writer.remove(self)
+        AsyncWriter._lock.release()
+
+
+    @staticmethod
+    def close_all():
+        for writer in list(AsyncWriter._l_writer): writer.close()
+
+
+    @staticmethod
+    def batch_write(al_batch):
+        '''
+        Write a batch of (handle, strip, message) tuples. Consecutive
+        messages to the same handle are joined into a single write.
+        '''
+        l_handle    = []
+        index       = 0
+        while index < len(al_batch):
+            handle, b_strip, str_msg = al_batch[index]
+            index += 1
+            l_msg = [str_msg]
+            if not isinstance(handle, dgm.C_dgmsocket):
+                while index < len(al_batch) and al_batch[index][0] is handle and \
+                      al_batch[index][1] == b_strip:
+                    l_msg.append(al_batch[index][2])
+                    index += 1
+            str_msg = ''.join(l_msg)
+            if b_strip: str_msg = Colors.strip(str_msg)
+            try:
+                handle.write(str_msg)
+            except (IOError, ValueError):
+                # The handle has been closed under us; nothing to be done.
+                continue
+            if handle not in l_handle: l_handle.append(handle)
+        for handle in l_handle:
+            try:
+                handle.flush()
+            except (IOError, ValueError):
+                pass
+
+
+    def run(self):
+        while True:
+            self._event.wait(self._flushInterval)
+            self._event.clear()
+            l_batch = []
+            while len(self._deque):
+                item = self._deque.popleft()
+                if len(item) == 3:
+                    l_batch.append(item)
+                    continue
+                self.batch_write(l_batch)
+                l_batch = []
+                str_action, event = item
+                event.set()
+                if str_action == 'close': return
+            self.batch_write(l_batch)
+
+
+atexit.register(AsyncWriter.close_all)
+
+class RotatingFile:
+    '''
+    A log file that is rolled over once it grows past <maxBytes>, or
+    once a new period of <interval> seconds starts (periods are counted
+    from the epoch, so 86400 rolls over at midnight UTC). A value of 0
+    turns either check off.
+
+    The current segment is always <path>, so that readers (and 'tail -F')
+    find it where they expect it. Rolled segments are renamed to
+    <path>.<YYYYmmdd-HHMMSS>, compressed to '.gz' in the background if
+    <compress> is True, and only the newest <count> are kept, which
+    bounds the space a log takes on a shared filesystem to roughly
+    (<count> + 1) * <maxBytes>.
+
+    Several processes may append to the same file. If another process
+    has already rolled it over, the file is simply reopened.
+    '''
+
+    def __init__(self, path, **kwargs):
+        self.name               = path
+        self._maxBytes          = 0
+        self._interval          = 0
+        self._count             = 5
+        self._b_compress        = False
+        for key, value in kwargs.iteritems():
+            if key == 'maxBytes':   self._maxBytes      = int(value)
+            if key == 'interval':   self._interval      = float(value)
+            if key == 'count':      self._count         = int(value)
+            if key == 'compress':   self._b_compress    = value
+        self._lock              = threading.Lock()
+        self._compressor        = None
+        self._handle            = None
+        self.open()
+
+
+    def open(self):
+        self._handle            = open(self.name, 'a')
+        st                      = os.fstat(self._handle.fileno())
+        self._inode             = st.st_ino
+        self._size              = st.st_size
+        # Time-based rotation is aligned to multiples of <interval> since
+        # the epoch, and a segment belongs to the period of its last
+        # write. This way, short runs (e.g. from cron) that each reopen
+        # the file still roll it over once its period has passed.
+        if self._size:  self._period = self.period(st.st_mtime)
+        else:           self._period = self.period(time.time())
+
+
+    def write(self, str_msg):
+        if self._maxBytes and self._size + len(str_msg) > self._maxBytes and \
+           '\n' in str_msg[:-1]:
+            # A batch of messages (see AsyncWriter) that would overflow
+            # the segment is written line by line, so that it is split
+            # across segments at a line boundary.
+            for str_line in str_msg.splitlines(True): self.write(str_line)
+            return
+        self._lock.acquire()
+        try:
+            if self.rotateDue(len(str_msg)): self.rotate()
+            self._handle.write(str_msg)
+            self._size += len(str_msg)
+        finally:
+            self._lock.release()
+
+
+    def flush(self):
+        self._handle.flush()
+
+
+    def close(self):
+        self._handle.close()
+        if self._compressor is not None: self._compressor.join()
+
+
+    def period(self, f_time):
+        if not self._interval: return 0
+        return int(f_time / self._interval)
+
+
+    def rotateDue(self, nbytes):
+        if not self._size: return False
+        if self._maxBytes and self._size + nbytes > self._maxBytes: return True
+        if self.period(time.time()) != self._period: return True
+        return False
+
+
+    def rotate(self):
+        '''
+        Roll the current segment over and start a new one.
+        '''
+        self._handle.close()
+        try:
+            b_ours = os.stat(self.name).st_ino == self._inode
+        except OSError:
+            b_ours = False
+        if b_ours:
+            str_segment = '%s.%s' % (self.name, time.strftime('%Y%m%d-%H%M%S'))
+            index = 1
+            while os.path.exists(str_segment) or os.path.exists(str_segment + '.gz'):
+                str_segment = '%s.%s.%d' % (self.name,
+                                time.strftime('%Y%m%d-%H%M%S'), index)
+                index += 1
+            os.rename(self.name, str_segment)
+            if self._compressor is not None: self._compressor.join()
+            if self._b_compress:
+                self._compressor = threading.Thread(target = self.compress,
+                                                    args = (str_segment,))
+                self._compressor.daemon = True
+                self._compressor.start()
+            else:
+                self.expire()
+        self.open()
+
+
+    def compress(self, astr_segment):
+        try:
+            handle_in = open(astr_segment, 'rb')
+            handle_out = gzip.open(astr_segment + '.gz', 'wb')
+            shutil.copyfileobj(handle_in, handle_out)
+            handle_out.close()
+            handle_in.close()
+            os.remove(astr_segment)
+        except (IOError, OSError):
+            # Leave the segment uncompressed rather than lose it.
+            pass
+        self.expire()
+
+
+    def segments(self):
+        '''
+        Returns the rolled segments of this file, oldest first.
+        '''
+        l_segment = [f for f in glob.glob(self.name + '.*')
+                     if f[len(self.name) + 1:][:8].isdigit()]
+        l_dated = []
+        for str_segment in l_segment:
+            try:
+                l_dated.append((os.path.getmtime(str_segment), str_segment))
+            except OSError:
+                pass
+        return [t[1] for t in sorted(l_dated)]
+
+
+    def expire(self):
+        '''
+        Remove all but the newest <count> rolled segments.
+        '''
+        l_segment = self.segments()
+        for str_segment in l_segment[:max(0, len(l_segment) - self._count)]:
+            try:
+                os.remove(str_segment)
+            except OSError:
+                pass
+
+
+    @staticmethod
+    def tail(astr_file, lines = 10, blockSize = 8192):
+        '''
+        Returns the last <lines> lines of <astr_file>, reading backwards
+        from its end in blocks of <blockSize> bytes, so that the cost
+        does not depend on the size of the file.
+        '''
+        handle = open(astr_file, 'rb')
+        handle.seek(0, os.SEEK_END)
+        position = handle.tell()
+        l_block = []
+        newlines = 0
+        while position > 0 and newlines <= lines:
+            size = min(blockSize, position)
+            position -= size
+            handle.seek(position)
+            str_block = handle.read(size)
+            newlines += str_block.count('\n')
+            l_block.insert(0, str_block)
+        handle.close()
+        l_line = ''.join(l_block).splitlines(True)
+        return l_line[-lines:] if lines else []
+
+
+class RingBuffer:
+    '''
+    An in-memory message sink that keeps only the most recent <size>
+    messages, e.g. to show the last few lines of a log on failure.
+    '''
+
+    def __init__(self, size = 1000):
+        self._deque = collections.deque(maxlen = size)
+
+    def write(self, str_msg):   self._deque.append(str_msg)
+    def flush(self):            pass
+    def close(self):            pass
+    def messages(self):         return list(self._deque)
+    def __str__(self):          return ''.join(self._deque)
+
+
+class Sink:
+    '''
+    One of the additional destinations of a Message. See sink_add().
+    '''
+
+    def __init__(self, name, handle, verbosity, b_strip, b_own):
+        self.name       = name
+        self.handle     = handle
+        self.verbosity  = verbosity
+        self.b_strip    = b_strip
+        self.b_own      = b_own
+
+    def accepts(self, alevel):
+        if self.verbosity is None or not alevel: return True
+        return int(alevel) <= int(self.verbosity)
+
+
 class Message:
     '''
     A simple messaging class that is able to send text content to a variety
@@ -22,9 +385,22 @@ class Message:
 
     Furthermore, text messages can be left/right justified in columns of given 
     width by setting in-call flags.
+
+    Writes are synchronous by default. With asyncWrite(True), they are
+    handed off to a background thread so that chatty callers never wait
+    on slow (e.g. NFS) log files. With rotate(), log files are rolled
+    over by size and/or time so that they do not grow without bound.
     
     '''
 
+    # Process-wide values used in syslog prefixes. These are resolved once
+    # per process (see hostname() and processName()), and the timestamped
+    # prefix itself is reused for as long as the wall-clock second is the
+    # same (see syslog_generate()).
+    _str_hostname       = None
+    _str_processName    = None
+    _t_syslog           = (None, None, None, '')
+
     def verbosity(self, *args):
         '''
         get/set the verbosity level.
@@ -137,6 +513,228 @@ class Message:
             return self._b_tee
 
 
+    def records(self, *args):
+        '''
+        get/set the side channel to which structured log records are
+        written, in addition to the normal text output.
+
+        Each message is written as a record with the fields
+
+            time, pid, host, process, tag, level, stage, msg
+
+        where 'level' is the debug level of the message, 'stage' is the
+        'stage' record field (see recordField()) and 'msg' is the message
+        text without any prefixes or colour codes. Records are written as
+        newline-delimited JSON or, see recordFormat(), as msgpack. They
+        can be read back with records_load().
+
+        records():              returns the current side channel file
+        records(<file>):        appends records to <file>
+        records(''):            turns structured records off
+
+        '''
+        if len(args):
+            if self._recordHandle is not None:
+                if self._writer is not None: self._writer.flush()
+                self._recordHandle.close()
+                self._recordHandle = None
+            self._str_records = args[0]
+            if len(self._str_records):
+                self._recordHandle = open(self._str_records, 'ab')
+        else:
+            return self._str_records
+
+
+    def recordFormat(self, *args):
+        '''
+        get/set the format of the structured records, either 'json'
+        (the default) or 'msgpack'. The latter needs the msgpack module.
+
+        recordFormat():                 returns the current format
+        recordFormat('json'|'msgpack'): sets the format
+
+        '''
+        if len(args):
+            if args[0] == 'msgpack' and msgpack is None:
+                raise ImportError('msgpack records need the msgpack module')
+            self._str_recordFormat = args[0]
+        else:
+            return self._str_recordFormat
+
+
+    def recordField(self, astr_field, *args):
+        '''
+        get/set a constant field that is added to every structured record,
+        such as the 'stage' name.
+
+        recordField(<field>):           returns the field value
+        recordField(<field>, <value>):  sets the field value
+
+        '''
+        if len(args):
+            self._d_recordField[astr_field] = args[0]
+        else:
+            return self._d_recordField.get(astr_field, '')
+
+
+    def record_emit(self, astr_msg, alevel):
+        '''
+        Write the structured record for <astr_msg> to the side channel.
+        Messages that only move the console cursor are not recorded.
+        '''
+        str_msg = Colors.strip(str(astr_msg))
+        if not len(str_msg.strip('\b')): return
+        d_record = {'time'      : time.time(),
+                    'pid'       : self._pid,
+                    'host'      : Message.hostname(),
+                    'process'   : self._processName,
+                    'tag'       : self._b_tag and self._str_tag or '',
+                    'level'     : alevel,
+                    'stage'     : ''}
+        d_record.update(self._d_recordField)
+        d_record['msg'] = str_msg
+        if self._str_recordFormat == 'msgpack':
+            str_record = msgpack.packb(d_record)
+        else:
+            str_record = json.dumps(d_record, separators = (',', ':')) + '\n'
+        self.output(self._recordHandle, str_record)
+
+
+    @staticmethod
+    def records_load(astr_file, ab_columns = False):
+        '''
+        Read back the structured records of <astr_file>, in either format.
+
+        Returns a list of record dictionaries or, if <ab_columns> is True,
+        a dictionary of per-field lists which is convenient for loading
+        into columnar tools (e.g. numpy or pandas).
+        '''
+        f = open(astr_file, 'rb')
+        str_head = f.read(1)
+        f.seek(0)
+        if str_head in ('{', ''):
+            l_record = [json.loads(str_line) for str_line in f if str_line.strip()]
+        else:
+            if msgpack is None:
+                raise ImportError('msgpack records need the msgpack module')
+            l_record = list(msgpack.Unpacker(f))
+        f.close()
+        if not ab_columns: return l_record
+        d_column = {}
+        for index, d_record in enumerate(l_record):
+            for key, value in d_record.iteritems():
+                d_column.setdefault(key, [None] * index).append(value)
+            for key in d_column:
+                if len(d_column[key]) <= index: d_column[key].append(None)
+        return d_column
+
+
+    def asyncWrite(self, *args):
+        '''
+        get/set the asynchronous write flag.
+
+        If True, messages are handed to a background AsyncWriter
+        thread, so that callers never wait on the disk (or network)
+        while writing. Use flush() to wait until all messages have been
+        written.
+
+        asyncWrite():           returns the current asyncWrite flag
+        asyncWrite(True|False): sets the flag to True|False
+
+        '''
+        if len(args):
+            if args[0] and self._writer is None:
+                self._writer = AsyncWriter()
+            if not args[0] and self._writer is not None:
+                self._writer.close()
+                self._writer = None
+        else:
+            return self._writer is not None
+
+
+    def flush(self):
+        '''
+        Wait until all messages have been written to their destinations.
+        '''
+        if self._writer is not None:    self._writer.flush()
+        else:                           self._sys_stdout.flush()
+        for sink in self._l_sink:       sink.handle.flush()
+
+
+    def close(self):
+        '''
+        Flush all messages, stop any writer thread and close the current
+        destination (unless it is the console).
+        '''
+        self.asyncWrite(False)
+        self.records('')
+        for str_name in self.sinks():   self.sink_remove(str_name)
+        if self._logHandle and self._logHandle != sys.stdout:
+            self._logHandle.close()
+        self._logHandle         = sys.stdout
+        self._sys_stdout        = sys.stdout
+        self._logFile           = 'stdout'
+
+
+    def emit(self, al_target, str_msg):
+        '''
+        Write <str_msg> to each (handle, strip) target in <al_target>.
+        Colour codes are stripped at most once, and with asyncWrite on,
+        the stripped text is what gets queued.
+        '''
+        str_plain = None
+        for handle, b_strip in al_target:
+            if b_strip:
+                if str_plain is None: str_plain = Colors.strip(str_msg)
+                self.output(handle, str_plain)
+            else:
+                self.output(handle, str_msg)
+
+
+    def output(self, handle, str_msg, ab_strip = False):
+        '''
+        Write <str_msg> to <handle>, either directly or through the
+        AsyncWriter.
+        '''
+        if self._writer is not None:
+            self._writer.write(handle, str_msg, ab_strip)
+            return
+        if ab_strip: str_msg = Colors.strip(str_msg)
+        handle.write(str_msg)
+        handle.flush()
+
+
+    def rotate(self, **kwargs):
+        '''
+        get/set the rotation of log files (see RotatingFile).
+
+        Applies to the current destination, if it is a file, and to any
+        file opened by to() or sink_add() afterwards.
+
+        rotate():               returns the current settings, or {} if
+                                log files are not rotated
+        rotate(**kwargs):       sets the rotation, where the kwargs are
+
+            maxBytes = <N>              roll over once larger than <N> bytes
+            interval = <secs>           roll over every <secs> seconds
+                                        (86400: daily at midnight UTC)
+            count = <N>                 number of rolled segments to keep
+                                        (default 5)
+            compress = True|False       gzip rolled segments (default False)
+
+        Rotation is turned off if neither <maxBytes> nor <interval> is set.
+
+        '''
+        if not len(kwargs): return dict(self._d_rotate)
+        self._d_rotate = {}
+        if kwargs.get('maxBytes') or kwargs.get('interval'):
+            self._d_rotate = dict(kwargs)
+        if isinstance(self._logFile, str) and \
+           isinstance(self._logHandle, (file, RotatingFile)) and \
+           self._logHandle not in (sys.stdout, sys.stderr):
+            self.to(self._logFile)
+
+
     def socket_parse(self, astr_destination):
         '''
         Examines <astr_destination> and if of form <str1>:<str2> assumes
@@ -163,6 +761,8 @@ class Message:
 
             string filenames:           '/tmp/test.log'
             remote hosts:               'pretoria:1701'
+            remote collectors:          'tcp://pretoria:1701'
+                                        'udp://pretoria:1701'
             system devices:             sys.stdout, sys.stderr
             special names:              'stdout'
             file handles:               open('/tmp/test.log')
@@ -170,22 +770,107 @@ class Message:
         '''
         if len(args):
             self._logFile = args[0]
+            if self._writer is not None:
+                self._writer.flush()
             if self._logHandle and self._logHandle != sys.stdout:
                 self._logHandle.close()
-            
-            if type(self._logFile) is types.FileType:
-                self._logHandle = self._logFile
-            elif self._logFile == 'stdout':
-                self._logHandle = sys.stdout
-            elif self.socket_parse(self._logFile):
-                self._logHandle = dgm.C_dgmsocket(
-                                            self._socketRemote,
-                                            int(self._socketPort))
-            else:
-                self._logHandle = open(self._logFile, "a")
+            self._logHandle       = self.handle_open(self._logFile)
             self._sys_stdout      = self._logHandle
         else:
             return self._logFile
+
+
+    def handle_open(self, destination):
+        '''
+        Returns a writable handle for <destination>, which is any of the
+        targets accepted by to().
+        '''
+        if type(destination) is types.FileType:
+            return destination
+        if destination == 'stdout':
+            return sys.stdout
+        if destination.startswith(('tcp://', 'udp://')) and \
+           self.socket_parse(destination[6:]):
+            # A coalescing, sequenced transport to a dgmcollect.py
+            # collector. Plain 'host:port' targets keep sending one
+            # raw datagram per message.
+            return dgm.C_dgmstream(self._socketRemote,
+                                   int(self._socketPort),
+                                   destination[:3])
+        if self.socket_parse(destination):
+            return dgm.C_dgmsocket(self._socketRemote, int(self._socketPort))
+        if len(self._d_rotate):
+            return RotatingFile(destination, **self._d_rotate)
+        return open(destination, "a")
+
+
+    def sink_add(self, destination, **kwargs):
+        '''
+        Add an additional destination ("sink") for messages, and return
+        its name.
+
+        <destination> is any of the targets accepted by to(), or 'ring'
+        for an in-memory RingBuffer of recent messages (see sink()).
+        Every message is rendered (and stripped of colour codes) only
+        once, however many sinks it goes to.
+
+        kwargs:
+            name = <name>               name of the sink (default: the
+                                        destination itself)
+            verbosity = <N>             only messages tagged with a debug
+                                        level of at most <N> (or not tagged
+                                        at all) are written to the sink. The
+                                        default of None writes everything
+            strip = True|False          strip colour codes (default: True
+                                        unless the sink is the console)
+            size = <N>                  number of messages kept by a 'ring'
+                                        sink (default 1000)
+
+        '''
+        str_name    = str(destination)
+        verbosity   = None
+        b_strip     = destination not in ('stdout', sys.stdout, sys.stderr)
+        size        = 1000
+        for key, value in kwargs.iteritems():
+            if key == 'name':       str_name    = value
+            if key == 'verbosity':  verbosity   = value
+            if key == 'strip':      b_strip     = value
+            if key == 'size':       size        = value
+        if destination == 'ring':   handle = RingBuffer(size)
+        else:                       handle = self.handle_open(destination)
+        self.sink_remove(str_name)
+        self._l_sink.append(Sink(str_name, handle, verbosity, b_strip,
+                                 handle not in (sys.stdout, sys.stderr, destination)))
+        return str_name
+
+
+    def sink_remove(self, astr_name):
+        '''
+        Remove (and close, if it was opened by sink_add()) the sink
+        named <astr_name>.
+        '''
+        for sink in list(self._l_sink):
+            if sink.name != astr_name: continue
+            if self._writer is not None: self._writer.flush()
+            self._l_sink.remove(sink)
+            if sink.b_own: sink.handle.close()
+
+
+    def sink(self, astr_name):
+        '''
+        Returns the handle of the sink named <astr_name> (e.g. to read
+        back a RingBuffer), or None.
+        '''
+        for sink in self._l_sink:
+            if sink.name == astr_name: return sink.handle
+        return None
+
+
+    def sinks(self):
+        '''
+        Returns the names of all additional sinks.
+        '''
+        return [sink.name for sink in self._l_sink]
             
             
     def vprintf(self, alevel, format, *args):
@@ -198,8 +883,69 @@ class Message:
 
     def canPrintVerbose(self, alevel):
         return int(self._verbosity) and int(alevel) <= int(self._verbosity)
+
+
+    def willEmit(self, alevel = 0):
+        '''
+        Returns True if a message tagged with debug level <alevel> would
+        be written anywhere, i.e. to a file or remote destination, to a
+        structured record side channel, or to the console given the
+        current verbosity.
+
+        Callers can use this to guard expensive message construction:
+
+            if log.willEmit(9): log(expensive_report(), debug=9)
+
+        '''
+        if self._recordHandle is not None:  return True
+        if self._logHandle != sys.stdout:   return True
+        if not alevel or self.canPrintVerbose(alevel): return True
+        for sink in self._l_sink:
+            if sink.accepts(alevel): return True
+        return False
+
+
+    @staticmethod
+    def render(al_args):
+        '''
+        Returns the message text for the positional arguments <al_args>
+        of a call: a format string followed by its arguments, a callable
+        that returns the text, or simply the text.
+        '''
+        if len(al_args) > 1:            return al_args[0] % tuple(al_args[1:])
+        if callable(al_args[0]):        return al_args[0]()
+        return al_args[0]
         
 
+    @staticmethod
+    def hostname():
+        '''
+        Returns the hostname, looked up once per process.
+        '''
+        if Message._str_hostname is None:
+            Message._str_hostname = os.uname()[1]
+        return Message._str_hostname
+
+
+    @staticmethod
+    def processName():
+        '''
+        Returns the name of the script being run, looked up once per
+        process. This is the script named on the command line or, if
+        there is none (e.g. an interactive session), the file of the
+        outermost stack frame.
+        '''
+        if Message._str_processName is None:
+            str_argv0 = getattr(sys, 'argv', None) and sys.argv[0] or ''
+            if str_argv0 not in ('', '-c', '-'):
+                Message._str_processName = os.path.basename(str_argv0)
+            else:
+                frame = sys._getframe()
+                while frame.f_back is not None: frame = frame.f_back
+                Message._str_processName = os.path.basename(frame.f_code.co_filename)
+        return Message._str_processName
+
+
     @staticmethod
     def syslog_generate(str_processName, str_pid):
       '''
@@ -209,10 +955,17 @@ class Message:
 
       where 'pretoria' is the hostname, 'message.py' is the current process
       name and 26873 is the current process id.
+
+      The string is cached, and only regenerated when the second or the
+      process changes.
       '''
-      localtime = time.asctime( time.localtime(time.time()) )      
-      hostname = os.uname()[1]
-      syslog = '%s %s %s[%s]' % (localtime, hostname, str_processName, str_pid)
+      now = int(time.time())
+      second, processName, pid, syslog = Message._t_syslog
+      if now != second or str_processName != processName or str_pid != pid:
+          localtime = time.asctime( time.localtime(now) )
+          syslog = '%s %s %s[%s]' % (localtime, Message.hostname(),
+                                     str_processName, str_pid)
+          Message._t_syslog = (now, str_processName, str_pid, syslog)
       return syslog
       
         
@@ -231,6 +984,16 @@ class Message:
             lw = <colWidth>             left justify message in <colWidth>
             rw = <colWidth>             right justify message in <colWidth>
 
+        The payload is either a single string, a format string followed
+        by its arguments, or a callable returning the string. The latter
+        two are only rendered if the message will actually be written
+        somewhere (see willEmit()), so that
+
+            log('vertex %d: %f\n', index, value, debug=9)
+            log(lambda: report(data), debug=9)
+
+        cost next to nothing when the verbosity filters them out.
+
         Typical calling syntax:
 
             log = Message()
@@ -283,6 +1046,11 @@ class Message:
             if key == 'rw':                             rw              = value
             if key == 'syslog':                         self._b_syslog  = value
 
+        if len(args) and not self.willEmit(verbosity):
+            self._b_syslog = b_syslog
+            return
+        if len(args): args = (self.render(args),)
+
         if self._b_tag and len(self._str_tag):
             str_prepend = Colors.LIGHT_CYAN + self._str_tag + ' ' + Colors.NO_COLOUR
 
@@ -292,26 +1060,32 @@ class Message:
             str_prepend = Colors.LIGHT_GRAY + self._str_syslog + Colors.NO_COLOUR
         if len(args):
             str_msg = '%s%s' % (str_prepend, args[0])
+            str_body = args[0]
 	else:
             str_msg = '%s%s' % (str_prepend, self._str_payload)
+            str_body = self._str_payload
             self._str_payload = ''
+        if self._recordHandle is not None:
+            self.record_emit(str_body, verbosity)
         if lw: str_msg  = '%*s' % (lw, str_msg)
         if rw: str_msg  = '%*s' % (rw, str_msg)
+        l_target = []
         if self._logHandle == sys.stdout:
             if verbosity:
                 if self.canPrintVerbose(verbosity):
-                    self._sys_stdout.write(str_msg)
+                    l_target.append((self._sys_stdout, False))
             else:
-                self._sys_stdout.write(str_msg)
+                l_target.append((self._sys_stdout, False))
         else:
-            self._sys_stdout.write(Colors.strip(str_msg))
-        self._sys_stdout.flush()
+            l_target.append((self._sys_stdout, True))
         if self._b_tee and self._logHandle != sys.stdout:
             if verbosity:
                 if self.canPrintVerbose(verbosity):
-                    sys.stdout.write(str_msg)
-            else: sys.stdout.write(str_msg)
-            sys.stdout.flush()
+                    l_target.append((sys.stdout, False))
+            else: l_target.append((sys.stdout, False))
+        for sink in self._l_sink:
+            if sink.accepts(verbosity): l_target.append((sink.handle, sink.b_strip))
+        self.emit(l_target, str_msg)
         self.syslog(b_syslog)    
 
         
@@ -339,6 +1113,10 @@ class Message:
             logTo = <destination>       set the <destination> that will print
                                         messages.
             tee = 0|1                   set the tee flag to 0|1
+            asyncWrite = True|False     write messages from a background
+                                        thread (see asyncWrite())
+            rotate = <dict>             rotate log files with the given
+                                        settings (see rotate())
 
         '''
 
@@ -363,9 +1141,17 @@ class Message:
         self._str_payload       = ''
         self._logFile           = 'stdout'
         self._logHandle         = None
+        self._writer            = None
+        self._l_sink            = []
+        self._d_rotate          = {}
+
+        # The optional structured record side channel. See records().
+        self._str_records       = ''
+        self._recordHandle      = None
+        self._str_recordFormat  = 'json'
+        self._d_recordField     = {}
 
-        self._processName       = os.path.basename(
-                                    inspect.stack()[-1][0].f_code.co_filename)
+        self._processName       = Message.processName()
         self._pid               = os.getpid()
 
         self.to(self._logFile)
@@ -373,6 +1159,12 @@ class Message:
             if key == "syslogPrepend":  self._b_syslog          = int(value)
             if key == "logTo":          self.to(value)
             if key == 'tee':            self._b_tee             = value
+            if key == 'asyncWrite':     self.asyncWrite(value)
+            if key == 'rotate':         self.rotate(**value)
+            if key == 'sinks':
+                for destination in value:   self.sink_add(destination)
+            if key == 'records':        self.records(value)
+            if key == 'recordFormat':   self.recordFormat(value)
             
         
 if __name__ == "__main__":
@@ -62,26 +62,10 @@ class FNNDSC_MRISCALC(base.FNNDSC):
     # across all instances of this class
     #
     _dictErr = {
-        'subjectSpecFail'   : {
-            'action'        : 'examining command line arguments, ',
-            'error'         : 'it seems that no subjects were specified.',
-            'exitCode'      : 10},
-        'noFreeSurferEnv'   : {
-            'action'        : 'examining environment, ',
-            'error'         : 'it seems that the FreeSurfer environment has not been sourced.',
-            'exitCode'      : 11},
-        'notClusterNode'    : {
-            'action'        : 'checking the execution environemt, ',
-            'error'         : 'script can only run on a cluster node.',
-            'exitCode'      : 12},
         'operandFilenotExist': {
             'action'        : 'examining the <operandFiles>, ',
             'error'         : 'the file does not exist.',
             'exitCode'      : 13},
-        'stageExec'         : {
-            'action'        : 'executing stage, ',
-            'error'         : 'an external error was detected.',
-            'exitCode'      : 30},
         'Load'              : {
             'action'        : 'attempting to pickle load object, ',
             'error'         : 'a PickleError occured.',
@@ -147,7 +131,7 @@ class FNNDSC_MRISCALC(base.FNNDSC):
         self._log('[ ok ]\n', debug=9, rw=self._rw, syslog=False)
             
         for str_operand in self._l_operands:
-            self._log('Checking on operand <%s>' % str_operand,
+            self._log('Checking on operand <%s>', str_operand,
                         debug=9, lw=self._lw)
             if os.path.isfile(str_operand):
                 self._log('[ ok ]\n', debug=9, rw=self._rw, syslog=False)
@@ -175,6 +159,7 @@ def synopsis(ab_shortOnly = False):
                             [--verbosity|-v <verboseLevel>]     \\
                             [--output | -o <outputFile>]        \\
                             [--stages|-s <stages>]                 \\
+                            [--profile <prefix>]                \\
                             --operation |-p <operation>       \\
                             <operand1> <operand2> ... <operandN>
     ''' % scriptName
@@ -187,6 +172,11 @@ def synopsis(ab_shortOnly = False):
         
     ARGS
 
+        --profile <prefix>
+        If specified, profile the run with a low-overhead sampling profiler
+        and write the collapsed stacks of each stage to
+        <prefix>.<stage>.collapsed, e.g. for rendering with 'flamegraph.pl'.
+
         --stages|-s <stages>
         The stages to execute. This is specified in a string, such as '1234'
         which would imply stages 1, 2, 3, and 4.
@@ -291,6 +281,11 @@ if __name__ == "__main__":
                         action='store',
                         default='add',
                         help='operation to perform over cumulative list of operands')
+    parser.add_argument('--profile',
+                        dest='profile',
+                        action='store',
+                        default='',
+                        help='file prefix for sampled profiles of each stage')
     args = parser.parse_args()
     
     # First, define the container pipeline
@@ -299,7 +294,8 @@ if __name__ == "__main__":
                         stages          = args.stages,
                         logTo           = 'MC.log',
                         syslog          = True,
-                        logTee          = True
+                        logTee          = True,
+                        sampleTo        = args.profile
                         )
     pipe_mrisCalc.verbosity(args.verbosity)
     pipeline    = pipe_mrisCalc.pipeline()
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+
+'''
+A low overhead statistical profiler.
+
+A timer signal periodically interrupts the process, and the stacks of
+all its threads are recorded. Stacks are counted per "label" -- the
+pipeline labels each thread with the name of the stage it is running
+(see Sampler.label()) -- and written as collapsed stacks, one file per
+label, that can be rendered directly as flame graphs:
+
+    s = sampler.Sampler(interval = 0.01)
+    s.start()
+    ...
+    s.stop()
+    for str_file in s.write('/tmp/run'):
+        os.system('flamegraph.pl %s > %s.svg' % (str_file, str_file))
+
+With the default 'cpu' clock, the timer only advances while the process
+is using the CPU, so the samples show where Python time goes. Threads
+that are blocked at the time (waiting on child processes, a scheduler,
+or I/O) show up under the frame they are waiting in. The 'wall' clock
+samples at regular wall-clock intervals instead, which also shows the
+time spent waiting while the process is otherwise idle.
+
+Unlike cProfile, the cost is a small constant per sample (by default
+100 per second), independent of how many Python calls are made.
+
+The sampler can only be started from the main thread. Interrupted
+system calls are restarted (see signal.siginterrupt()), but note that
+select() and similar calls may still fail with EINTR.
+
+'''
+
+import  os
+import  sys
+import  re
+import  signal
+import  thread
+
+
+class Sampler:
+    '''
+    kwargs:
+        interval                seconds between samples (default 0.01)
+        clock                   'cpu' (default) or 'wall'
+    '''
+
+    # The label of each thread, by thread id. This is shared by all
+    # samplers, so that threads can be labelled whether or not a
+    # sampler is running.
+    _d_label        = {}
+
+    _d_clock        = {
+        'cpu'       : (signal.ITIMER_PROF, signal.SIGPROF),
+        'wall'      : (signal.ITIMER_REAL, signal.SIGALRM)
+    }
+
+    def __init__(self, **kwargs):
+        self._interval          = 0.01
+        self._str_clock         = 'cpu'
+        for key, value in kwargs.iteritems():
+            if key == 'interval':   self._interval      = float(value)
+            if key == 'clock':      self._str_clock     = value
+        self._itimer, self._signum = Sampler._d_clock[self._str_clock]
+        self._d_stack           = {}
+        self._d_samples         = {}
+        self._handler           = None
+
+
+    @staticmethod
+    def label(*args):
+        '''
+        get/set the label of the calling thread.
+
+        label():                returns the current label (or None)
+        label(<name>):          labels the thread's samples <name>
+        label(None):            removes the label
+        '''
+        ident = thread.get_ident()
+        if len(args):
+            if args[0] is None: Sampler._d_label.pop(ident, None)
+            else:               Sampler._d_label[ident] = args[0]
+        else:
+            return Sampler._d_label.get(ident)
+
+
+    def start(self):
+        self._handler   = signal.signal(self._signum, self.sample)
+        signal.siginterrupt(self._signum, False)
+        signal.setitimer(self._itimer, self._interval, self._interval)
+
+
+    def stop(self):
+        if self._handler is None: return
+        signal.setitimer(self._itimer, 0)
+        signal.signal(self._signum, self._handler)
+        self._handler   = None
+
+
+    def sample(self, signum, frame):
+        '''
+        The signal handler: record the stack of every thread.
+
+        Threads without a label are attributed to the only labelled
+        thread if there is exactly one (e.g. the helper threads of a
+        stage in a serial pipeline), and to 'main' otherwise.
+        '''
+        if frame is not None and frame.f_code is Sampler.sample.im_func.func_code:
+            # A signal that arrived while a sample was being taken.
+            return
+        d_frame     = sys._current_frames()
+        # The handler runs in the main thread; sample the frame that it
+        # interrupted rather than the handler itself.
+        d_frame[thread.get_ident()] = frame
+        d_label     = Sampler._d_label
+        l_label     = list(set(d_label.values()))
+        str_default = 'main'
+        if len(l_label) == 1: str_default = l_label[0]
+        for ident, f in d_frame.iteritems():
+            l_code  = []
+            while f is not None:
+                l_code.append(f.f_code)
+                f = f.f_back
+            str_label   = d_label.get(ident, str_default)
+            d_stack     = self._d_stack.get(str_label)
+            if d_stack is None:
+                d_stack = self._d_stack[str_label] = {}
+            t_code      = tuple(l_code)
+            d_stack[t_code] = d_stack.get(t_code, 0) + 1
+        for str_label in set([d_label.get(i, str_default) for i in d_frame]):
+            self._d_samples[str_label] = self._d_samples.get(str_label, 0) + 1
+
+
+    @staticmethod
+    def frame_name(code):
+        return '%s (%s:%d)' % (code.co_name,
+                               os.path.basename(code.co_filename),
+                               code.co_firstlineno)
+
+
+    def collapsed(self, astr_label):
+        '''
+        Returns the stacks of <astr_label> in collapsed form, i.e. one
+        line per distinct stack, 'root;...;leaf <count>'.
+        '''
+        l_line = []
+        for t_code, count in self._d_stack.get(astr_label, {}).iteritems():
+            str_stack = ';'.join([self.frame_name(c) for c in reversed(t_code)])
+            l_line.append('%s %d\n' % (str_stack, count))
+        return ''.join(sorted(l_line))
+
+
+    def labels(self):
+        return sorted(self._d_stack.keys())
+
+
+    def summary(self):
+        '''
+        Returns a dictionary with the number of samples, and the
+        corresponding time in seconds, of each label.
+        '''
+        d_summary = {}
+        for str_label, samples in self._d_samples.iteritems():
+            d_summary[str_label] = {'samples'   : samples,
+                                    'seconds'   : samples * self._interval}
+        return d_summary
+
+
+    @staticmethod
+    def fileName(astr_prefix, astr_label):
+        '''
+        Returns the file to which write() writes the stacks of <astr_label>.
+        '''
+        return '%s.%s.collapsed' % (astr_prefix, re.sub(r'[^\w.-]+', '_', astr_label))
+
+
+    def write(self, astr_prefix):
+        '''
+        Write the collapsed stacks of each label to
+        <astr_prefix>.<label>.collapsed, and return the file names.
+        '''
+        l_file = []
+        for str_label in self.labels():
+            str_file = self.fileName(astr_prefix, str_label)
+            handle = open(str_file, 'w')
+            handle.write(self.collapsed(str_label))
+            handle.close()
+            l_file.append(str_file)
+        return l_file
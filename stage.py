@@ -1,35 +1,100 @@
 #!/usr/bin/env python
 
+import  os
 import  sys
 import  types
 import  time
+import  threading
+import  Queue
+import  hashlib
+import  json
+import  shlex
+import  subprocess
+import  select
+import  signal
+import  errno
+import  re
+import  collections
+import  resource
+import  csv
+import  itertools
+
+try:
+    import  pyinotify
+except ImportError:
+    pyinotify   = None
 
 from    _common         import crun
 from    _common._colors import Colors
 from    _common         import systemMisc       as misc
 
 import  message
+import  telemetry
+import  sampler
 import  inspect
 
 import  error
 
+def meminfo():
+    '''
+    Returns the contents of /proc/meminfo as a dictionary of values in
+    kB, e.g. meminfo()['MemAvailable']. Returns an empty dictionary on
+    systems without /proc/meminfo.
+    '''
+    d_meminfo = {}
+    try:
+        f = open('/proc/meminfo')
+        for str_line in f:
+            l_field = str_line.split()
+            if len(l_field) >= 2: d_meminfo[l_field[0].rstrip(':')] = int(l_field[1])
+        f.close()
+    except (IOError, ValueError):
+        pass
+    if 'MemAvailable' not in d_meminfo and 'MemFree' in d_meminfo:
+        # Older kernels do not report MemAvailable.
+        d_meminfo['MemAvailable'] = d_meminfo['MemFree'] + \
+                                    d_meminfo.get('Buffers', 0) + d_meminfo.get('Cached', 0)
+    return d_meminfo
+
+
+def cpu_count():
+    '''
+    Returns the number of online CPUs, or 1 if it cannot be determined.
+    '''
+    try:
+        return max(1, os.sysconf('SC_NPROCESSORS_ONLN'))
+    except (ValueError, OSError, AttributeError):
+        return 1
+
+
 class Pipeline:
     '''
     A thin wrapper that essentially strings several stages together
     in a pipeline, using the venerable python list as organizing container.
     The main advantage to using a pipeline as stage container is the
     simplification afforded to running stages selectively.
+
+    By default, stages are executed strictly in list order. If the number
+    of pipeline workers is set to more than one, the pipeline is treated
+    as a dependency graph: each stage waits only on the stages it declares
+    via stage.dependsOn(), and every stage whose dependencies are satisfied
+    is run concurrently, up to the number of workers. A stage that does not
+    declare any dependencies is assumed to depend on its predecessor in the
+    list, so that existing pipelines behave exactly as before.
+
+    Stages may also declare the CPUs and memory they need (see
+    stage.cpus() and stage.memMB()). A parallel pipeline only starts a
+    stage if the declared needs of all running stages plus the new one
+    fit within the pipeline budget (by default, the whole node), and if
+    the system currently reports enough available memory. A stage that
+    does not fit on its own is still run, but only when nothing else is
+    running.
+
+    The progress of a running pipeline can be polled as JSON from a local
+    HTTP (or Unix socket) endpoint; see telemetry() and status().
     '''
 
     _dictErr = {
-        'preconditions'     : {
-            'action'        : 'executing preconditions, ',
-            'error'         : 'a failure state was detected.',
-            'exitCode'      : 10},
-        'postconditions'    : {
-            'action'        : 'executing postconditions, ',
-            'error'         : 'a failure state was detected.',
-            'exitCode'      : 11},
         'stageNotFound'     : {
             'action'        : 'searching for a stage in the pipeline, ',
             'error'         : 'the stage was not found!',
@@ -37,7 +102,11 @@ class Pipeline:
         'stageError'        : {
             'action'        : 'executing a stage in the pipeline, ',
             'error'         : 'the stage reported an error condition.',
-            'exitCode'      : 13}
+            'exitCode'      : 13},
+        'stageCycle'        : {
+            'action'        : 'resolving stage dependencies in the pipeline, ',
+            'error'         : 'a dependency cycle was detected.',
+            'exitCode'      : 14}
     }
 
 
@@ -112,6 +181,253 @@ class Pipeline:
             return self.__name
 
 
+    def workers(self, *args):
+        '''
+        get/set the number of stages that can execute concurrently.
+
+        A value of 1 (the default) runs the pipeline serially, in list
+        order. Larger values run the pipeline as a dependency graph on
+        a bounded pool of worker threads.
+
+        workers():      returns the current number of workers
+        workers(<N>):   sets the number of workers to <N>
+
+        '''
+        if len(args):
+            self._workers = max(1, int(args[0]))
+        else:
+            return self._workers
+
+
+    def cpus(self, *args):
+        '''
+        get/set the CPU budget of the pipeline, i.e. the largest sum of
+        declared stage CPUs that can run concurrently. Defaults to the
+        number of CPUs on the node.
+
+        cpus():         returns the current CPU budget
+        cpus(<N>):      sets the CPU budget
+
+        '''
+        if len(args):
+            self._cpus = args[0]
+        else:
+            return self._cpus
+
+
+    def memMB(self, *args):
+        '''
+        get/set the memory budget (in MB) of the pipeline, i.e. the
+        largest sum of declared stage memory that can run concurrently.
+        Defaults to the total memory of the node.
+
+        memMB():        returns the current memory budget
+        memMB(<MB>):    sets the memory budget
+
+        '''
+        if len(args):
+            self._memMB = args[0]
+        else:
+            return self._memMB
+
+
+    def stage_admit(self, stage, al_running, ab_live = True):
+        '''
+        Returns True if <stage> can be started alongside the stages in
+        <al_running> without exceeding the CPU and memory budgets. If
+        <ab_live> is True, the memory currently available on the system
+        is also checked. An idle pipeline always admits a stage.
+        '''
+        if not len(al_running): return True
+        cpus    = sum([s.cpus() for s in al_running])
+        memMB   = sum([s.memMB() for s in al_running])
+        if cpus + stage.cpus() > self._cpus:        return False
+        if memMB + stage.memMB() > self._memMB:     return False
+        if ab_live and stage.memMB():
+            availMB = meminfo().get('MemAvailable', 0) / 1024
+            if availMB and stage.memMB() > availMB: return False
+        return True
+
+
+    def profiles(self):
+        '''
+        Returns the list of StageProfile records accumulated over all
+        stages executed by this pipeline.
+        '''
+        return self._l_profile
+
+
+    def profileTo(self, *args):
+        '''
+        get/set the file to which profiling records are exported at the
+        end of execute(). The format (JSON or CSV) follows the file
+        extension. An empty string (the default) disables the export.
+
+        profileTo():            returns the current profile file
+        profileTo(<file>):      sets the profile file
+
+        '''
+        if len(args):
+            self._str_profileTo = args[0]
+        else:
+            return self._str_profileTo
+
+
+    def profile_export(self, astr_file, astr_format = ''):
+        '''
+        Export the accumulated profiling records to <astr_file> as JSON
+        or CSV. See stage.profile_export().
+        '''
+        profile_export(self._l_profile, astr_file, astr_format)
+
+
+    def journal(self, *args):
+        '''
+        get/set the checkpoint journal of the pipeline.
+
+        The journal can be set either as a Journal object or as a file
+        name. Every stage start and finish is recorded in the journal.
+
+        journal():              returns the current Journal object (or None)
+        journal(<file>):        sets the journal to <file>
+
+        '''
+        if len(args):
+            self._journal = args[0]
+            if isinstance(self._journal, str):
+                self._journal = Journal(self._journal)
+        else:
+            return self._journal
+
+
+    def telemetry(self, *args):
+        '''
+        get/set the address of the telemetry endpoint, which serves the
+        status() of the pipeline as JSON (see the telemetry module).
+
+        telemetry():            returns the address served, or ''
+        telemetry(<address>):   serves on <address>, i.e. 'host:port',
+                                'port' or the path of a Unix socket
+        telemetry(''):          stops serving
+
+        '''
+        if len(args):
+            if self._telemetry is not None:
+                self._telemetry.close()
+                self._telemetry = None
+            if len(str(args[0])):
+                self._telemetry = telemetry.Server(self.status, args[0])
+                self._log(Colors.CYAN + 'Telemetry for pipeline ' +
+                          Colors.PURPLE + '<' + self.name() + '>' + Colors.NO_COLOUR +
+                          ' served on %s\n' % self._telemetry.address())
+        else:
+            if self._telemetry is None: return ''
+            return self._telemetry.address()
+
+
+    def stageTimes(self):
+        '''
+        Returns the (start, end) times of each stage that has run, by
+        stage name. The end time is None while the stage is running.
+        '''
+        return dict([(stage.name(), tuple(t_time)) for stage, t_time in
+                     self._d_stageTime.iteritems()])
+
+
+    def status(self):
+        '''
+        Returns a dictionary describing the progress of the pipeline:
+        the state of each stage, its elapsed time, the counts of its
+        (cluster or fan-out) jobs as far as they are known (see
+        Stage.jobs()) and its throughput in completed jobs per minute,
+        together with totals over the whole pipeline.
+        '''
+        now         = time.time()
+        d_state     = {}
+        d_jobs      = {}
+        l_stage     = []
+        l_running   = []
+        for stage in self._pipeline:
+            str_state   = self._d_stageState.get(stage)
+            if str_state is None:
+                if stage.canRun():  str_state = 'pending'
+                else:               str_state = 'skipped'
+            d_state[str_state] = d_state.get(str_state, 0) + 1
+            if str_state == 'running': l_running.append(stage)
+            elapsed     = 0.0
+            t_time      = self._d_stageTime.get(stage)
+            if t_time is not None: elapsed = (t_time[1] or now) - t_time[0]
+            d_stageJobs = stage.jobs()
+            for key, value in d_stageJobs.iteritems():
+                if isinstance(value, (int, long)): d_jobs[key] = d_jobs.get(key, 0) + value
+            completed   = d_stageJobs.get('completed', 0)
+            throughput  = 0.0
+            if elapsed and isinstance(completed, (int, long)):
+                throughput = completed * 60.0 / elapsed
+            l_stage.append({
+                'name'          : stage.name(),
+                'state'         : str_state,
+                'elapsed'       : round(elapsed, 3),
+                'jobs'          : d_stageJobs,
+                'throughput'    : round(throughput, 3)})
+        l_running.sort(key = lambda s: self._d_stageTime[s][0])
+        elapsed     = 0.0
+        if self._startTime: elapsed = now - self._startTime
+        throughput  = 0.0
+        if elapsed: throughput = d_jobs.get('completed', 0) * 60.0 / elapsed
+        return {
+            'pipeline'      : self.name(),
+            'host'          : message.Message.hostname(),
+            'pid'           : os.getpid(),
+            'time'          : now,
+            'elapsed'       : round(elapsed, 3),
+            'current'       : [s.name() for s in l_running],
+            'stages'        : d_state,
+            'jobs'          : d_jobs,
+            'throughput'    : round(throughput, 3),
+            'stage'         : l_stage}
+
+
+    def resume(self, *args):
+        '''
+        get/set the resume flag.
+
+        If True, stages with a valid completion record in the journal are
+        skipped, so that a failed run can simply be restarted.
+
+        resume():               returns the current resume flag
+        resume(True|False):     sets the flag to True|False
+
+        '''
+        if len(args):
+            self._b_resume = args[0]
+        else:
+            return self._b_resume
+
+
+    def stage_isComplete(self, stage):
+        '''
+        Returns True if <stage> can be skipped because the pipeline is
+        resuming and the journal holds a valid completion record for it.
+
+        This is only a check, see stage_skipComplete() for skipping.
+        '''
+        if not self._b_resume or self._journal is None: return False
+        return self._journal.completed(stage)
+
+
+    def stage_skipComplete(self, stage):
+        '''
+        Returns True, after marking <stage> as skipped, if it is complete
+        (see stage_isComplete()).
+        '''
+        if not self.stage_isComplete(stage): return False
+        self._d_stageState[stage] = 'skipped'
+        self._log(Colors.YELLOW + 'Stage: ' + stage.name() + Colors.NO_COLOUR +
+                  ' already completed according to journal, skipping.\n')
+        return True
+
+
     def __init__(self, **kwargs):
         '''
         Constructor
@@ -122,8 +438,28 @@ class Pipeline:
         self._verbosity         = 0
         self._b_poststdout      = False
         self._b_poststderr      = False
+        self._workers           = 1
+        self._cpus              = cpu_count()
+        self._memMB             = meminfo().get('MemTotal', 0) / 1024 or sys.maxint
+        self._l_profile         = []
+        self._str_profileTo     = ''
+        self._journal           = None
+        self._b_resume          = False
+
+        # Progress as served by the telemetry endpoint. See status().
+        self._startTime         = 0
+        self._d_stageState      = {}
+        self._d_stageTime       = {}
+        self._telemetry         = None
         for key, value in kwargs.iteritems():
             if key == 'name':               self.name(value)
+            if key == 'workers':            self.workers(value)
+            if key == 'cpus':               self.cpus(value)
+            if key == 'memMB':              self.memMB(value)
+            if key == 'profileTo':          self.profileTo(value)
+            if key == 'journal':            self.journal(value)
+            if key == 'resume':             self.resume(value)
+            if key == 'telemetry':          self.telemetry(value)
             if key == 'fatalConditions':    self.fatalConditions(value)
             if key == 'syslog':             self.log().syslog(value)
             if key == 'verbosity':          self.verbosity(value)
@@ -174,35 +510,336 @@ class Pipeline:
         for stage in self._pipeline:
             stage.canRun(value)
 
+    def stage_dependencies(self, stage):
+        '''
+        Return the list of stage objects that <stage> depends on.
+
+        Dependencies are declared by name (or by object) with
+        stage.dependsOn(). A stage that has not declared any dependencies
+        depends on its immediate predecessor in the pipeline list.
+
+        '''
+        l_depends = stage.dependsOn()
+        if l_depends is None:
+            index = self._pipeline.index(stage)
+            if index: return [self._pipeline[index-1]]
+            return []
+        l_stage = []
+        for depend in l_depends:
+            if isinstance(depend, Stage):   l_stage.append(depend)
+            else:                           l_stage.append(self.stage_get(depend))
+        return l_stage
+
+
+    def stage_execute(self, stage):
+        '''
+        Run a single <stage> and log its stage specific output.
+
+        '''
+        self._log(Colors.YELLOW + 'Stage: ' + stage.name() + '\n' + Colors.NO_COLOUR)
+        if self._journal is not None: self._journal.start(stage)
+        self._d_stageTime[stage]    = [time.time(), None]
+        self._d_stageState[stage]   = 'running'
+        sampler.Sampler.label(stage.name())
+        try:
+            stage(checkpreconditions=True, runstage=True, checkpostconditions=True)
+        except BaseException, e:
+            self._d_stageTime[stage][1] = time.time()
+            self._d_stageState[stage]   = 'failed'
+            if self._journal is not None and isinstance(e, SystemExit):
+                self._journal.finish(stage, e.code or 1)
+            raise
+        finally:
+            sampler.Sampler.label(None)
+        self._d_stageTime[stage][1] = time.time()
+        exitCode = stage.exitCode() or stage.failCode()
+        if exitCode:    self._d_stageState[stage] = 'failed'
+        else:           self._d_stageState[stage] = 'done'
+        if self._journal is not None: self._journal.finish(stage, exitCode)
+        stage.profile_close()
+        if stage.profile() is not None:
+            stage.profile()['pipeline'] = self.name()
+            self._l_profile.append(stage.profile())
+        log = stage.log()
+        if self._b_poststdout:
+            log(Colors.LIGHT_GREEN + 'stage specific stdout:\n' + Colors.NO_COLOUR)
+            if not len(stage.stdout()):
+                log(Colors.LIGHT_GREEN + '\t\t(no stage specific stdout)\n' + Colors.NO_COLOUR)
+            else:
+                log('\n' + Colors.LIGHT_GREEN + stage.stdout() + Colors.NO_COLOUR)
+        if self._b_poststderr:
+            log(Colors.LIGHT_RED + 'stage specific stderr:\n' + Colors.NO_COLOUR)
+            if not len(stage.stdout()):
+                log(Colors.LIGHT_RED + '\t\t(no stage specific stderr)\n' + Colors.NO_COLOUR)
+            else:
+                log('\n' + Colors.LIGHT_RED + stage.stderr() + Colors.NO_COLOUR)
+
+
     def execute(self):
         '''
         Run the pipeline, stage by stage.
         '''
         self._log(  Colors.CYAN + 'Executing pipeline ' +
                     Colors.PURPLE +  '<'+self.name()+'>' + Colors.NO_COLOUR + '...\n')
-        for stage in self._pipeline:
-          if stage.canRun():
-            self._log(Colors.YELLOW + 'Stage: ' + stage.name() + '\n' + Colors.NO_COLOUR)
-            stage(checkpreconditions=True, runstage=True, checkpostconditions=True)
-            log = stage.log()
-            if self._b_poststdout:
-                log(Colors.LIGHT_GREEN + 'stage specific stdout:\n' + Colors.NO_COLOUR)
-                if not len(stage.stdout()):
-                    log(Colors.LIGHT_GREEN + '\t\t(no stage specific stdout)\n' + Colors.NO_COLOUR)
-                else:
-                    log('\n' + Colors.LIGHT_GREEN + stage.stdout() + Colors.NO_COLOUR)
-            if self._b_poststderr:
-                log(Colors.LIGHT_RED + 'stage specific stderr:\n' + Colors.NO_COLOUR)
-                if not len(stage.stdout()):
-                    log(Colors.LIGHT_RED + '\t\t(no stage specific stderr)\n' + Colors.NO_COLOUR)
-                else:
-                    log('\n' + Colors.LIGHT_RED + stage.stderr() + Colors.NO_COLOUR)
-            if stage.exitCode():
-                error.fatal(self, 'stageError', '%s' % stage.name())
+        self._startTime = time.time()
+        try:
+            if self._workers > 1:
+                self.execute_parallel()
+            else:
+                for stage in self._pipeline:
+                  if stage.canRun() and not self.stage_skipComplete(stage):
+                    self.stage_execute(stage)
+                    if stage.exitCode():
+                        error.fatal(self, 'stageError', '%s' % stage.name(), stage = stage.name())
+        finally:
+            # Profiles are also exported when a stage exits to the system,
+            # since failing runs are often the interesting ones.
+            if len(self._str_profileTo):
+                self.profile_export(self._str_profileTo)
         self._log(  Colors.CYAN + 'Terminating pipeline ' +
                     Colors.PURPLE +  '<'+self.name()+'>' + Colors.NO_COLOUR + '\n')
 
 
+    def execute_parallel(self):
+        '''
+        Run the pipeline as a dependency graph.
+
+        Each stage is dispatched to a worker thread as soon as all of its
+        dependencies have completed, with at most self.workers() stages
+        running at any time. Stages with their canRun flag off are not
+        executed, but count as completed for the purposes of dependency
+        resolution -- exactly as if the pipeline were run serially. The same
+        holds for stages skipped on resume.
+
+        If any stage exits to the system (for example on a failed pre- or
+        postcondition with fatalConditions set) or reports a non-zero exit
+        code, no further stages are dispatched. Stages already running are
+        allowed to finish, after which the failure is handled as in the
+        serial case.
+
+        Stages that are ready but do not fit in the remaining resources
+        (see stage_admit()) wait, and are reconsidered whenever a running
+        stage completes, or every few seconds as live memory changes.
+
+        '''
+        d_depends       = {}
+        for stage in self._pipeline:
+            d_depends[stage] = self.stage_dependencies(stage)
+        l_deferred      = []
+
+        l_pending       = list(self._pipeline)
+        l_done          = []
+        l_running       = []
+        queue_done      = Queue.Queue()
+        exit_system     = None
+        stage_failed    = None
+
+        def worker(stage):
+            exc = None
+            try:
+                self.stage_execute(stage)
+            except SystemExit, e:
+                exc = e
+            except BaseException, e:
+                exc = error.error_make(self, 'stageError', repr(e), stage = stage.name())
+                stage.log()('%s\n' % repr(e))
+            queue_done.put((stage, exc))
+
+        while len(l_pending) or len(l_running):
+            b_dispatched = True
+            while b_dispatched and exit_system is None and stage_failed is None:
+                b_dispatched = False
+                for stage in list(l_pending):
+                    if len(l_running) >= self._workers: break
+                    if [s for s in d_depends[stage] if s not in l_done]: continue
+                    if not stage.canRun() or self.stage_skipComplete(stage):
+                        l_pending.remove(stage)
+                        l_done.append(stage)
+                        b_dispatched = True
+                        continue
+                    if not self.stage_admit(stage, l_running):
+                        if stage not in l_deferred:
+                            l_deferred.append(stage)
+                            self._log(Colors.YELLOW + 'Stage: ' + stage.name() +
+                                      Colors.NO_COLOUR + ' waiting for resources ' +
+                                      '(%s cpus, %s MB).\n' % (stage.cpus(), stage.memMB()))
+                        continue
+                    l_pending.remove(stage)
+                    b_dispatched = True
+                    l_running.append(stage)
+                    thread = threading.Thread(target = worker, args = (stage,))
+                    thread.daemon = True
+                    thread.start()
+            if not len(l_running):
+                if len(l_pending) and exit_system is None and stage_failed is None:
+                    str_cycle = ', '.join([s.name() for s in l_pending])
+                    error.fatal(self, 'stageCycle', str_cycle)
+                break
+            try:
+                stage, exc = queue_done.get(timeout = 5)
+            except Queue.Empty:
+                continue
+            l_running.remove(stage)
+            l_done.append(stage)
+            if exc is not None:
+                if exit_system is None: exit_system = exc
+            elif stage.exitCode():
+                if stage_failed is None: stage_failed = stage
+
+        if exit_system is not None:
+            raise exit_system
+        if stage_failed is not None:
+            error.fatal(self, 'stageError', '%s' % stage_failed.name(), stage = stage_failed.name())
+
+
+    def plan(self, **kwargs):
+        '''
+        Estimate the cost of running the pipeline, without executing
+        any stage.
+
+        Each stage that would run is assigned a duration by a CostModel
+        built from historical profiling records, scaled by the current
+        size of the stage's input files. The stage graph is then walked
+        to find the critical path (the chain of dependent stages with the
+        largest total duration), and the dispatch of execute_parallel() is
+        replayed on the estimates to give the expected wall time at the
+        requested number of workers (and within the pipeline's declared
+        resource budget). A report is written to the pipeline log.
+
+        kwargs:
+
+            history     A CostModel, a list of profiling records, or a
+                        profile file name (or list of names) as written
+                        via profileTo().
+            workers     Number of workers to plan for (default: the
+                        pipeline's own setting).
+
+        Returns a dictionary with the keys 'stages' (a list of per-stage
+        dictionaries in pipeline order), 'criticalPath' (a list of stage
+        names), 'criticalTime', 'work' (the sum of all durations),
+        'wall' (the expected wall time) and 'workers'.
+
+        '''
+        model       = CostModel()
+        workers     = self._workers
+        for key, value in kwargs.iteritems():
+            if key == 'workers':    workers = max(1, int(value))
+            if key == 'history':
+                if isinstance(value, CostModel):    model = value
+                elif isinstance(value, str) or \
+                     (len(value) and isinstance(value[0], str)):
+                                                    model = CostModel(profile_load(value))
+                else:                               model = CostModel(value)
+
+        d_depends   = {}
+        d_duration  = {}
+        d_basis     = {}
+        for stage in self._pipeline:
+            d_depends[stage] = self.stage_dependencies(stage)
+            if not stage.canRun() or self.stage_isComplete(stage):
+                d_duration[stage], d_basis[stage] = 0.0, 'skipped'
+            else:
+                d_duration[stage], d_basis[stage] = \
+                    model.estimate(stage.name(), stage.inputBytes())
+
+        # Critical path: longest finish time over a topological order.
+        d_finish    = {}
+        d_previous  = {}
+        l_pending   = list(self._pipeline)
+        while len(l_pending):
+            l_ready = [s for s in l_pending
+                       if not [d for d in d_depends[s] if d not in d_finish]]
+            if not len(l_ready):
+                str_cycle = ', '.join([s.name() for s in l_pending])
+                error.fatal(self, 'stageCycle', str_cycle)
+            for stage in l_ready:
+                l_pending.remove(stage)
+                start, d_previous[stage] = 0.0, None
+                for depend in d_depends[stage]:
+                    if d_finish[depend] > start or d_previous[stage] is None:
+                        start, d_previous[stage] = d_finish[depend], depend
+                d_finish[stage] = start + d_duration[stage]
+        l_critical  = []
+        if len(self._pipeline):
+            stage = max(reversed(self._pipeline), key = lambda s: d_finish[s])
+            while stage is not None:
+                l_critical.insert(0, stage)
+                stage = d_previous[stage]
+        criticalTime = len(l_critical) and d_finish[l_critical[-1]] or 0.0
+
+        # Wall time: replay the dispatch of execute_parallel().
+        d_start     = {}
+        d_end       = {}
+        l_pending   = list(self._pipeline)
+        l_running   = []
+        now         = 0.0
+        while len(l_pending) or len(l_running):
+            b_dispatched = True
+            while b_dispatched:
+                b_dispatched = False
+                for stage in list(l_pending):
+                    if len(l_running) >= workers: break
+                    if [s for s in d_depends[stage] if s not in d_end]: continue
+                    if d_basis[stage] != 'skipped' and \
+                       not self.stage_admit(stage, l_running, ab_live = False):
+                        continue
+                    l_pending.remove(stage)
+                    b_dispatched    = True
+                    d_start[stage]  = now
+                    if d_basis[stage] == 'skipped':
+                        d_end[stage] = now
+                        continue
+                    l_running.append(stage)
+            if not len(l_running): break
+            stage = min(l_running, key = lambda s: d_start[s] + d_duration[s])
+            l_running.remove(stage)
+            now = d_start[stage] + d_duration[stage]
+            d_end[stage] = now
+        wall        = max([0.0] + d_end.values())
+        work        = sum(d_duration.values())
+
+        l_stage     = []
+        for stage in self._pipeline:
+            l_stage.append({'stage'     : stage.name(),
+                            'estimate'  : d_duration[stage],
+                            'basis'     : d_basis[stage],
+                            'start'     : d_start[stage],
+                            'end'       : d_end[stage],
+                            'critical'  : stage in l_critical})
+        d_plan      = { 'stages'        : l_stage,
+                        'criticalPath'  : [s.name() for s in l_critical],
+                        'criticalTime'  : criticalTime,
+                        'work'          : work,
+                        'wall'          : wall,
+                        'workers'       : workers}
+        self.plan_report(d_plan)
+        return d_plan
+
+
+    def plan_report(self, ad_plan):
+        '''
+        Write the result of plan() to the pipeline log.
+        '''
+        self._log(  Colors.CYAN + 'Plan for pipeline ' +
+                    Colors.PURPLE + '<' + self.name() + '>' + Colors.NO_COLOUR +
+                    ' at %d worker(s) (nothing is executed):\n' % ad_plan['workers'])
+        self._log('\t%-32s %12s %12s %12s  %s\n' % \
+                  ('stage', 'estimate (s)', 'start (s)', 'end (s)', 'basis'))
+        for d_stage in ad_plan['stages']:
+            str_colour = d_stage['critical'] and Colors.LIGHT_RED or Colors.NO_COLOUR
+            self._log('\t' + str_colour + '%-32s %12.1f %12.1f %12.1f  %s' % \
+                      (d_stage['stage'], d_stage['estimate'], d_stage['start'],
+                       d_stage['end'], d_stage['basis']) + Colors.NO_COLOUR + '\n')
+        self._log('\tcritical path:      %s\n' % ' -> '.join(ad_plan['criticalPath']))
+        self._log('\tcritical path time: %.1f seconds\n' % ad_plan['criticalTime'])
+        self._log('\ttotal stage time:   %.1f seconds\n' % ad_plan['work'])
+        self._log('\texpected wall time: %.1f seconds\n' % ad_plan['wall'])
+        l_unknown = [d['stage'] for d in ad_plan['stages'] if d['basis'] == 'no history']
+        if len(l_unknown):
+            self._log(Colors.YELLOW + '\tno timing history for: %s\n' % \
+                      ', '.join(l_unknown) + Colors.NO_COLOUR)
+
+
     def fatalConditions(self, *args):
         '''
         get/set the fatalConditions flag.
@@ -221,6 +858,1309 @@ class Pipeline:
             return self._b_fatalConditions
 
 
+class Backoff:
+    '''
+    An adaptive exponential backoff for polling loops.
+
+    Each call to next() returns the next interval to wait, starting at
+    <initial> seconds and growing by <factor> up to <maximum>. Whenever
+    the caller observes a change in the state being polled it should
+    call reset(), so that polling is fast while things are happening
+    and slows down only while nothing changes.
+    '''
+
+    def __init__(self, **kwargs):
+        self._initial           = 1.0
+        self._factor            = 2.0
+        self._maximum           = 60.0
+        for key, value in kwargs.iteritems():
+            if key == 'initial':    self._initial       = float(value)
+            if key == 'factor':     self._factor        = float(value)
+            if key == 'maximum':    self._maximum       = float(value)
+        self._initial           = min(self._initial, self._maximum)
+        self._interval          = self._initial
+
+
+    def reset(self):
+        self._interval          = self._initial
+
+
+    def next(self):
+        interval                = self._interval
+        self._interval          = min(self._interval * self._factor, self._maximum)
+        return interval
+
+
+class RetryPolicy:
+    '''
+    Decides whether a failed command is tried again, and how long to
+    wait in between.
+
+    A command is retried while its exit code is retryable and fewer than
+    <maxAttempts> attempts have been made. The waits between attempts
+    grow exponentially (see Backoff). For example, to retry transient
+    ssh failures (exit code 255) up to twice:
+
+        RetryPolicy(maxAttempts = 3, retryOn = [255], initial = 10)
+
+    kwargs:
+        maxAttempts             total number of attempts, including the
+                                first one (default 1, i.e. no retries)
+        retryOn                 the exit codes worth retrying. None (the
+                                default) retries any non-zero exit code
+        initial, factor,        the backoff between attempts, in seconds;
+        maximum                 see Backoff
+    '''
+
+    def __init__(self, **kwargs):
+        self._maxAttempts       = 1
+        self._l_retryOn         = None
+        self._d_backoff         = {}
+        for key, value in kwargs.iteritems():
+            if key == 'maxAttempts':    self._maxAttempts       = max(1, int(value))
+            if key == 'retryOn':        self._l_retryOn         = value
+            if key in ('initial', 'factor', 'maximum'):
+                self._d_backoff[key] = value
+
+
+    def maxAttempts(self):
+        return self._maxAttempts
+
+
+    def backoff(self):
+        '''
+        Returns a new Backoff for the waits between the attempts of one
+        command.
+        '''
+        return Backoff(**self._d_backoff)
+
+
+    def retryable(self, exitCode):
+        '''
+        Returns True if a command that exited with <exitCode> is worth
+        another attempt.
+        '''
+        if not exitCode: return False
+        if self._l_retryOn is None: return True
+        return exitCode in self._l_retryOn
+
+
+    def __call__(self, f_attempt, log = None):
+        '''
+        Call <f_attempt>(<attempt>) until it returns an exit code that
+        is not retryable, or the attempts are used up. Returns the tuple
+        (last exitCode, number of attempts).
+        '''
+        backoff = self.backoff()
+        attempt = 0
+        while True:
+            attempt += 1
+            exitCode = f_attempt(attempt)
+            if attempt >= self._maxAttempts or not self.retryable(exitCode):
+                return exitCode, attempt
+            wait = backoff.next()
+            if log is not None:
+                log(Colors.YELLOW + 'Attempt %d of %d failed with exit code %s, ' % \
+                    (attempt, self._maxAttempts, exitCode) + \
+                    'retrying in %.1f seconds.\n' % wait + Colors.NO_COLOUR)
+            time.sleep(wait)
+
+
+class SchedulerQuery:
+    '''
+    Shared, rate limited scheduler queries.
+
+    All stages waiting on the same scheduler share one query result:
+    if a result for a given scheduler and process is younger than
+    <maxAge> seconds it is returned directly, and concurrent callers
+    asking for the same result wait on a single query rather than each
+    querying the scheduler themselves.
+
+    Two kinds of query are supported:
+
+        queueInfo()     the crun scheduler shell queueInfo() call
+        listing()       the output of a single listing shell command
+                        (for example 'mosq listall'), which is then
+                        filtered in Python for any number of processes,
+                        rather than forking a grep/wc pipeline per process
+    '''
+
+    _d_result           = {}
+    _d_lock             = {}
+    _lock               = threading.Lock()
+
+    @staticmethod
+    def scheduler_key(shell):
+        '''
+        Returns a key that identifies the scheduler behind <shell>.
+        '''
+        str_cluster = ''
+        if hasattr(shell, 'clusterName'): str_cluster = shell.clusterName()
+        return (shell.__class__.__name__, str_cluster,
+                getattr(shell, '_str_remoteHost', ''))
+
+
+    @classmethod
+    def query(cls, key, f_query, maxAge):
+        '''
+        Return the result of f_query(), shared under <key> for <maxAge>
+        seconds.
+        '''
+        cls._lock.acquire()
+        lock = cls._d_lock.setdefault(key, threading.Lock())
+        cls._lock.release()
+        lock.acquire()
+        try:
+            if key in cls._d_result:
+                stamp, result = cls._d_result[key]
+                if time.time() - stamp < maxAge: return result
+            result = f_query()
+            cls._d_result[key] = (time.time(), result)
+            return result
+        finally:
+            lock.release()
+
+
+    @classmethod
+    def queueInfo(cls, shell, astr_blockProcess, maxAge = 1.0):
+        key = ('queueInfo', cls.scheduler_key(shell), astr_blockProcess)
+        return cls.query(key,
+                         lambda: shell.queueInfo(blockProcess=astr_blockProcess),
+                         maxAge)
+
+
+    @classmethod
+    def listing(cls, astr_listCmd, maxAge = 1.0):
+        def f_query():
+            shell = crun.crun()
+            shell(astr_listCmd)
+            return shell.stdout()
+        return cls.query(('listing', astr_listCmd), f_query, maxAge)
+
+
+class Blocker:
+    '''
+    The base blocking backend.
+
+    A blocker repeatedly evaluates a condition until it is satisfied,
+    waiting between evaluations according to a Backoff. Sub-classes
+    implement poll(), which returns a tuple (b_done, str_status), and
+    may also record the job counts behind the status (see jobs()). The
+    backoff is reset every time the status changes.
+    '''
+
+    def __init__(self, **kwargs):
+        self._backoff           = Backoff()
+        self._settle            = 0
+        self._blockTime         = 0.0
+        self._d_jobs            = {}
+        for key, value in kwargs.iteritems():
+            if key == 'backoff':    self._backoff       = value
+            if key == 'settle':     self._settle        = value
+
+
+    def poll(self):
+        return True, ''
+
+
+    def blockTime(self):
+        '''
+        Returns the total time (in seconds) spent in block().
+        '''
+        return self._blockTime
+
+
+    def jobs(self):
+        '''
+        Returns the job counts found by the most recent poll(), e.g.
+        {'pending': 3, 'running': 8}, or {} if the backend has none.
+        '''
+        return dict(self._d_jobs)
+
+
+    @staticmethod
+    def count(astr_count):
+        try:
+            return int(astr_count)
+        except (TypeError, ValueError):
+            return astr_count
+
+
+    def wait(self, afinterval):
+        time.sleep(afinterval)
+
+
+    def block(self, stage, astr_blockMsg = '', astr_loopMsg = ''):
+        '''
+        Block until poll() is satisfied, logging progress to the <stage>
+        log. Returns True.
+        '''
+        startTime           = time.time()
+        if self._settle: time.sleep(self._settle)
+        b_done, str_status  = self.poll()
+        stage.jobs(self.jobs())
+        if not b_done:
+            self._backoff.reset()
+            stage.log()(Colors.CYAN + astr_blockMsg + Colors.NO_COLOUR)
+            while not b_done:
+                self.wait(self._backoff.next())
+                b_done, str_newStatus = self.poll()
+                stage.jobs(self.jobs())
+                if str_newStatus != str_status: self._backoff.reset()
+                str_status  = str_newStatus
+                if b_done:
+                    stage.log()('\n', syslog=False)
+                else:
+                    stage.blockLoopMsg_show(
+                        '(block duration = %ds; %s) ' % (time.time() - startTime, str_status),
+                        astr_loopMsg)
+        self._blockTime     += time.time() - startTime
+        return True
+
+
+class SchedulerBlocker(Blocker):
+    '''
+    Blocks on jobs in a crun scheduler shell (or a FakeScheduler) until
+    no <blockProcess> jobs are pending or running.
+    '''
+
+    def __init__(self, shell, **kwargs):
+        Blocker.__init__(self, **kwargs)
+        self._shell             = shell
+        self._str_blockProcess  = ''
+        self._str_blockUntil    = '0'
+        self._maxAge            = 1.0
+        for key, value in kwargs.iteritems():
+            if key == 'blockProcess':   self._str_blockProcess  = value
+            if key == 'blockUntil':     self._str_blockUntil    = value
+            if key == 'maxAge':         self._maxAge            = value
+
+
+    def poll(self):
+        str_pending, str_running, str_scheduled, str_completed = \
+            SchedulerQuery.queueInfo(self._shell, self._str_blockProcess, self._maxAge)
+        self._d_jobs = {
+            'pending'   : self.count(str_pending),
+            'running'   : self.count(str_running),
+            'completed' : self.count(str_completed),
+            'scheduled' : self.count(str_scheduled)}
+        b_done = str_running == self._str_blockUntil and \
+                 str_pending == self._str_blockUntil
+        return b_done, 'pending/running/completed/scheduled = %s/%s/%s/%s' % \
+                        (str_pending, str_running, str_completed, str_scheduled)
+
+
+class ListingBlocker(Blocker):
+    '''
+    Blocks until no line of a (shared) scheduler listing contains
+    <blockProcess>. Running jobs are counted as lines that also contain
+    <runningTag>.
+    '''
+
+    def __init__(self, **kwargs):
+        Blocker.__init__(self, **kwargs)
+        self._str_listCmd       = 'mosq listall'
+        self._str_blockProcess  = ''
+        self._str_runningTag    = 'RUN'
+        self._maxAge            = 1.0
+        for key, value in kwargs.iteritems():
+            if key == 'listCmd':        self._str_listCmd       = value
+            if key == 'blockProcess':   self._str_blockProcess  = value
+            if key == 'runningTag':     self._str_runningTag    = value
+            if key == 'maxAge':         self._maxAge            = value
+
+
+    def poll(self):
+        str_listing = SchedulerQuery.listing(self._str_listCmd, self._maxAge)
+        l_jobs      = [l for l in str_listing.splitlines() if self._str_blockProcess in l]
+        l_running   = [l for l in l_jobs if self._str_runningTag in l]
+        self._d_jobs = {'running': len(l_running), 'scheduled': len(l_jobs)}
+        return not len(l_jobs), 'running/scheduled = %d/%d' % (len(l_running), len(l_jobs))
+
+
+class ShellCmdBlocker(Blocker):
+    '''
+    Blocks until the stripped stdout of <shellCmd> equals <shellReturn>.
+    '''
+
+    def __init__(self, **kwargs):
+        Blocker.__init__(self, **kwargs)
+        self._shell             = crun.crun()
+        self._str_shellCmd      = ''
+        self._str_shellReturn   = ''
+        for key, value in kwargs.iteritems():
+            if key == 'shellCmd':       self._str_shellCmd      = value
+            if key == 'shellReturn':    self._str_shellReturn   = value
+
+
+    def poll(self):
+        self._shell(self._str_shellCmd)
+        str_stdout  = self._shell.stdout().strip()
+        return str_stdout == self._str_shellReturn, 'block processCount = %s' % str_stdout
+
+
+class SentinelBlocker(Blocker):
+    '''
+    Blocks until every file in <files> exists (and, if <nonEmpty>, has
+    a non-zero size). This suits jobs that write a completion marker.
+
+    If the optional pyinotify module is available, the blocker sleeps
+    on filesystem events in the directories concerned and wakes as soon
+    as a sentinel appears; the backoff interval then only bounds how
+    long it sleeps without an event (which matters on NFS, where events
+    from other hosts are not delivered). Otherwise it falls back to
+    polling with the backoff.
+    '''
+
+    def __init__(self, **kwargs):
+        Blocker.__init__(self, **kwargs)
+        self._l_files           = []
+        self._b_nonEmpty        = True
+        self._b_inotify         = pyinotify is not None
+        for key, value in kwargs.iteritems():
+            if key == 'files':          self._l_files           = value
+            if key == 'nonEmpty':       self._b_nonEmpty        = value
+            if key == 'inotify':        self._b_inotify         = value and pyinotify is not None
+        if isinstance(self._l_files, str): self._l_files = [self._l_files]
+        self._notifier          = None
+
+
+    def file_done(self, astr_file):
+        if not os.path.exists(astr_file): return False
+        if self._b_nonEmpty: return os.path.getsize(astr_file) > 0
+        return True
+
+
+    def poll(self):
+        l_done = [f for f in self._l_files if self.file_done(f)]
+        return len(l_done) == len(self._l_files), \
+               'sentinels done/total = %d/%d' % (len(l_done), len(self._l_files))
+
+
+    def wait(self, afinterval):
+        if not self._b_inotify:
+            time.sleep(afinterval)
+            return
+        if self._notifier is None:
+            watchManager    = pyinotify.WatchManager()
+            self._notifier  = pyinotify.Notifier(watchManager, timeout = 0)
+            mask            = pyinotify.IN_CREATE | pyinotify.IN_CLOSE_WRITE | \
+                              pyinotify.IN_MOVED_TO
+            for str_dir in set([os.path.dirname(os.path.abspath(f)) for f in self._l_files]):
+                if os.path.isdir(str_dir): watchManager.add_watch(str_dir, mask)
+        if self._notifier.check_events(timeout = int(afinterval * 1000)):
+            self._notifier.read_events()
+            self._notifier.process_events()
+
+
+class FakeScheduler:
+    '''
+    A local stand-in for a crun HPC scheduler shell.
+
+    Commands "scheduled" with this object are run as local background
+    processes, at most <slots> at a time; the rest wait as pending jobs.
+    The object answers queueInfo() like a crun scheduler, so that
+    blocking logic (and whole pipelines) can be exercised without a
+    cluster:
+
+        shell = stage.FakeScheduler(slots = 2)
+        stage.shell(shell)
+        shell('sleep 10')
+        stage.kwBlockOnScheduler(blockProcess = 'sleep', ...)
+
+    A job's process name is the basename of the first word of its
+    command.
+    '''
+
+    def __init__(self, **kwargs):
+        self._slots             = 2
+        self._str_name          = 'fake'
+        for key, value in kwargs.iteritems():
+            if key == 'slots':          self._slots             = value
+            if key == 'name':           self._str_name          = value
+        self._l_job             = []
+        self._lock              = threading.Lock()
+
+
+    def clusterName(self):
+        return self._str_name
+
+
+    def clusterType(self):
+        return 'local'
+
+
+    def stdout(self):   return ''
+    def stderr(self):   return ''
+    def exitCode(self): return 0
+
+
+    def __call__(self, astr_cmd, **kwargs):
+        str_process = os.path.basename(shlex.split(astr_cmd)[0])
+        self._lock.acquire()
+        self._l_job.append({'cmd': astr_cmd, 'process': str_process, 'proc': None})
+        self._lock.release()
+        self.schedule()
+        return '', '', 0
+
+
+    def schedule(self):
+        '''
+        Start pending jobs while there are free slots.
+        '''
+        self._lock.acquire()
+        running = len([j for j in self._l_job
+                       if j['proc'] is not None and j['proc'].poll() is None])
+        for job in self._l_job:
+            if running >= self._slots: break
+            if job['proc'] is None:
+                devnull     = open(os.devnull, 'w')
+                job['proc'] = subprocess.Popen(job['cmd'], shell = True,
+                                               stdout = devnull, stderr = devnull)
+                devnull.close()
+                running     += 1
+                # Like a real scheduler, start the next pending job as
+                # soon as this one finishes, not only when queried.
+                thread      = threading.Thread(target = self.job_reap,
+                                               args = (job['proc'],))
+                thread.daemon = True
+                thread.start()
+        self._lock.release()
+
+
+    def job_reap(self, proc):
+        proc.wait()
+        self.schedule()
+
+
+    def queueInfo(self, **kwargs):
+        '''
+        Returns (pending, running, scheduled, completed) job counts as
+        strings, for jobs matching the optional <blockProcess>.
+        '''
+        str_blockProcess = ''
+        for key, value in kwargs.iteritems():
+            if key == 'blockProcess':   str_blockProcess        = value
+        self.schedule()
+        self._lock.acquire()
+        l_job       = [j for j in self._l_job if str_blockProcess in j['process']]
+        pending     = len([j for j in l_job if j['proc'] is None])
+        running     = len([j for j in l_job
+                           if j['proc'] is not None and j['proc'].poll() is None])
+        self._lock.release()
+        completed   = len(l_job) - pending - running
+        return '%d' % pending, '%d' % running, '%d' % (pending + running), '%d' % completed
+
+
+
+class TailBuffer:
+    '''
+    A bounded ring buffer that keeps (at least) the last <size> bytes
+    written to it, in constant memory.
+    '''
+
+    def __init__(self, size = 64*1024):
+        self._size              = size
+        self._d_chunk           = collections.deque()
+        self._bytes             = 0
+
+
+    def write(self, astr_data):
+        self._d_chunk.append(astr_data)
+        self._bytes             += len(astr_data)
+        while len(self._d_chunk) > 1 and \
+              self._bytes - len(self._d_chunk[0]) >= self._size:
+            self._bytes         -= len(self._d_chunk.popleft())
+
+
+    def __str__(self):
+        return ''.join(self._d_chunk)[-self._size:]
+
+
+class SpoolFile:
+    '''
+    A size-capped, rotating spool file. Once <astr_file> grows beyond
+    <maxBytes>, it is renamed to <astr_file>.1 (older segments moving
+    up to .2, .3, ...) and a new segment is started. At most <count>
+    old segments are kept.
+    '''
+
+    def __init__(self, astr_file, maxBytes = 64*1024*1024, count = 4):
+        self._str_file          = astr_file
+        self._maxBytes          = maxBytes
+        self._count             = count
+        self._file              = open(self._str_file, 'w')
+        self._bytes             = 0
+
+
+    def fileName(self):
+        return self._str_file
+
+
+    def rotate(self):
+        self._file.close()
+        for i in range(self._count - 1, 0, -1):
+            str_src = '%s.%d' % (self._str_file, i)
+            if os.path.exists(str_src):
+                os.rename(str_src, '%s.%d' % (self._str_file, i + 1))
+        if self._count: os.rename(self._str_file, '%s.1' % self._str_file)
+        self._file              = open(self._str_file, 'w')
+        self._bytes             = 0
+
+
+    def write(self, astr_data):
+        if self._maxBytes and self._bytes + len(astr_data) > self._maxBytes and self._bytes:
+            self.rotate()
+        self._file.write(astr_data)
+        self._bytes             += len(astr_data)
+
+
+    def close(self):
+        self._file.close()
+
+
+class StreamCapture:
+    '''
+    Run a shell command and capture its stdout and stderr incrementally.
+
+    Output is read as it is produced (using select), written to a
+    rotating spool file per stream and kept in a bounded TailBuffer, so
+    that memory use stays constant no matter how much the command
+    prints. The most recent output is available from stdout() and
+    stderr(); the complete output is in the spool files.
+
+    kwargs:
+        spoolStem               path stem of the spool files, to which
+                                '.stdout' and '.stderr' are appended.
+                                If empty, output is not spooled.
+        spoolMaxBytes           size at which a spool file is rotated
+        spoolCount              number of rotated segments to keep
+        tailBytes               size of the in-memory tail buffers
+        stdoutflush             echo stdout to the console as it arrives
+        stderrflush             echo stderr to the console as it arrives
+        processGroup            run the command in its own process group,
+                                so that kill() also reaches any processes
+                                the command started
+    '''
+
+    def __init__(self, **kwargs):
+        self._str_spoolStem     = ''
+        self._spoolMaxBytes     = 64*1024*1024
+        self._spoolCount        = 4
+        self._tailBytes         = 64*1024
+        self._b_stdoutflush     = False
+        self._b_stderrflush     = False
+        self._b_processGroup    = False
+        for key, value in kwargs.iteritems():
+            if key == 'spoolStem':      self._str_spoolStem     = value
+            if key == 'processGroup':   self._b_processGroup    = value
+            if key == 'spoolMaxBytes':  self._spoolMaxBytes     = value
+            if key == 'spoolCount':     self._spoolCount        = value
+            if key == 'tailBytes':      self._tailBytes         = value
+            if key == 'stdoutflush':    self._b_stdoutflush     = value
+            if key == 'stderrflush':    self._b_stderrflush     = value
+        self._tail_stdout       = TailBuffer(self._tailBytes)
+        self._tail_stderr       = TailBuffer(self._tailBytes)
+        self._bytes_stdout      = 0
+        self._bytes_stderr      = 0
+        self._exitCode          = 0
+        self._proc              = None
+
+
+    def stdout(self):       return str(self._tail_stdout)
+    def stderr(self):       return str(self._tail_stderr)
+    def exitCode(self):     return self._exitCode
+    def bytes_stdout(self): return self._bytes_stdout
+    def bytes_stderr(self): return self._bytes_stderr
+
+
+    def spoolFile(self, astr_stream = 'stdout'):
+        '''
+        Returns the name of the current spool file of <astr_stream>.
+        '''
+        if not len(self._str_spoolStem): return ''
+        return '%s.%s' % (self._str_spoolStem, astr_stream)
+
+
+    def kill(self):
+        '''
+        Terminate the running command, if any.
+        '''
+        proc = self._proc
+        if proc is None or proc.poll() is not None: return
+        try:
+            if self._b_processGroup:    os.killpg(proc.pid, signal.SIGTERM)
+            else:                       proc.terminate()
+        except OSError:
+            pass
+
+
+    def __call__(self, astr_cmd):
+        '''
+        Run <astr_cmd> to completion. Returns the tuple
+        (stdout tail, stderr tail, exitCode).
+        '''
+        self._tail_stdout       = TailBuffer(self._tailBytes)
+        self._tail_stderr       = TailBuffer(self._tailBytes)
+        self._bytes_stdout      = 0
+        self._bytes_stderr      = 0
+        proc = subprocess.Popen(astr_cmd, shell = True,
+                                stdout = subprocess.PIPE, stderr = subprocess.PIPE,
+                                preexec_fn = self._b_processGroup and os.setsid or None)
+        self._proc = proc
+        d_sink = {
+            proc.stdout.fileno(): ['stdout', self._tail_stdout, None,
+                                   self._b_stdoutflush and sys.stdout],
+            proc.stderr.fileno(): ['stderr', self._tail_stderr, None,
+                                   self._b_stderrflush and sys.stderr]
+        }
+        if len(self._str_spoolStem):
+            for fd in d_sink:
+                d_sink[fd][2] = SpoolFile(self.spoolFile(d_sink[fd][0]),
+                                          self._spoolMaxBytes, self._spoolCount)
+        l_fd = d_sink.keys()
+        while len(l_fd):
+            try:
+                l_ready = select.select(l_fd, [], [])[0]
+            except select.error, e:
+                # A signal, e.g. from the sampling profiler.
+                if e.args[0] == errno.EINTR: continue
+                raise
+            for fd in l_ready:
+                str_stream, tail, spool, echo = d_sink[fd]
+                str_data = os.read(fd, 64*1024)
+                if not str_data:
+                    l_fd.remove(fd)
+                    continue
+                tail.write(str_data)
+                if spool: spool.write(str_data)
+                if echo:
+                    echo.write(str_data)
+                    echo.flush()
+                if str_stream == 'stdout':  self._bytes_stdout += len(str_data)
+                else:                       self._bytes_stderr += len(str_data)
+        for fd in d_sink:
+            if d_sink[fd][2]: d_sink[fd][2].close()
+        self._exitCode = proc.wait()
+        return self.stdout(), self.stderr(), self._exitCode
+
+
+class StageProfile:
+    '''
+    A structured profiling record of a single stage invocation.
+
+    Wall times are split into the preconditions, the stage proper and
+    the postconditions. CPU times and peak RSS are taken from
+    resource.getrusage(RUSAGE_CHILDREN), i.e. they describe the child
+    processes the stage waited on. Since these counters are process-wide,
+    CPU deltas are only exact for stages that do not run concurrently
+    with other stages. Peak RSS is in the units of the platform (KB on
+    Linux) and is the largest child seen so far.
+    '''
+
+    l_fields = ['pipeline', 'stage', 'host', 'pid', 'start', 'exitCode',
+                'cacheHit', 'attempts', 'wall', 'wall_pre', 'wall_stage',
+                'wall_post', 'wall_blocked', 'cpu_user', 'cpu_sys',
+                'maxrss_children', 'maxrss_self', 'bytes_input',
+                'bytes_stdout', 'bytes_stderr']
+
+    # The fields that hold measurements, see profile_load()
+    l_numeric = ['start', 'attempts', 'wall', 'wall_pre', 'wall_stage',
+                 'wall_post', 'wall_blocked', 'cpu_user', 'cpu_sys',
+                 'maxrss_children', 'maxrss_self', 'bytes_input',
+                 'bytes_stdout', 'bytes_stderr']
+
+    def __init__(self, **kwargs):
+        self._d_record = dict([(field, 0) for field in StageProfile.l_fields])
+        self._d_record['pipeline']  = ''
+        self._d_record['stage']     = ''
+        self._d_record['host']      = os.uname()[1]
+        self._d_record['pid']       = os.getpid()
+        self._d_record['start']     = time.time()
+        self._d_record['cacheHit']  = False
+        self._rusage                = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self._b_open                = True
+        for key, value in kwargs.iteritems():
+            self._d_record[key] = value
+
+
+    def __getitem__(self, key):
+        return self._d_record[key]
+
+
+    def __setitem__(self, key, value):
+        self._d_record[key] = value
+
+
+    def add(self, key, value):
+        self._d_record[key] += value
+
+
+    def isOpen(self):
+        return self._b_open
+
+
+    def close(self, stage):
+        '''
+        Complete the record with the totals of <stage>.
+        '''
+        rusage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self._d_record['wall']              = time.time() - self._d_record['start']
+        self._d_record['cpu_user']          = rusage.ru_utime - self._rusage.ru_utime
+        self._d_record['cpu_sys']           = rusage.ru_stime - self._rusage.ru_stime
+        self._d_record['maxrss_children']   = rusage.ru_maxrss
+        self._d_record['maxrss_self']       = \
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        self._d_record['exitCode']          = stage.exitCode()
+        self._d_record['cacheHit']          = stage.cacheHit()
+        self._d_record['bytes_input']       = stage.inputBytes()
+        self._d_record['bytes_stdout'], self._d_record['bytes_stderr'] = \
+            stage.outputBytes()
+        self._b_open                        = False
+
+
+    def dict(self):
+        return dict(self._d_record)
+
+
+def profile_export(al_profile, astr_file, astr_format = ''):
+    '''
+    Write the list of StageProfile records <al_profile> to <astr_file>
+    as JSON or CSV. If no <astr_format> is given, it is taken from the
+    file extension (defaulting to JSON).
+    '''
+    if not len(astr_format):
+        astr_format = 'csv' if astr_file.endswith('.csv') else 'json'
+    f = open(astr_file, 'w')
+    if astr_format == 'csv':
+        writer = csv.DictWriter(f, StageProfile.l_fields)
+        writer.writerow(dict([(field, field) for field in StageProfile.l_fields]))
+        for profile in al_profile: writer.writerow(profile.dict())
+    else:
+        json.dump([profile.dict() for profile in al_profile], f, indent = 1)
+    f.close()
+
+
+def profile_load(al_file):
+    '''
+    Read back the profiling records written by profile_export() from
+    the file (or list of files) <al_file>. Returns a list of plain
+    dictionaries. The measurements read from CSV files (see
+    StageProfile.l_numeric) are converted to numbers, the other fields
+    (such as the stage name) are kept as strings.
+    '''
+    if isinstance(al_file, str): al_file = [al_file]
+    l_record = []
+    for str_file in al_file:
+        f = open(str_file)
+        if str_file.endswith('.csv'):
+            for d_row in csv.DictReader(f):
+                for key in StageProfile.l_numeric:
+                    if not d_row.get(key): continue
+                    try:                d_row[key] = float(d_row[key])
+                    except ValueError:  pass
+                l_record.append(d_row)
+        else:
+            l_record.extend(json.load(f))
+        f.close()
+    return l_record
+
+
+class CostModel:
+    '''
+    Estimates the wall time of a stage from historical profiling records
+    (see profile_export() and profile_load()).
+
+    Records are grouped by stage name; failed runs and cache hits are
+    ignored since they say little about the cost of real work. If the
+    history covers several input sizes, the estimate is a least-squares
+    linear fit of wall time against input bytes. With a single input size
+    the median wall time is scaled in proportion, and with no size
+    information at all the median wall time is used as is.
+    '''
+
+    def __init__(self, al_record = []):
+        self._d_history = {}
+        for d_record in al_record: self.record_add(d_record)
+
+
+    def record_add(self, d_record):
+        '''
+        Add a single profiling record (a StageProfile or a dictionary).
+        '''
+        if isinstance(d_record, StageProfile): d_record = d_record.dict()
+        if int(d_record.get('exitCode', 0) or 0): return
+        if str(d_record.get('cacheHit')) in ('True', '1', '1.0'): return
+        self._d_history.setdefault(d_record['stage'], []).append(
+            (float(d_record.get('bytes_input', 0) or 0), float(d_record['wall'])))
+
+
+    def samples(self, astr_stage):
+        '''
+        Returns the number of historical records for <astr_stage>.
+        '''
+        return len(self._d_history.get(astr_stage, []))
+
+
+    @staticmethod
+    def median(al_value):
+        l_value = sorted(al_value)
+        n       = len(l_value)
+        if n % 2: return l_value[n/2]
+        return (l_value[n/2-1] + l_value[n/2]) / 2.0
+
+
+    def estimate(self, astr_stage, abytes = 0):
+        '''
+        Returns the tuple (seconds, basis) estimating the wall time of
+        <astr_stage> on <abytes> of input. The basis is a short string
+        describing how the estimate was made; it is 'no history' (with
+        an estimate of zero) for unknown stages.
+        '''
+        l_sample = self._d_history.get(astr_stage, [])
+        if not len(l_sample): return 0.0, 'no history'
+        l_wall  = [wall for size, wall in l_sample]
+        l_size  = [size for size, wall in l_sample if size > 0]
+        n       = len(l_sample)
+        if abytes > 0 and len(set(l_size)) > 1:
+            l_pair  = [(size, wall) for size, wall in l_sample if size > 0]
+            mx      = sum([size for size, wall in l_pair]) / len(l_pair)
+            my      = sum([wall for size, wall in l_pair]) / len(l_pair)
+            sxx     = sum([(size - mx)**2 for size, wall in l_pair])
+            sxy     = sum([(size - mx)*(wall - my) for size, wall in l_pair])
+            slope   = sxy / sxx
+            if slope >= 0:
+                return max(0.0, my + slope*(abytes - mx)), 'fit of %d' % n
+        if abytes > 0 and len(l_size):
+            return self.median(l_wall) * abytes / self.median(l_size), 'scaled %d' % n
+        return self.median(l_wall), 'median of %d' % n
+
+
+class Journal:
+    '''
+    An append-only checkpoint journal of stage executions.
+
+    Each stage start and finish is appended as one JSON record per line
+    and fsync'd, so that the journal survives the controlling process
+    dying at any point. A finish record holds the stage exit code and
+    fingerprints of the stage work (see Stage.cache_material()), its
+    declared input files and its declared output files.
+
+    A completed() stage is one whose most recent record is a successful
+    finish, and whose work and file fingerprints still match the stage
+    in its current state. Such stages can be skipped on resume, unless
+    their work cannot be fingerprinted (see Stage.cacheable()).
+    '''
+
+    def __init__(self, astr_file):
+        self._str_file          = astr_file
+        self._lock              = threading.Lock()
+        self._d_last            = {}
+        if os.path.isfile(astr_file):
+            self.load()
+
+
+    def fileName(self):
+        return self._str_file
+
+
+    def load(self):
+        '''
+        Read the journal, keeping the most recent record of each stage.
+        A truncated final line (from a crash mid-write) is ignored.
+        '''
+        f = open(self._str_file)
+        for str_line in f:
+            try:
+                d_record = json.loads(str_line)
+            except ValueError:
+                continue
+            self._d_last[d_record['stage']] = d_record
+        f.close()
+
+
+    def append(self, d_record):
+        self._lock.acquire()
+        try:
+            f = open(self._str_file, 'a')
+            f.write(json.dumps(d_record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+            f.close()
+            self._d_last[d_record['stage']] = d_record
+        finally:
+            self._lock.release()
+
+
+    @staticmethod
+    def fingerprints(stage):
+        '''
+        Returns a dictionary of the fingerprints of the work, inputs and
+        outputs of <stage>.
+        '''
+        str_method = stage.cacheHash()
+        return {
+            'work'      : hashlib.sha1(stage.cache_material()).hexdigest(),
+            'inputs'    : dict([(f, Stage.file_fingerprint(f, str_method))
+                                for f in stage.inputFiles()]),
+            'outputs'   : dict([(f, Stage.file_fingerprint(f, str_method))
+                                for f in stage.outputFiles()])
+        }
+
+
+    def start(self, stage):
+        self.append({'stage': stage.name(), 'event': 'start', 'time': time.time()})
+
+
+    def finish(self, stage, exitCode):
+        d_record = {'stage': stage.name(), 'event': 'finish', 'time': time.time(),
+                    'exitCode': exitCode, 'ok': not exitCode}
+        d_record.update(Journal.fingerprints(stage))
+        self.append(d_record)
+
+
+    def completed(self, stage):
+        '''
+        Returns True if <stage> has a valid completion record.
+        '''
+        d_record = self._d_last.get(stage.name())
+        if d_record is None or d_record['event'] != 'finish' or not d_record['ok']:
+            return False
+        if not stage.cacheable(): return False
+        d_now = Journal.fingerprints(stage)
+        for key in ['work', 'inputs', 'outputs']:
+            if d_record[key] != d_now[key]: return False
+        for str_fingerprint in d_now['outputs'].values():
+            if str_fingerprint == 'missing': return False
+        return True
+
+
+class FanOut:
+    '''
+    Run the same command over the cartesian product of several parameter
+    lists, concurrently.
+
+    This replaces the nested 'for subj / hemi / surface / curv' loops
+    that run one command per combination serially. For example:
+
+        fan = FanOut(
+            cmd     = 'mris_info %(subj)s/surf/%(hemi)s.%(surface)s',
+            params  = [('subj', l_subj), ('hemi', ['lh', 'rh']),
+                       ('surface', ['smoothwm', 'pial'])],
+            workers = 8)
+        fan()
+        if len(fan.failures()): ...
+
+    Failing items can be retried with a RetryPolicy. To cut the tail
+    latency of large fan-outs, items can also be run speculatively: once
+    the queue has drained and a worker is idle, an item that has been
+    running for longer than a given percentile of the completed items
+    is started a second time. The first attempt to succeed is kept and
+    the other one is killed (if its shell supports kill()) or ignored.
+    Speculative execution is only safe for commands that can run twice
+    concurrently, e.g. that write their outputs atomically.
+
+    kwargs:
+        cmd                     the command template. Either a string
+                                that is '%'-formatted with a dictionary of
+                                the item parameters, or a callable that
+                                takes that dictionary and returns the
+                                command string
+        params                  a list of (name, values) tuples; items are
+                                expanded in the given order, the last
+                                parameter varying fastest
+        workers                 the maximum number of commands in flight
+        shellFactory            a callable returning a new crun (or crun
+                                compatible) shell per item, used to run
+                                commands on a configured HPC backend. If
+                                not given, items run as local processes
+        tailKB                  stdout/stderr kept in memory per local
+                                item (only the tail is kept)
+        flush                   if True, the shellFactory shells pass the
+                                output of their commands through as it
+                                arrives (their stdoutflush/stderrflush).
+                                The default is True for a single worker,
+                                whose output cannot interleave, and False
+                                otherwise
+        retry                   a RetryPolicy applied to every item, or
+                                simply the number of attempts per item
+        speculate               the latency percentile (0 < p <= 100)
+                                beyond which a straggling item is
+                                duplicated. 0 (the default) turns
+                                speculative execution off
+        speculateAfter          the number of items that need to have
+                                completed before speculating (default 5)
+        log                     a message.Message for progress messages
+    '''
+
+    def __init__(self, **kwargs):
+        self._cmd               = ''
+        self._l_param           = []
+        self._workers           = 1
+        self._f_shellFactory    = None
+        self._tailBytes         = 16*1024
+        self._b_flush           = None
+        self._retry             = RetryPolicy()
+        self._speculate         = 0
+        self._speculateAfter    = 5
+        self._log               = None
+        for key, value in kwargs.iteritems():
+            if key == 'cmd':            self._cmd               = value
+            if key == 'params':         self._l_param           = value
+            if key == 'workers':        self._workers           = max(1, int(value))
+            if key == 'shellFactory':   self._f_shellFactory    = value
+            if key == 'tailKB':         self._tailBytes         = int(value * 1024)
+            if key == 'flush':          self._b_flush           = value
+            if key == 'retry':          self._retry             = value
+            if key == 'speculate':      self._speculate         = float(value)
+            if key == 'speculateAfter': self._speculateAfter    = max(1, int(value))
+            if key == 'log':            self._log               = value
+        if isinstance(self._l_param, dict):
+            self._l_param = sorted(self._l_param.items())
+        if isinstance(self._retry, (int, long)):
+            self._retry = RetryPolicy(maxAttempts = self._retry)
+        if self._b_flush is None:
+            self._b_flush = self._workers == 1
+        self._l_result          = []
+        self._d_running         = {}
+        self._lock              = threading.Lock()
+        self._elapsed           = 0.0
+
+
+    def items(self):
+        '''
+        Returns the list of parameter dictionaries, one per expansion.
+        '''
+        l_name      = [name for name, values in self._l_param]
+        l_values    = [values for name, values in self._l_param]
+        return [dict(zip(l_name, t)) for t in itertools.product(*l_values)]
+
+
+    def item_cmd(self, d_item):
+        if callable(self._cmd): return self._cmd(d_item)
+        return self._cmd % d_item
+
+
+    def item_run(self, d_item, d_attempt = None):
+        '''
+        Run a single expansion (retrying according to the RetryPolicy)
+        and return its result dictionary. The shell of the current try
+        is kept in <d_attempt>, so that it can be killed from another
+        thread; once d_attempt['killed'] is set, no further tries are
+        made.
+        '''
+        if d_attempt is None: d_attempt = {'shell': None, 'killed': False}
+        d_result = {'params': d_item, 'cmd': '', 'exitCode': None,
+                    'stdout': '', 'stderr': '', 'elapsed': 0.0, 'error': '',
+                    'attempts': 0, 'speculative': False}
+        startTime = time.time()
+
+        def f_attempt(attempt):
+            # A killed item returns no exit code, which ends the retries.
+            if d_attempt['killed']: return None
+            if self._f_shellFactory is not None:
+                shell = self._f_shellFactory()
+                d_attempt['shell'] = shell
+                shell(d_result['cmd'], waitForChild = True,
+                      stdoutflush = self._b_flush,
+                      stderrflush = self._b_flush)
+            else:
+                shell = StreamCapture(tailBytes     = self._tailBytes,
+                                      processGroup  = True)
+                d_attempt['shell'] = shell
+                shell(d_result['cmd'])
+            d_result['attempts']    = attempt
+            d_result['stdout']      = shell.stdout()
+            d_result['stderr']      = shell.stderr()
+            d_result['exitCode']    = shell.exitCode()
+            if d_attempt['killed']: return None
+            return d_result['exitCode']
+
+        log = None
+        if self._log is not None:
+            log = lambda str_msg: self._log('<%s> %s', d_result['cmd'], str_msg)
+        try:
+            d_result['cmd'] = self.item_cmd(d_item)
+            self._retry(f_attempt, log)
+        except Exception, e:
+            d_result['error']       = repr(e)
+        d_result['elapsed'] = time.time() - startTime
+        return d_result
+
+
+    def item_failed(self, d_result):
+        return len(d_result['error']) or bool(d_result['exitCode'])
+
+
+    def item_attempt(self, index, d_item, ab_speculative = False):
+        '''
+        Run one attempt at item <index> and record its result, unless
+        another attempt at the same item got there first.
+        '''
+        d_attempt = {'shell': None, 'killed': False, 'start': time.time(),
+                     'speculative': ab_speculative}
+        self._lock.acquire()
+        self._d_running.setdefault(index, []).append(d_attempt)
+        self._lock.release()
+        d_result = self.item_run(d_item, d_attempt)
+        self._lock.acquire()
+        try:
+            l_attempt = self._d_running.get(index, [])
+            if d_attempt in l_attempt: l_attempt.remove(d_attempt)
+            if d_attempt['killed'] or self._l_result[index] is not None:
+                return
+            if self.item_failed(d_result) and len(l_attempt):
+                # Another attempt is still running; let it decide.
+                return
+            d_result['speculative'] = ab_speculative
+            self._l_result[index]   = d_result
+            for d_other in self._d_running.pop(index, []):
+                d_other['killed'] = True
+                f_kill = getattr(d_other['shell'], 'kill', None)
+                if f_kill is not None: f_kill()
+        finally:
+            self._lock.release()
+        if self._log is not None:
+            str_status = 'ok'
+            if self.item_failed(d_result):  str_status = 'FAILED'
+            if ab_speculative:              str_status += ', speculative'
+            self._log('[%s] %s (%.1fs)\n', str_status, d_result['cmd'],
+                      d_result['elapsed'])
+
+
+    @staticmethod
+    def percentile(al_value, p):
+        l_value = sorted(al_value)
+        index   = int(round((len(l_value) - 1) * p / 100.0))
+        return l_value[max(0, min(index, len(l_value) - 1))]
+
+
+    def speculate(self, al_item, queue_item, al_thread):
+        '''
+        Start a duplicate attempt at every straggling item, as long as
+        there is spare worker capacity.
+        '''
+        if not queue_item.empty(): return
+        self._lock.acquire()
+        try:
+            l_elapsed = [r['elapsed'] for r in self._l_result
+                         if r is not None and not self.item_failed(r)]
+            if len(l_elapsed) < self._speculateAfter: return
+            threshold   = self.percentile(l_elapsed, self._speculate)
+            active      = sum([len(l) for l in self._d_running.values()])
+            now         = time.time()
+            for index, l_attempt in self._d_running.items():
+                if active >= self._workers: break
+                if len(l_attempt) != 1 or l_attempt[0]['speculative']: continue
+                if now - l_attempt[0]['start'] <= threshold: continue
+                thread = threading.Thread(target = self.item_attempt,
+                                          args = (index, al_item[index], True))
+                thread.daemon = True
+                thread.start()
+                al_thread.append(thread)
+                active += 1
+        finally:
+            self._lock.release()
+
+
+    def __call__(self):
+        '''
+        Run all expansions on at most <workers> concurrent workers, and
+        return the summary().
+        '''
+        startTime       = time.time()
+        l_item          = self.items()
+        self._l_result  = [None] * len(l_item)
+        self._d_running = {}
+        queue_item      = Queue.Queue()
+        for index, d_item in enumerate(l_item): queue_item.put((index, d_item))
+
+        def worker():
+            while True:
+                try:
+                    index, d_item = queue_item.get_nowait()
+                except Queue.Empty:
+                    return
+                self.item_attempt(index, d_item)
+
+        l_thread = []
+        for i in range(min(self._workers, len(l_item))):
+            thread = threading.Thread(target = worker)
+            thread.daemon = True
+            thread.start()
+            l_thread.append(thread)
+        while [t for t in l_thread if t.isAlive()]:
+            # A timeout on join() keeps the main thread responsive to ctrl-c
+            for thread in l_thread:
+                if thread.isAlive(): thread.join(1)
+                if self._speculate:
+                    self.speculate(l_item, queue_item, l_thread)
+        self._elapsed   = time.time() - startTime
+        return self.summary()
+
+
+    def progress(self):
+        '''
+        Returns the counts of pending, running, completed and failed
+        items of the current (or most recent) run.
+        '''
+        l_result    = [r for r in list(self._l_result) if r is not None]
+        running     = len(self._d_running)
+        failed      = len([r for r in l_result if self.item_failed(r)])
+        return {
+            'pending'   : len(self._l_result) - len(l_result) - running,
+            'running'   : running,
+            'completed' : len(l_result),
+            'failed'    : failed}
+
+
+    def results(self):
+        '''
+        Returns the per-item result dictionaries, in expansion order.
+        '''
+        return self._l_result
+
+
+    def failures(self):
+        '''
+        Returns the result dictionaries of all failed items.
+        '''
+        return [r for r in self._l_result if r is not None and self.item_failed(r)]
+
+
+    def summary(self):
+        '''
+        Returns a dictionary summarizing the most recent run.
+        '''
+        l_failed = self.failures()
+        l_result = [r for r in self._l_result if r is not None]
+        return {
+            'total'         : len(self._l_result),
+            'ok'            : len([r for r in l_result if not self.item_failed(r)]),
+            'failed'        : len(l_failed),
+            'retried'       : len([r for r in l_result if r['attempts'] > 1]),
+            'speculative'   : len([r for r in l_result if r['speculative']]),
+            'elapsed'       : self._elapsed,
+            'failures'      : [(r['cmd'], r['exitCode'], r['error'] or r['stderr'][-512:])
+                               for r in l_failed]
+        }
+
+
+    def summary_str(self):
+        '''
+        Returns the summary as a (multi-line) human readable string.
+        '''
+        d_summary   = self.summary()
+        str_summary = '%d/%d items completed successfully in %.1f seconds' % \
+                      (d_summary['ok'], d_summary['total'], d_summary['elapsed'])
+        str_summary += ' (%d retried, %d won by a speculative duplicate).\n' % \
+                      (d_summary['retried'], d_summary['speculative'])
+        for str_cmd, exitCode, str_error in d_summary['failures']:
+            str_summary += '\tFAILED (exitCode %s): %s\n\t\t%s\n' % \
+                           (exitCode, str_cmd, str_error.strip())
+        return str_summary
+
+
 class Stage:
     '''
     A simple 'stage' class used for constructing serialized pipeline
@@ -245,18 +2185,14 @@ class Stage:
     # across all instances of this class
     #
     _dictErr = {
-        'preconditions'     : {
-            'action'        : 'executing preconditions, ',
-            'error'         : 'a failure state was detected.',
-            'exitCode'      : 10},
-        'postconditions'    : {
-            'action'        : 'executing postconditions, ',
-            'error'         : 'a failure state was detected.',
-            'exitCode'      : 11},
         'NoCmd'             : {
             'action'        : 'executing a stage shell command, ',
             'error'         : 'no shell command has been specified.',
-            'exitCode'      : 12}
+            'exitCode'      : 12},
+        'stage'             : {
+            'action'        : 'executing the stage, ',
+            'error'         : 'the stage reported an error condition.',
+            'exitCode'      : 13}
     }
 
     def shell(self, *args):
@@ -368,10 +2304,68 @@ class Stage:
         '''
         if len(args):
             self.__name = args[0]
+            self._log.recordField('stage', args[0])
         else:
             return self.__name
 
 
+    def dependsOn(self, *args):
+        '''
+        get/set the list of stages that this stage depends on.
+
+        Dependencies are only consulted when a pipeline executes with
+        more than one worker. Each entry is either a stage name or a
+        stage object. A value of None (the default) means "depends on
+        the previous stage in the pipeline", while an empty list means
+        the stage is independent and can start immediately.
+
+        dependsOn():                    returns the current dependency list
+        dependsOn(['stage1', ...]):     sets the dependency list
+
+        '''
+        if len(args):
+            self._l_dependsOn = args[0]
+            if isinstance(self._l_dependsOn, (str, Stage)):
+                self._l_dependsOn = [self._l_dependsOn]
+        else:
+            return self._l_dependsOn
+
+
+    def cpus(self, *args):
+        '''
+        get/set the number of CPUs this stage is expected to keep busy.
+
+        Used by a parallel pipeline to admit stages only while enough of
+        its CPU budget is free. See Pipeline.cpus().
+
+        cpus():         returns the declared number of CPUs
+        cpus(<N>):      sets the declared number of CPUs
+
+        '''
+        if len(args):
+            self._cpus = args[0]
+        else:
+            return self._cpus
+
+
+    def memMB(self, *args):
+        '''
+        get/set the approximate peak memory (in MB) of this stage.
+
+        Used by a parallel pipeline to admit stages only while enough
+        memory is free, both within its declared budget and as reported
+        live by the system. See Pipeline.memMB().
+
+        memMB():        returns the declared memory requirement
+        memMB(<MB>):    sets the declared memory requirement
+
+        '''
+        if len(args):
+            self._memMB = args[0]
+        else:
+            return self._memMB
+
+
     def __init__(self, **kwargs):
         '''
         The base constructor for the 'Stage' class.
@@ -401,20 +2395,60 @@ class Stage:
         # A stage also contains a "shell" object used for interacting with the
         # host OS environment. Specific sub-classes of 'crun' actually use this
         # shell to run the stage internals; however all stages can use the
-        # shell in any capacity.
-        self._shell             = None
+        # shell in any capacity. Sub-classes may already have set a shell
+        # before calling this constructor, in which case it is preserved.
+        self._shell             = getattr(self, '_shell', None)
 
         # The canRun flag is a simple toggle that can be controlled by a caller
         # to either turn a stage off or on, but leave it otherwise intact.
         self._b_canRun          = True
         self._callCount         = 0
 
+        # The stages that need to complete before this stage can start when
+        # run in a parallel pipeline. See dependsOn().
+        self._l_dependsOn       = None
+        self._startTime         = 0
+
+        # The counts of the jobs this stage is waiting on, as reported by
+        # its blocking backend or fan-out. See jobs().
+        self._d_jobs            = {}
+        self._fanout            = None
+
+        # The resources the stage declares it needs while running. These
+        # only matter to a parallel pipeline. Stages that declare nothing
+        # (such as those that merely submit cluster jobs) are only limited
+        # by the number of pipeline workers. See cpus() and memMB().
+        self._cpus              = 0
+        self._memMB             = 0
+
+        # The optional result cache. If a cache directory is set, the
+        # stdout/stderr/exitCode of a successful stage execution are
+        # recorded under a key derived from the stage name, command or
+        # callback arguments and the declared input files. See cache_key().
+        self._str_cacheDir      = ''
+        self._str_cacheHash     = 'content'
+        self._str_cacheKey      = ''
+        self._l_inputFiles      = []
+        self._l_outputFiles     = []
+        self._b_cacheHit        = False
+
+        # The backend used to block on schedulers, shell conditions or
+        # sentinel files. None selects the default backend of each of the
+        # kwBlockOn*() methods.
+        self._blocker           = None
+
+        # Profiling records, one StageProfile per invocation.
+        self._profile           = None
+        self._l_profile         = []
+
         self._verbosity         = 1
 
         self._str_cmd           = ''
         self._str_stdout        = ''
         self._str_stderr        = ''
         self._str_exitCode      = ''
+        # The exit code of a non-fatal failure of the current run.
+        self._failCode          = 0
 
         self._f_preconditions           = lambda **x: True
         self._f_preconditionsArgs       = {'val': True}
@@ -430,7 +2464,290 @@ class Stage:
             if key == 'cmd':                self.cmd(value)
             if key == 'logTo':              self.log().to(value)
             if key == 'logTee':             self.log().tee(value)
+            if key == 'logRecords':         self.log().records(value)
+            if key == 'logRotate':          self.log().rotate(**value)
             if key == 'def_stage':          self._f_stage = value
+            if key == 'dependsOn':          self.dependsOn(value)
+            if key == 'cpus':               self.cpus(value)
+            if key == 'memMB':              self.memMB(value)
+            if key == 'cacheDir':           self.cache(value)
+            if key == 'cacheHash':          self.cacheHash(value)
+            if key == 'cacheKey':           self.cacheKey(value)
+            if key == 'inputFiles':         self.inputFiles(value)
+            if key == 'outputFiles':        self.outputFiles(value)
+
+
+    def cache(self, *args):
+        '''
+        get/set the result cache directory.
+
+        If set to a non-empty directory name, stage results are cached
+        and a subsequent call with an identical cache key restores the
+        recorded stdout, stderr and exitCode instead of re-executing
+        the stage. An empty string (the default) disables caching.
+
+        cache():            returns the current cache directory
+        cache(<dir>):       sets the cache directory to <dir>
+
+        '''
+        if len(args):
+            self._str_cacheDir = args[0]
+        else:
+            return self._str_cacheDir
+
+
+    def cacheHash(self, *args):
+        '''
+        get/set how declared input files are fingerprinted in the cache key.
+
+            'content'           a sha1 over the file contents (the default)
+            'stat'              the file size and modification time only,
+                                which is much cheaper for large inputs
+
+        cacheHash():            returns the current fingerprint method
+        cacheHash(<method>):    sets the fingerprint method
+
+        '''
+        if len(args):
+            self._str_cacheHash = args[0]
+        else:
+            return self._str_cacheHash
+
+
+    def cacheKey(self, *args):
+        '''
+        get/set explicit key material for the result cache and journal.
+
+        The arguments of a stage callback that are not simple values (such
+        as stage or pipeline objects) cannot be fingerprinted. A stage with
+        such arguments should name what its work depends on instead, e.g.
+        cacheKey('%s.%s' % (hemi, surface)), otherwise it is only cached
+        or skipped on resume if it declares input files (see cacheable()).
+
+        cacheKey():             returns the current key material
+        cacheKey(<str>):        sets the key material to <str>
+
+        '''
+        if len(args):
+            self._str_cacheKey = args[0]
+        else:
+            return self._str_cacheKey
+
+
+    def inputFiles(self, *args):
+        '''
+        get/set the list of input files that this stage depends on.
+
+        Input files are only used in constructing the result cache key.
+
+        inputFiles():               returns the current list of files
+        inputFiles([<f1>, ...]):    sets the list of files
+
+        '''
+        if len(args):
+            self._l_inputFiles = args[0]
+            if isinstance(self._l_inputFiles, str):
+                self._l_inputFiles = [self._l_inputFiles]
+        else:
+            return self._l_inputFiles
+
+
+    def outputFiles(self, *args):
+        '''
+        get/set the list of output files that this stage produces.
+
+        Output files are fingerprinted in the pipeline journal, so that a
+        resumed pipeline only skips a stage if its outputs are intact.
+
+        outputFiles():              returns the current list of files
+        outputFiles([<f1>, ...]):   sets the list of files
+
+        '''
+        if len(args):
+            self._l_outputFiles = args[0]
+            if isinstance(self._l_outputFiles, str):
+                self._l_outputFiles = [self._l_outputFiles]
+        else:
+            return self._l_outputFiles
+
+
+    def cacheHit(self):
+        '''
+        Returns True if the most recent stage execution was restored
+        from the result cache.
+        '''
+        return self._b_cacheHit
+
+
+    @staticmethod
+    def file_fingerprint(astr_file, astr_method = 'content'):
+        '''
+        Returns a string fingerprint of <astr_file>, either a sha1
+        over its contents or its size and modification time, depending
+        on <astr_method>. Missing files have a fingerprint of 'missing'.
+        '''
+        if not os.path.exists(astr_file): return 'missing'
+        if astr_method == 'stat' or os.path.isdir(astr_file):
+            st = os.stat(astr_file)
+            return '%d:%f' % (st.st_size, st.st_mtime)
+        sha = hashlib.sha1()
+        f = open(astr_file, 'rb')
+        while True:
+            chunk = f.read(1024*1024)
+            if not chunk: break
+            sha.update(chunk)
+        f.close()
+        return sha.hexdigest()
+
+
+    def cache_args(self):
+        '''
+        Returns a (<str>, <b_opaque>) tuple of the stage callback and its
+        keyword arguments as a string, and whether any of the arguments
+        is not a simple value (such as a stage or pipeline object) and
+        hence only contributes its type name.
+        '''
+        l_opaque = []
+        def value_str(value):
+            if isinstance(value, (str, unicode, int, long, float, bool, types.NoneType)):
+                return repr(value)
+            if isinstance(value, (list, tuple)):
+                return '[%s]' % ','.join([value_str(v) for v in value])
+            if isinstance(value, dict):
+                return '{%s}' % ','.join(['%s:%s' % (repr(k), value_str(value[k]))
+                                          for k in sorted(value.keys())])
+            l_opaque.append(value)
+            return '<%s>' % type(value).__name__
+        str_args = '%s(%s)' % (getattr(self._f_stage, '__name__', ''),
+                               value_str(self._f_stageArgs))
+        return str_args, len(l_opaque) > 0
+
+
+    def cache_material(self):
+        '''
+        Returns the string that identifies the work done by this stage,
+        i.e. the stage callback and its keyword arguments (see cache_args())
+        and any explicit key material (see cacheKey()).
+        '''
+        str_material = self.cache_args()[0]
+        if len(self._str_cacheKey):
+            str_material += '#' + self._str_cacheKey
+        return str_material
+
+
+    def cacheable(self):
+        '''
+        Returns True if the work of the stage is fully identified by its
+        cache_material() and input files, i.e. if the stage can be cached
+        and skipped on resume. A stage whose callback takes arguments
+        that are not simple values, and that declares neither input files
+        nor key material (see cacheKey()), is not.
+        '''
+        if len(self._str_cacheKey) or len(self._l_inputFiles): return True
+        return not self.cache_args()[1]
+
+
+    def cache_key(self):
+        '''
+        Returns the result cache key of the stage in its current state,
+        or an empty string if caching is off.
+
+        The key is a sha1 over the stage name, the work the stage does
+        (see cache_material()) and the fingerprints of all declared
+        input files. Stages that are not cacheable() have no key.
+        '''
+        if not len(self._str_cacheDir) or not self.cacheable(): return ''
+        sha = hashlib.sha1()
+        sha.update(self.name())
+        sha.update('\0' + self.cache_material())
+        for str_file in self._l_inputFiles:
+            sha.update('\0%s=%s' % (str_file,
+                        Stage.file_fingerprint(str_file, self._str_cacheHash)))
+        return sha.hexdigest()
+
+
+    def cache_restore(self, astr_key):
+        '''
+        Restore the stage result recorded under <astr_key>. Returns True
+        on a cache hit, False otherwise.
+        '''
+        str_file = os.path.join(self._str_cacheDir, '%s.json' % astr_key)
+        self._b_cacheHit = False
+        if not os.path.isfile(str_file): return False
+        try:
+            f = open(str_file)
+            d_record = json.load(f)
+            f.close()
+        except (IOError, ValueError):
+            return False
+        self._str_stdout        = d_record['stdout']
+        self._str_stderr        = d_record['stderr']
+        self._str_exitCode      = d_record['exitCode']
+        self._b_cacheHit        = True
+        self._log(Colors.CYAN + 'Stage result restored from cache <%s>.\n' % astr_key +
+                  Colors.NO_COLOUR)
+        return True
+
+
+    def cache_store(self, astr_key):
+        '''
+        Record the current stage result under <astr_key>. The record is
+        written to a temporary file and renamed, so that an interrupted
+        run never leaves a partial record behind.
+        '''
+        if not os.path.isdir(self._str_cacheDir):
+            os.makedirs(self._str_cacheDir)
+        str_file = os.path.join(self._str_cacheDir, '%s.json' % astr_key)
+        d_record = {
+            'name'      : self.name(),
+            'time'      : time.time(),
+            'stdout'    : self.stdout(),
+            'stderr'    : self.stderr(),
+            'exitCode'  : self.exitCode()
+        }
+        f = open(str_file + '.tmp', 'w')
+        json.dump(d_record, f)
+        f.close()
+        os.rename(str_file + '.tmp', str_file)
+
+
+    def profile(self):
+        '''
+        Returns the StageProfile of the most recent invocation, or None.
+        '''
+        return self._profile
+
+
+    def profiles(self):
+        '''
+        Returns the list of StageProfile records of all invocations.
+        '''
+        return self._l_profile
+
+
+    def profile_close(self):
+        '''
+        Complete the current profiling record, if it is still open.
+        '''
+        if self._profile is not None and self._profile.isOpen():
+            self._profile.close(self)
+
+
+    def outputBytes(self):
+        '''
+        Returns the tuple (stdout bytes, stderr bytes) of the most
+        recent invocation.
+        '''
+        return len(self.stdout()), len(self.stderr())
+
+
+    def inputBytes(self):
+        '''
+        Returns the total size in bytes of the declared input files
+        that currently exist.
+        '''
+        return sum([os.path.getsize(f) for f in self._l_inputFiles
+                    if os.path.isfile(f)])
 
 
     def def_preconditions(self, *args, **kwargs):
@@ -572,28 +2889,91 @@ class Stage:
                 if key == 'postamble':            b_postamble           = value
 
             if b_preamble:
-                misc.tic() ; self._log(Colors.GREEN + \
+                # Each stage keeps its own start time (rather than using the
+                # global misc.tic()) since stages can run concurrently.
+                self._startTime = time.time()
+                self._failCode  = 0
+                self._profile   = StageProfile(stage = self.name())
+                self._l_profile.append(self._profile)
+                self._log(Colors.GREEN + \
                                        '<%s> START' % self.name() + \
                                        Colors.NO_COLOUR +'...\n' )
 
             if b_preconditionsRun:
+                startTime = time.time()
+                collected = len(error.summary())
                 if not self.preconditions():
-                    error.report(self, 'preconditions', self._b_fatalConditions)
+                    self.fail(error.report(self, 'preconditions', self._b_fatalConditions, stage = self.name()))
+                self.fail_collected(collected)
+                self.profile_add('wall_pre', time.time() - startTime)
             if b_stageRun:
+                startTime = time.time()
                 self._callCount += 1
-                if not self.stage():
-                    error.report(self, 'stage', self._b_fatalConditions)
+                self._b_cacheHit = False
+                str_key = self.cache_key()
+                if not len(str_key) or not self.cache_restore(str_key):
+                    self.profile_add('attempts', 1)
+                    collected = len(error.summary())
+                    if not self.stage():
+                        self.fail(error.report(self, 'stage', self._b_fatalConditions, stage = self.name()))
+                    self.fail_collected(collected)
+                    if len(str_key) and not self.exitCode() and not self._failCode:
+                        self.cache_store(str_key)
+                self.profile_add('wall_stage', time.time() - startTime)
             if b_postconditionsRun:
+                startTime = time.time()
+                collected = len(error.summary())
                 if not self.postconditions():
-                    error.report(self, 'postconditions', self._b_fatalConditions)
+                    self.fail(error.report(self, 'postconditions', self._b_fatalConditions, stage = self.name()))
+                self.fail_collected(collected)
+                self.profile_add('wall_post', time.time() - startTime)
 
             if b_postamble:
+                self.profile_close()
                 self._log(Colors.GREEN      + '<%s> END' % self.name()      + \
                         Colors.NO_COLOUR  + '. Elapsed time = '           + \
-                        Colors.CYAN       + '%f' % misc.toc()             + \
+                        Colors.CYAN       + '%f' % (time.time() - self._startTime) + \
                         Colors.NO_COLOUR  + ' seconds.\n')
 
 
+    def profile_add(self, astr_field, value):
+        '''
+        Add <value> to <astr_field> of the current profiling record.
+        '''
+        if self._profile is not None: self._profile.add(astr_field, value)
+
+
+    def failCode(self):
+        '''
+        Returns the exit code of the first non-fatal failure of the most
+        recent run of the stage (i.e. with fatalConditions off, or errors
+        that were collected in "keep going" mode), or 0 if there was none.
+
+        Such failures do not stop a pipeline, but the stage does not count
+        as completed (see Journal).
+        '''
+        return self._failCode
+
+
+    def fail(self, exitCode):
+        '''
+        Record a non-fatal failure of the current run of the stage (the
+        first failure is kept).
+        '''
+        if not self._failCode: self._failCode = exitCode or 1
+
+
+    def fail_collected(self, collected):
+        '''
+        Record a failure if errors of this stage were added to the error
+        summary (see error.collect()) since it held <collected> errors.
+        '''
+        for e in error.summary().errors()[collected:]:
+            if e.stage == self.name():
+                self.fail(e.exitCode)
+                return
+
+
     def postconditions(self):
         '''
         Evaluates the internal postconditions callback, and returns
@@ -605,12 +2985,19 @@ class Stage:
         return ret
 
 
-    def log(self):
+    def log(self, *args):
         '''
-        Returns the internal log message object. Caller can further manipulate
+        get/set the internal log message object. Caller can further manipulate
         the log object with object-specific calls.
+
+        Several stages (and their pipeline) can share a single log object,
+        which can then write to any number of destinations, see
+        message.Message.sink_add().
         '''
-        return self._log
+        if len(args):
+            self._log = args[0]
+        else:
+            return self._log
 
 
     def canRun(self, *args):
@@ -633,6 +3020,81 @@ class Stage:
 
 
 
+    def fanout(self, **kwargs):
+        '''
+        Run a FanOut (see the FanOut class for the kwargs), logging
+        progress and a summary to the stage log. Returns the FanOut
+        object, from which per-item results and failures can be read.
+        '''
+        kwargs.setdefault('log', self._log)
+        fan = FanOut(**kwargs)
+        self._fanout = fan
+        fan()
+        self._log(fan.summary_str())
+        return fan
+
+
+    def jobs(self, *args):
+        '''
+        get/set the counts of the jobs this stage is processing or
+        waiting on, e.g. {'pending': 3, 'running': 8, 'completed': 20}.
+
+        These are set by the blocking backends (see blockOn()) and read
+        by the pipeline telemetry. While (and after) the stage runs a
+        fan-out, they are the progress of the fan-out.
+
+        jobs():                 returns the current counts
+        jobs(<dict>):           sets the counts to <dict>
+
+        '''
+        if len(args):
+            self._d_jobs = args[0]
+        else:
+            if self._fanout is not None: return self._fanout.progress()
+            return dict(self._d_jobs)
+
+
+    def blockLoopMsg_show(self, astr_status, astr_loopMsg):
+        '''
+        Show a blocking status line, and then backspace over it so that
+        the next status line overwrites it on the console.
+        '''
+        str_loopMsg         = Colors.BROWN + astr_status + \
+                              Colors.YELLOW + astr_loopMsg + Colors.NO_COLOUR
+        self._log(str_loopMsg)
+        loopMsgLen          = len(str_loopMsg)
+        syslogLen           = len(self._log.str_syslog())
+        self._log('\b' * (loopMsgLen + syslogLen), syslog=False)
+
+
+    def blocker(self, *args):
+        '''
+        get/set the blocking backend used by the kwBlockOn*() methods.
+
+        If None (the default), each method constructs the backend that
+        matches its semantics. Setting a Blocker object (for example a
+        SentinelBlocker) overrides this for all of them.
+
+        blocker():          returns the current blocking backend
+        blocker(<obj>):     sets the blocking backend
+
+        '''
+        if len(args):
+            self._blocker = args[0]
+        else:
+            return self._blocker
+
+
+    def blockOn(self, blocker, astr_blockMsg = '', astr_loopMsg = ''):
+        '''
+        Block on the given <blocker> backend.
+        '''
+        startTime   = time.time()
+        ret         = blocker.block(self, astr_blockMsg, astr_loopMsg)
+        self.profile_add('wall_blocked', time.time() - startTime)
+        return ret
+
+
     def kwBlockOnScheduler(self, **kwargs):
         '''
         A 'kwargs' block-on-jobs-in-scheduler method. This method assumes
@@ -641,49 +3103,41 @@ class Stage:
 
         Not all kwargs can be completely processed by all queue methods.
 
+        Polling starts fast and backs off exponentially (up to <timeout>
+        seconds) while the queue state does not change. Queue queries are
+        shared between all stages waiting on the same scheduler.
+
         kwargs:
             blockProcess                process in scheduler to block on
             blockMsg                    log message when block starts
             loopMsg                     log message while blocking
-            timeout                     how long between checking astr_shellCmd
-                                        while blocking
-        '''
+            timeout                     maximum time between checking the
+                                        scheduler while blocking
+            blockUntil                  pending/running count at which
+                                        the block is released
+            settle                      initial wait to allow network and
+                                        "ramp up" transients to reach
+                                        steady state (default 5s)
+            backoff                     a Backoff object to use instead
+                                        of the default
+        '''
+        astr_blockMsg   = ''
+        astr_loopMsg    = ''
+        atimeout        = 10
+        d_blocker       = {'settle': 5}
         for key, val in kwargs.iteritems():
-            if key == 'blockProcess':   astr_blockProcess       = val
-            if key == 'blockMsg':       astr_blockMsg           = val
-            if key == 'loopMsg':        astr_loopMsg            = val
-            if key == 'timeout':        atimeout                = val
-            if key == 'blockUntil':     ablockUntil             = val
-
-        # Wait a few seconds before checking on scheduled/running etc
-        # to allow any network and "ramp up" transients to reach
-        # steady state.
-        time.sleep(5)
-        (str_pending, str_running, str_scheduled, str_completed) = \
-            self.shell().queueInfo(blockProcess=astr_blockProcess)
-        astr_allJobsDoneCount           = ablockUntil
-        blockLoop       = 1
-        if str_scheduled != astr_allJobsDoneCount:
-            self._log(Colors.CYAN + astr_blockMsg + Colors.NO_COLOUR)
-            while 1:
-                time.sleep(atimeout)
-                str_pending, str_running, str_scheduled, str_completed = \
-                    self.shell().queueInfo(blockProcess=astr_blockProcess)
-                if str_running == astr_allJobsDoneCount and \
-                   str_pending == astr_allJobsDoneCount:
-                    self._log('\n', syslog=False)
-                    break
-                else:
-                    str_loopMsg         = Colors.BROWN + \
-                    '(block duration = %ds; pending/running/completed/scheduled = %s/%s/%s/%s) '% \
-                    (blockLoop * atimeout, str_pending, str_running, str_completed, str_scheduled) + \
-                    Colors.YELLOW + astr_loopMsg + Colors.NO_COLOUR
-                    self._log(str_loopMsg)
-                    loopMsgLen          = len(str_loopMsg)
-                    syslogLen           = len(self._log.str_syslog())
-                    for i in range(0, loopMsgLen+syslogLen): self._log('\b', syslog=False)
-                    blockLoop           += 1
-        return True
+            if key == 'blockProcess':   d_blocker['blockProcess']   = val
+            if key == 'blockMsg':       astr_blockMsg               = val
+            if key == 'loopMsg':        astr_loopMsg                = val
+            if key == 'timeout':        atimeout                    = val
+            if key == 'blockUntil':     d_blocker['blockUntil']     = val
+            if key == 'settle':         d_blocker['settle']         = val
+            if key == 'backoff':        d_blocker['backoff']        = val
+        d_blocker.setdefault('backoff', Backoff(initial = 1, maximum = atimeout))
+        blocker = self._blocker
+        if blocker is None:
+            blocker = SchedulerBlocker(self.shell(), **d_blocker)
+        return self.blockOn(blocker, astr_blockMsg, astr_loopMsg)
 
 
     def kwBlockOnShellCmd_rs(self, **kwargs):
@@ -694,48 +3148,32 @@ class Stage:
         The _rs denotes that this method is specialized to flagging
         running *and* scheduled jobs.
 
-        This particular method is MOSIX specific.
+        This particular method is MOSIX specific: a single 'mosq listall'
+        is shared between all waiting stages and filtered for each
+        <blockProcess>.
 
         kwargs:
             blockProcess                process in scheduler to block on
             blockMsg                    log message when block starts
             loopMsg                     log message while blocking
-            timeout                     how long between checking astr_shellCmd
-                                        while blocking
+            timeout                     maximum time between checking the
+                                        scheduler while blocking
         '''
+        astr_blockMsg   = ''
+        astr_loopMsg    = ''
+        atimeout        = 10
+        d_blocker       = {'listCmd': 'mosq listall'}
         for key, val in kwargs.iteritems():
-            if key == 'blockProcess':   astr_blockProcess       = val
-            if key == 'blockMsg':       astr_blockMsg           = val
-            if key == 'loopMsg':        astr_loopMsg            = val
-            if key == 'timeout':        atimeout                = val
-        shellScheduleCount              = crun.crun()
-        shellRunCount                   = crun.crun()
-        astr_processInSchedulerCount    = 'mosq listall | grep %s | wc -l' % astr_blockProcess
-        astr_allJobsDoneCount           = '0'
-        astr_processRunningCount        = 'mosq listall | grep %s | grep RUN | wc -l' % astr_blockProcess
-        shellScheduleCount(astr_processInSchedulerCount)
-        blockLoop       = 1
-        if shellScheduleCount.stdout().strip() != astr_allJobsDoneCount:
-            self._log(Colors.CYAN + astr_blockMsg + Colors.NO_COLOUR)
-            while 1:
-                time.sleep(atimeout)
-                shellScheduleCount(astr_processInSchedulerCount)
-                shellRunCount(astr_processRunningCount)
-                str_scheduled   = shellScheduleCount.stdout().strip()
-                str_running     = shellRunCount.stdout().strip()
-                if str_scheduled == astr_allJobsDoneCount:
-                    self._log('\n', syslog=False)
-                    break
-                else:
-                    str_loopMsg         = Colors.BROWN + '(block duration = %ds; running/scheduled = %s/%s) '% \
-                                          (blockLoop * atimeout, str_running, str_scheduled) + \
-                                          Colors.YELLOW + astr_loopMsg + Colors.NO_COLOUR
-                    self._log(str_loopMsg)
-                    loopMsgLen          = len(str_loopMsg)
-                    syslogLen           = len(self._log.str_syslog())
-                    for i in range(0, loopMsgLen+syslogLen): self._log('\b', syslog=False)
-                    blockLoop           += 1
-        return True
+            if key == 'blockProcess':   d_blocker['blockProcess']   = val
+            if key == 'blockMsg':       astr_blockMsg               = val
+            if key == 'loopMsg':        astr_loopMsg                = val
+            if key == 'timeout':        atimeout                    = val
+            if key == 'backoff':        d_blocker['backoff']        = val
+        d_blocker.setdefault('backoff', Backoff(initial = 1, maximum = atimeout))
+        blocker = self._blocker
+        if blocker is None:
+            blocker = ListingBlocker(**d_blocker)
+        return self.blockOn(blocker, astr_blockMsg, astr_loopMsg)
 
 
     def blockOnShellCmd(self, astr_shellCmd, astr_shellReturn,
@@ -745,10 +3183,10 @@ class Stage:
         '''
         Block on a shell command.
 
-        This method will repeatedly poll a given <str_shellCmd> every
-        <atimeout> seconds until the command evaluates to <astr_shellReturn>.
-        The <astr_shellCmd> itself should not block, but simply evaluate a
-        condition and return a status.
+        This method will repeatedly poll a given <str_shellCmd>, at most
+        every <atimeout> seconds, until the command evaluates to
+        <astr_shellReturn>. The <astr_shellCmd> itself should not block,
+        but simply evaluate a condition and return a status.
 
         It is typically used as either a pre- or post-condition filter.
 
@@ -758,33 +3196,18 @@ class Stage:
                                         indicating success
             astr_blockMsg               log message when block starts
             astr_loopMsg                log message while blocking
-            atimeout                    how long between checking astr_shellCmd
-                                        while blocking
+            atimeout                    maximum time between checking
+                                        astr_shellCmd while blocking
         RETURN
             o True
 
         '''
-        shell           = crun.crun()
-        shell(astr_shellCmd)
-        blockLoop       = 1
-        if shell.stdout().strip() != astr_shellReturn:
-            self._log(Colors.CYAN + astr_blockMsg + Colors.NO_COLOUR)
-            while 1:
-                time.sleep(atimeout)
-                shell(astr_shellCmd)
-                if shell.stdout().strip() == astr_shellReturn:
-                    self._log('\n', syslog=False)
-                    break
-                else:
-                    str_loopMsg         = Colors.BROWN + '(block duration = %ds; block processCount = %s) '% \
-                                          (blockLoop * atimeout, shell.stdout().strip()) + \
-                                          Colors.YELLOW + astr_loopMsg + Colors.NO_COLOUR
-                    self._log(str_loopMsg)
-                    loopMsgLen          = len(str_loopMsg)
-                    syslogLen           = len(self._log.str_syslog())
-                    for i in range(0, loopMsgLen+syslogLen): self._log('\b', syslog=False)
-                    blockLoop           += 1
-        return True
+        blocker = self._blocker
+        if blocker is None:
+            blocker = ShellCmdBlocker(shellCmd      = astr_shellCmd,
+                                      shellReturn   = astr_shellReturn,
+                                      backoff       = Backoff(initial = 1, maximum = atimeout))
+        return self.blockOn(blocker, astr_blockMsg, astr_loopMsg)
 
 
     def fatalConditions(self, *args):
@@ -808,8 +3231,26 @@ class Stage:
 class Stage_crun(Stage):
     '''
     A Stage class that uses crun as its execute engine.
+
+    In 'streaming' mode, the command is instead run locally through a
+    StreamCapture: its output is spooled to rotating files named after
+    the stage, and only a bounded tail is kept in memory for stdout()
+    and stderr(). Streaming mode does not use the crun shell, and so
+    it is an error to stream with any shell other than a plain local
+    crun.crun (e.g. a remote or scheduled one).
+
+    A failing command can be retried according to a RetryPolicy (see
+    retry()), which is mostly useful for remote shells that suffer from
+    transient network errors.
     '''
 
+    _dictErr = {
+        'streamingShell'    : {
+            'action'        : 'setting up a streaming stage command, ',
+            'error'         : 'streaming runs locally, but the stage has a remote or scheduled shell.',
+            'exitCode'      : 14}
+    }
+
 
     def cmd(self, *args):
         '''
@@ -829,27 +3270,108 @@ class Stage_crun(Stage):
             return self._str_cmd
 
 
+    def streaming(self, *args):
+        '''
+        get/set the streaming capture flag.
+
+        streaming():                returns the current streaming flag
+        streaming(True|False):      sets the flag to True|False
+
+        '''
+        if len(args):
+            self._b_streaming = args[0]
+        else:
+            return self._b_streaming
+
+
+    def retry(self, *args):
+        '''
+        get/set the RetryPolicy of the stage command.
+
+        For convenience, an integer sets a policy that retries any
+        failure up to that many attempts in total.
+
+        retry():                returns the current RetryPolicy
+        retry(<policy>|<N>):    sets the retry policy
+
+        '''
+        if len(args):
+            self._retry = args[0]
+            if isinstance(self._retry, (int, long)):
+                self._retry = RetryPolicy(maxAttempts = self._retry)
+        else:
+            return self._retry
+
+
+    def capture(self):
+        '''
+        Returns the StreamCapture of the most recent streaming execution,
+        or None.
+        '''
+        return self._capture
+
+
+    def engine(self):
+        '''
+        Returns the object that holds the most recent execution results,
+        i.e. either the crun shell or the StreamCapture.
+        '''
+        if self._b_streaming and self._capture is not None: return self._capture
+        return self._shell
+
+
     def stdout(self):
         '''
         Returns the stdout data from the shell. This reflects the most
         recent stdout collected from executing a system process.
+
+        In streaming mode, this is only the tail of the output.
         '''
-        return self._shell.stdout()
+        if self._b_cacheHit: return self._str_stdout
+        return self.engine().stdout()
 
 
     def stderr(self):
         '''
         Returns the stderr data from the shell. This reflects the most
         recent stderr collected from executing a system process.
+
+        In streaming mode, this is only the tail of the output.
         '''
-        return self._shell.stderr()
+        if self._b_cacheHit: return self._str_stderr
+        return self.engine().stderr()
 
 
     def exitCode(self):
         '''
         Returns the shell exit code from the most command executed.
         '''
-        return self._shell.exitCode()
+        if self._b_cacheHit: return self._str_exitCode
+        return self.engine().exitCode()
+
+
+    def cache_material(self):
+        '''
+        For a crun stage, the work done is simply the shell command.
+        '''
+        return self._str_cmd
+
+
+    def cacheable(self):
+        '''
+        A crun stage is always identified by its shell command.
+        '''
+        return True
+
+
+    def outputBytes(self):
+        '''
+        In streaming mode, the byte counts cover the full output, not
+        just the tail kept in memory.
+        '''
+        if self._b_streaming and self._capture is not None and not self._b_cacheHit:
+            return self._capture.bytes_stdout(), self._capture.bytes_stderr()
+        return Stage.outputBytes(self)
 
 
     def __init__(self, **kwargs):
@@ -857,7 +3379,8 @@ class Stage_crun(Stage):
         Sub-class constuctor. Currently sets an internal sub-class
         _shell object, and then calls the super-class constructor.
         '''
-        self._shell             = crun.crun()
+        if getattr(self, '_shell', None) is None:
+            self._shell         = crun.crun()
         Stage.__init__(self, **kwargs)
 
         # The following flags force flushing of stdout/stderr streams
@@ -866,9 +3389,71 @@ class Stage_crun(Stage):
         # generate output to stdout/stderr.
         self._b_stdoutflush     = True
         self._b_stderrflush     = True
+
+        # Streaming capture settings. See StreamCapture.
+        self._b_streaming       = False
+        self._capture           = None
+        self._str_spoolDir      = '.'
+        self._spoolMaxBytes     = 64*1024*1024
+        self._spoolCount        = 4
+        self._tailBytes         = 64*1024
+
+        # By default, a failed command is not retried. See retry().
+        self._retry             = RetryPolicy()
         for key, value in kwargs.iteritems():
+            if key == 'retry':          self.retry(value)
             if key == 'stdoutflush':    self._b_stdoutflush = value
             if key == 'stderrflush':    self._b_stderrflush = value
+            if key == 'streaming':      self._b_streaming   = value
+            if key == 'spoolDir':       self._str_spoolDir  = value
+            if key == 'spoolMaxMB':     self._spoolMaxBytes = int(value * 1024*1024)
+            if key == 'spoolCount':     self._spoolCount    = value
+            if key == 'tailKB':         self._tailBytes     = int(value * 1024)
+        self.streaming_check()
+
+
+    def streaming_check(self):
+        '''
+        In streaming mode, the command bypasses the crun shell and runs
+        locally, so refuse any shell that would have run it elsewhere.
+        '''
+        if self._b_streaming and self._shell.__class__ is not crun.crun:
+            error.fatal(self, 'streamingShell', '%s' % self._shell.__class__.__name__, stage = self.name())
+
+
+    def capture_create(self):
+        '''
+        Returns a new StreamCapture, spooling to a file stem in the spool
+        directory that is derived from the stage name.
+        '''
+        str_spoolStem = ''
+        if self._str_spoolDir:
+            if not os.path.isdir(self._str_spoolDir):
+                os.makedirs(self._str_spoolDir)
+            str_spoolStem = os.path.join(self._str_spoolDir,
+                                re.sub(r'[^\w.-]+', '_', self.name()))
+        return StreamCapture(spoolStem      = str_spoolStem,
+                             spoolMaxBytes  = self._spoolMaxBytes,
+                             spoolCount     = self._spoolCount,
+                             tailBytes      = self._tailBytes,
+                             stdoutflush    = self._b_stdoutflush,
+                             stderrflush    = self._b_stderrflush)
+
+
+    def attempt(self, attempt = 1):
+        '''
+        Run the stage command once and return its exit code.
+        '''
+        if self._b_streaming:
+            self.streaming_check()
+            self._capture = self.capture_create()
+            str_stdout, str_stderr, exitCode = self._capture(self._str_cmd)
+        else:
+            str_stdout, str_stderr, exitCode = self._shell(self._str_cmd,
+                                stdoutflush = self._b_stdoutflush,
+                                stderrflush = self._b_stderrflush)
+        return exitCode
+
 
     def __call__(self, **kwargs):
         '''
@@ -890,10 +3475,19 @@ class Stage_crun(Stage):
         for key, value in kwargs.iteritems():
             if key == 'cmd':    self._str_cmd   = value
         if len(self._str_cmd):
-            str_stdout, str_stderr, exitCode = self._shell(self._str_cmd,
-                                    stdoutflush = self._b_stdoutflush,
-                                    stderrflush = self._b_stderrflush)
-            if exitCode: return
+            startTime = time.time()
+            self._b_cacheHit = False
+            str_key = self.cache_key()
+            if not len(str_key) or not self.cache_restore(str_key):
+                exitCode, attempts = self._retry(self.attempt, self._log)
+                self.profile_add('attempts', attempts)
+                self.profile_add('wall_stage', time.time() - startTime)
+                if exitCode:
+                    self.profile_close()
+                    return
+                if len(str_key): self.cache_store(str_key)
+            else:
+                self.profile_add('wall_stage', time.time() - startTime)
         else:
             self.fatal('NoCmd')
 
@@ -911,12 +3505,14 @@ class Stage_crun_mosix(Stage_crun):
         Sub-class constuctor. Currently sets an internal sub-class
         _shell object, and then calls the super-class constructor.
         '''
-        # First, filter out any args pertinent to the crun_mosix object
+        # First, filter out any args pertinent to the crun_mosix object.
+        # Note that a 'streaming' kwarg is refused (see streaming_check()),
+        # since it would bypass the cluster and run on the submit host.
         crun_kwargs     = {}
         for key, value in kwargs.iteritems():
             if 'crun' in key: crun_kwargs[key[4:]] = value
         self._shell     = crun.crun_mosix(**crun_kwargs)
-        Stage.__init__(self, **kwargs)
+        Stage_crun.__init__(self, **kwargs)
 
 
     def __call__(self, **kwargs):
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+
+'''
+A small local HTTP endpoint that serves the progress of a running
+pipeline as JSON, so that monitoring can poll any number of concurrent
+pipelines without scraping their terminal output.
+
+    server = telemetry.Server(pipeline.status, '127.0.0.1:8421')
+    ...
+    server.close()
+
+The <address> is either 'host:port' or simply 'port' for a TCP socket
+(port 0 picks a free port, see Server.address()), or a filesystem path,
+i.e. anything containing a '/', for a Unix domain socket:
+
+    $>curl http://127.0.0.1:8421/
+    $>curl --unix-socket /tmp/hbwm.sock http://localhost/
+
+Any GET request returns the current status. Requests are answered from
+background threads, so a slow client never holds up the pipeline.
+
+'''
+
+import  os
+import  json
+import  atexit
+import  threading
+import  BaseHTTPServer
+import  SocketServer
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        try:
+            str_body    = json.dumps(self.server.f_status(), indent = 1, default = str)
+            code        = 200
+        except Exception, e:
+            str_body    = json.dumps({'error': repr(e)})
+            code        = 500
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(str_body)))
+        self.end_headers()
+        self.wfile.write(str_body)
+
+
+    def address_string(self):
+        # Unix domain sockets have no client address, and there is no
+        # point in a reverse DNS lookup for every poll of a TCP client.
+        return 'local'
+
+
+    def log_message(self, format, *args):
+        # Monitoring polls would otherwise clutter the pipeline's stderr.
+        pass
+
+
+class TCPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads      = True
+    allow_reuse_address = True
+
+
+class UnixServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads      = True
+
+
+class Server:
+    '''
+    Serves the dictionary returned by <f_status>() as JSON on <address>.
+    '''
+
+    def __init__(self, f_status, address):
+        self._str_path  = ''
+        str_address     = str(address)
+        if '/' in str_address:
+            self._str_path = str_address
+            if os.path.exists(str_address): os.remove(str_address)
+            self._server = UnixServer(str_address, Handler)
+        else:
+            str_host, sep, str_port = str_address.rpartition(':')
+            self._server = TCPServer((str_host or '127.0.0.1', int(str_port)), Handler)
+        self._server.f_status   = f_status
+        self._thread            = threading.Thread(target = self._server.serve_forever)
+        self._thread.daemon     = True
+        self._thread.start()
+        atexit.register(self.close)
+
+
+    def address(self):
+        '''
+        Returns the address actually served, i.e. 'host:port' with any
+        port 0 resolved, or the Unix socket path.
+        '''
+        if len(self._str_path): return self._str_path
+        return '%s:%d' % self._server.server_address[:2]
+
+
+    def close(self):
+        if self._server is None: return
+        self._server.shutdown()
+        self._server.server_close()
+        self._server = None
+        if len(self._str_path) and os.path.exists(self._str_path):
+            os.remove(self._str_path)
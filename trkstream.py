@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+
+'''
+Streaming access to TrackVis (.trk) files.
+
+Unlike loading a whole file at once, the Reader yields the tracks in
+chunks of a fixed number of tracks, so that a file of any size can be
+processed in constant memory:
+
+    reader = trkstream.Reader('in.trk', chunk = 10000)
+    writer = trkstream.Writer('out.trk', reader.header())
+    for l_track in reader.chunks():
+        writer.write([t for t in l_track if len(t[0]) > 10])
+    writer.close()
+    reader.close()
+
+Tracks are (points, scalars, properties) tuples as elsewhere in the
+FNNDSC tools: an (n x 3) array of points, an (n x n_scalars) array of
+scalars (or None) and an array of n_properties properties (or None).
+
+The header is the 1000 byte TrackVis header, as a 0-d structured array
+with the usual field names ('dim', 'scalar_name', 'n_count', ...). In
+the file, each track follows as an int32 number of points <n>, then
+n x (3 + n_scalars) float32 values and n_properties float32 values.
+Since the number of tracks is only known at the end, the Writer leaves
+'n_count' at 0 and patches it into the header on close().
+
+'''
+
+import  struct
+import  numpy       as np
+
+
+HEADER_SIZE     = 1000
+N_COUNT_OFFSET  = 988
+
+_l_header       = [
+    ('id_string',                   'S6'),
+    ('dim',                         'h', (3,)),
+    ('voxel_size',                  'f4', (3,)),
+    ('origin',                      'f4', (3,)),
+    ('n_scalars',                   'h'),
+    ('scalar_name',                 'S20', (10,)),
+    ('n_properties',                'h'),
+    ('property_name',               'S20', (10,)),
+    ('vox_to_ras',                  'f4', (4, 4)),
+    ('reserved',                    'S444'),
+    ('voxel_order',                 'S4'),
+    ('pad2',                        'S4'),
+    ('image_orientation_patient',   'f4', (6,)),
+    ('pad1',                        'S2'),
+    ('invert_x',                    'S1'),
+    ('invert_y',                    'S1'),
+    ('invert_z',                    'S1'),
+    ('swap_xy',                     'S1'),
+    ('swap_yz',                     'S1'),
+    ('swap_zx',                     'S1'),
+    ('n_count',                     'i4'),
+    ('version',                     'i4'),
+    ('hdr_size',                    'i4')
+]
+
+
+def header_dtype(astr_endian = '<'):
+    '''
+    Returns the dtype of the header in the byte order <astr_endian>.
+    '''
+    return np.dtype(_l_header).newbyteorder(astr_endian)
+
+
+def header_make(header = None):
+    '''
+    Returns a new (little endian) header with the fields of <header>,
+    e.g. the header of another file, and 'n_count' reset to 0.
+    '''
+    h = np.zeros((), dtype = header_dtype())
+    if header is not None:
+        for str_name in header.dtype.names:
+            if str_name in h.dtype.names: h[str_name] = header[str_name]
+    h['id_string']  = 'TRACK'
+    h['hdr_size']   = HEADER_SIZE
+    h['n_count']    = 0
+    if not h['version']: h['version'] = 2
+    return h
+
+
+class Reader:
+    '''
+    kwargs:
+        chunk                   the number of tracks per chunk (default 10000)
+    '''
+
+    def __init__(self, astr_file, **kwargs):
+        self._chunk         = 10000
+        for key, value in kwargs.iteritems():
+            if key == 'chunk':  self._chunk     = int(value)
+        self._str_file      = astr_file
+        self._file          = open(astr_file, 'rb')
+        str_header          = self._file.read(HEADER_SIZE)
+        if len(str_header) != HEADER_SIZE:
+            raise IOError('%s: not a .trk file (truncated header)' % astr_file)
+        # the header says its own size, which tells the byte order
+        self._str_endian    = '<'
+        if struct.unpack('<i', str_header[-4:])[0] != HEADER_SIZE:
+            self._str_endian = '>'
+        self._header        = np.frombuffer(str_header,
+                                            dtype = header_dtype(self._str_endian)).reshape(()).copy()
+        if self._header['hdr_size'] != HEADER_SIZE:
+            raise IOError('%s: not a .trk file (bad header size)' % astr_file)
+
+
+    def header(self):
+        return self._header
+
+
+    def count(self):
+        '''
+        Returns the number of tracks according to the header, or 0 if it
+        is not known.
+        '''
+        return int(self._header['n_count'])
+
+
+    def chunks(self):
+        '''
+        Yields the tracks as lists of up to <chunk> tracks. Each call
+        starts over at the first track.
+        '''
+        n_scalars       = int(self._header['n_scalars'])
+        n_properties    = int(self._header['n_properties'])
+        n_count         = self.count()
+        str_int         = self._str_endian + 'i4'
+        str_float       = self._str_endian + 'f4'
+        f               = self._file
+        f.seek(HEADER_SIZE)
+        track           = 0
+        l_track         = []
+        while not n_count or track < n_count:
+            str_n       = f.read(4)
+            if not len(str_n): break
+            if len(str_n) != 4: self._truncated()
+            n           = int(np.frombuffer(str_n, dtype = str_int)[0])
+            size        = n * (3 + n_scalars) * 4
+            str_data    = f.read(size)
+            if len(str_data) != size: self._truncated()
+            data        = np.frombuffer(str_data, dtype = str_float).reshape(n, 3 + n_scalars)
+            scalars     = None
+            properties  = None
+            if n_scalars:       scalars     = data[:, 3:]
+            if n_properties:
+                str_data = f.read(n_properties * 4)
+                if len(str_data) != n_properties * 4: self._truncated()
+                properties = np.frombuffer(str_data, dtype = str_float)
+            l_track.append((data[:, :3], scalars, properties))
+            track      += 1
+            if len(l_track) == self._chunk:
+                yield l_track
+                l_track = []
+        if len(l_track): yield l_track
+
+
+    def __iter__(self):
+        for l_track in self.chunks():
+            for t in l_track: yield t
+
+
+    def _truncated(self):
+        raise IOError('%s: truncated track data' % self._str_file)
+
+
+    def close(self):
+        self._file.close()
+
+
+class Writer:
+    '''
+    Writes tracks to <astr_file> with (a copy of) <header>. Tracks are
+    appended with write() and the file is complete after close().
+    '''
+
+    def __init__(self, astr_file, header = None):
+        self._header        = header_make(header)
+        self._n_scalars     = int(self._header['n_scalars'])
+        self._n_properties  = int(self._header['n_properties'])
+        self._count         = 0
+        self._file          = open(astr_file, 'wb')
+        self._file.write(self._header.tostring())
+
+
+    def header(self):
+        return self._header
+
+
+    def count(self):
+        return self._count
+
+
+    def write(self, l_track):
+        '''
+        Append the tracks of the list <l_track>.
+        '''
+        l_data = []
+        for t in l_track:
+            points      = np.asarray(t[0], dtype = '<f4')
+            n           = len(points)
+            if self._n_scalars:
+                scalars = np.asarray(t[1], dtype = '<f4').reshape(n, self._n_scalars)
+                points  = np.hstack((points.reshape(n, 3), scalars))
+            l_data.append(struct.pack('<i', n))
+            l_data.append(points.tostring())
+            if self._n_properties:
+                l_data.append(np.asarray(t[2], dtype = '<f4').reshape(self._n_properties).tostring())
+        self._file.write(''.join(l_data))
+        self._count += len(l_track)
+
+
+    def close(self):
+        if self._file.closed: return
+        self._header['n_count'] = self._count
+        self._file.seek(N_COUNT_OFFSET)
+        self._file.write(struct.pack('<i', self._count))
+        self._file.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, type, value, traceback):
+        self.close()